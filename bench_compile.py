@@ -0,0 +1,122 @@
+import argparse
+import copy
+import json
+import os
+import time
+from pathlib import Path
+
+import torch
+
+from models import get_vit_base_patch16_224
+from utils import utils
+from utils.benchmark import synchronize
+from utils.compile import compile_model
+from utils.parser import load_config
+from vision_transformer import DINOHead
+
+
+def build_crops(config, args, device):
+    """
+    Random multi-crop batch: 2 global crops and `local_crops_number` local crops with fewer frames.
+    """
+    T, S = config.DATA.NUM_FRAMES, config.DATA.TRAIN_CROP_SIZE
+    local_frames = max(config.TIMESFORMER.TUBELET_SIZE, T // 2)
+    crops = [torch.randn(args.batch_size, 3, T, S, S, device=device) for _ in range(2)]
+    crops += [torch.randn(args.batch_size, 3, local_frames, args.local_crop_size, args.local_crop_size, device=device)
+              for _ in range(args.local_crops_number)]
+    return crops
+
+
+def train_step(student, teacher, optimizer, crops, args):
+    """
+    One student forward / backward and one teacher forward, with a cross-entropy between the student
+    outputs and the teacher outputs of the global crops in place of DINOLoss (which needs a process group).
+    """
+    with torch.cuda.amp.autocast(enabled=args.use_fp16):
+        with torch.no_grad():
+            teacher_output = teacher(crops[:2]).softmax(dim=-1).chunk(2)
+        student_output = student(crops).chunk(len(crops))
+        loss = sum(torch.sum(-t * s.log_softmax(dim=-1), dim=-1).mean()
+                   for t in teacher_output for s in student_output) / (2 * len(crops))
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def bench(student, teacher, crops, args, device):
+    optimizer = torch.optim.AdamW(student.parameters(), lr=1e-5)
+    # the first step triggers the compilation of the global and local crop graphs
+    synchronize(device)
+    start_time = time.time()
+    train_step(student, teacher, optimizer, crops, args)
+    synchronize(device)
+    first_step = time.time() - start_time
+    for _ in range(args.warmup):
+        train_step(student, teacher, optimizer, crops, args)
+    synchronize(device)
+    start_time = time.time()
+    for _ in range(args.num_iters):
+        train_step(student, teacher, optimizer, crops, args)
+    synchronize(device)
+    step_time = (time.time() - start_time) / args.num_iters
+    return {"first_step_s": first_step, "step_ms": 1000 * step_time}
+
+
+def build_student_teacher(config, args, device):
+    torch.manual_seed(0)
+    backbone = get_vit_base_patch16_224(cfg=config, no_head=True)
+    student = utils.MultiCropWrapper(backbone, DINOHead(backbone.embed_dim, args.out_dim))
+    teacher = copy.deepcopy(student)
+    for p in teacher.parameters():
+        p.requires_grad = False
+    return student.to(device).train(), teacher.to(device).train()
+
+
+def main(args):
+    config = load_config(args)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    crops = build_crops(config, args, device)
+    results = {}
+    for mode in ["eager"] + args.compile_modes:
+        student, teacher = build_student_teacher(config, args, device)
+        if mode != "eager":
+            # drop the graphs of the previous mode so that its compile time is measured from scratch
+            import torch._dynamo
+            torch._dynamo.reset()
+            compile_model(student.backbone, mode=mode)
+            compile_model(teacher.backbone, mode=mode)
+        results[mode] = bench(student, teacher, crops, args, device)
+        print(f"{mode}: {results[mode]}")
+        del student, teacher
+    for mode in args.compile_modes:
+        results[mode]["speedup"] = results["eager"]["step_ms"] / results[mode]["step_ms"]
+        # number of steps after which the compilation time is paid back
+        saved = (results["eager"]["step_ms"] - results[mode]["step_ms"]) / 1000
+        extra = results[mode]["first_step_s"] - results["eager"]["first_step_s"]
+        results[mode]["break_even_steps"] = extra / saved if saved > 0 else None
+
+    with (Path(args.output_dir) / "bench_compile.json").open("w") as f:
+        json.dump({"device": device, "batch_size": args.batch_size, "results": results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Step time and compile time of the compiled student / teacher')
+    parser.add_argument('--compile_modes', default=["default"], nargs='+',
+        choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile modes compared to eager.')
+    parser.add_argument('--batch_size', default=4, type=int, help='Clips per crop.')
+    parser.add_argument('--local_crops_number', default=8, type=int, help='Number of local crops.')
+    parser.add_argument('--local_crop_size', default=96, type=int, help='Resolution of the local crops.')
+    parser.add_argument('--out_dim', default=65536, type=int, help='Output dimension of the DINO head.')
+    parser.add_argument('--use_fp16', type=utils.bool_flag, default=True, help='Mixed precision training steps.')
+    parser.add_argument('--warmup', default=3, type=int, help='Untimed steps after the first one.')
+    parser.add_argument('--num_iters', default=10, type=int, help='Timed steps.')
+    parser.add_argument('--output_dir', default=".", help='Path to save the report.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    os.makedirs(args.output_dir, exist_ok=True)
+    main(args)
@@ -0,0 +1,126 @@
+import argparse
+import http.client
+import io
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from datasets.video_folder import list_videos
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=60):
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class EmbeddingClient(object):
+    """
+    Client of serve_embeddings.py over TCP or a unix socket, one connection per call.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, unix_socket="", timeout=60):
+        self.host, self.port, self.unix_socket, self.timeout = host, port, unix_socket, timeout
+
+    def _request(self, method, path, body=None, content_type="application/json"):
+        if self.unix_socket:
+            conn = UnixHTTPConnection(self.unix_socket, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request(method, path, body=body, headers={"Content-Type": content_type} if body else {})
+            response = conn.getresponse()
+            payload = json.loads(response.read())
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError("request failed ({}): {}".format(response.status, payload.get("error")))
+        return payload
+
+    def embed_paths(self, paths, num_clips=None):
+        request = {"paths": list(paths)}
+        if num_clips:
+            request["num_clips"] = num_clips
+        return self._request("POST", "/embed", json.dumps(request).encode())
+
+    def embed_frames(self, frames):
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(frames, dtype=np.uint8))
+        return self._request("POST", "/embed", buffer.getvalue(), content_type="application/x-npy")
+
+    def stats(self):
+        return self._request("GET", "/stats")
+
+
+def bench(args):
+    """
+    Send `num_requests` requests from `concurrency` callers and report the client side latency
+    percentiles and throughput, next to the counters of the server.
+    """
+    client = EmbeddingClient(args.host, args.port, args.unix_socket)
+    if args.input:
+        paths = [path for _, path in list_videos(args.input)]
+        assert len(paths) > 0, f"no videos found in {args.input}"
+        make_request = lambda i: client.embed_paths([paths[i % len(paths)]], args.num_clips)
+    else:
+        # random uint8 frames stand in for the callers decoding their own clips
+        rng = np.random.RandomState(0)
+        frames = rng.randint(0, 256, size=(args.frames, args.height, args.width, 3), dtype=np.uint8)
+        make_request = lambda i: client.embed_frames(frames)
+
+    def timed_request(i):
+        start_time = time.time()
+        response = make_request(i)
+        return time.time() - start_time, sum(response["valid"])
+
+    for i in range(args.warmup):
+        timed_request(i)
+    start_time = time.time()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(timed_request, range(args.num_requests)))
+    elapsed = time.time() - start_time
+    latencies = np.asarray([latency for latency, _ in results]) * 1000
+    report = {
+        "concurrency": args.concurrency,
+        "requests": args.num_requests,
+        "valid": int(sum(valid for _, valid in results)),
+        "requests_per_sec": args.num_requests / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "server": client.stats(),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Load test of the embedding service')
+    parser.add_argument('--host', default="127.0.0.1", type=str, help='Address of the service.')
+    parser.add_argument('--port', default=8765, type=int, help='Port of the service.')
+    parser.add_argument('--unix_socket', default="", type=str, help='Unix socket of the service, instead of TCP.')
+    parser.add_argument('--input', default="", type=str,
+        help='Folder or manifest of videos to request by path; random uint8 frames are sent if empty.')
+    parser.add_argument('--num_clips', default=0, type=int, help='Clips per video path (0: server default).')
+    parser.add_argument('--frames', default=16, type=int, help='Number of random frames per request.')
+    parser.add_argument('--height', default=240, type=int, help='Height of the random frames.')
+    parser.add_argument('--width', default=320, type=int, help='Width of the random frames.')
+    parser.add_argument('--num_requests', default=200, type=int, help='Number of timed requests.')
+    parser.add_argument('--concurrency', default=8, type=int, help='Number of concurrent callers.')
+    parser.add_argument('--warmup', default=5, type=int, help='Number of untimed sequential requests sent first.')
+    parser.add_argument('--output', default="", type=str, help='Path to save the report as json.')
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    bench(args)
@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+
+from datasets.data_utils import tensor_normalize, spatial_sampling
+from datasets.video_container import get_video_container
+
+
+def preprocess_frames(frames, scale, crop_size, mean, std):
+    """
+    Test-time preprocessing of decoded frames (list of h x w x c uint8 arrays): color normalization,
+    short side resized to `scale` and center crop of `crop_size`.
+    Returns a c x t x crop_size x crop_size tensor.
+    """
+    frames = torch.as_tensor(np.stack(frames))
+    frames = tensor_normalize(frames, mean, std)
+    frames = frames.permute(3, 0, 1, 2)
+    frames = spatial_sampling(
+        frames,
+        spatial_idx=1,
+        min_scale=scale,
+        max_scale=scale,
+        crop_size=crop_size,
+        random_horizontal_flip=False,
+    )
+    return frames
+
+
+def iter_video_frames(path, sampling_rate=1, scale=224, crop_size=224, mean=(0.45, 0.45, 0.45),
+                      std=(0.225, 0.225, 0.225), chunk_size=32):
+    """
+    Decode the video at `path` once, front to back, and yield every `sampling_rate`-th frame in
+    preprocessed chunks of `chunk_size` frames (c x t x h x w tensors, see preprocess_frames).
+    Only one chunk of frames is held in memory, whatever the length of the video.
+    """
+    mean, std = list(mean), list(std)
+    container = get_video_container(path, multi_thread_decode=True)
+    try:
+        frames = []
+        for idx, frame in enumerate(container.decode(video=0)):
+            if idx % sampling_rate:
+                continue
+            frames.append(frame.to_rgb().to_ndarray())
+            if len(frames) == chunk_size:
+                yield preprocess_frames(frames, scale, crop_size, mean, std)
+                frames = []
+        if frames:
+            yield preprocess_frames(frames, scale, crop_size, mean, std)
+    finally:
+        container.close()
@@ -0,0 +1,120 @@
+import os
+
+import torch
+import torch.utils.data
+
+from datasets.data_utils import tensor_normalize, spatial_sampling
+from datasets.decoder import decode
+from datasets.video_container import get_video_container
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".webm", ".mov", ".m4v")
+
+
+def list_videos(path):
+    """
+    Ids and paths of the videos to process, sorted by id. `path` is either a folder, searched
+    recursively for video files (the id of a video is its path relative to the folder), or a
+    manifest file with one `path` or `id<TAB>path` per line.
+    """
+    if os.path.isdir(path):
+        videos = []
+        for root, _, files in os.walk(path):
+            for name in files:
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    video_path = os.path.join(root, name)
+                    videos.append((os.path.relpath(video_path, path), video_path))
+    else:
+        videos = []
+        with open(path, "r") as f:
+            for line in f.read().splitlines():
+                if not line.strip():
+                    continue
+                fields = line.split("\t")
+                videos.append((fields[0], fields[-1]))
+    return sorted(videos)
+
+
+def preprocess_test_clip(cfg, frames):
+    """
+    Test-time preprocessing of decoded uint8 frames (`num frames` x `height` x `width` x `channel`):
+    color normalization, short side resized to TRAIN_JITTER_SCALES[0] and center crop of TEST_CROP_SIZE.
+    Returns a `channel` x `num frames` x `height` x `width` clip.
+    """
+    scale = cfg.DATA.TRAIN_JITTER_SCALES[0]
+    frames = tensor_normalize(frames, cfg.DATA.MEAN, cfg.DATA.STD)
+    frames = frames.permute(3, 0, 1, 2)
+    return spatial_sampling(
+        frames,
+        spatial_idx=1,
+        min_scale=scale,
+        max_scale=scale,
+        crop_size=cfg.DATA.TEST_CROP_SIZE,
+        random_horizontal_flip=False,
+    )
+
+
+def decode_test_clip(cfg, path, clip_idx=0, num_clips=1):
+    """
+    Decode the clip_idx-th of `num_clips` clips uniformly spread over the video at `path` and preprocess
+    it with preprocess_test_clip. Returns None if the video could not be decoded.
+    """
+    video_container = get_video_container(
+        path,
+        cfg.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE,
+        cfg.DATA.DECODING_BACKEND,
+    )
+    frames = decode(
+        container=video_container,
+        sampling_rate=cfg.DATA.SAMPLING_RATE,
+        num_frames=cfg.DATA.NUM_FRAMES,
+        clip_idx=clip_idx,
+        num_clips=num_clips,
+        video_meta={},
+        target_fps=cfg.DATA.TARGET_FPS,
+        backend=cfg.DATA.DECODING_BACKEND,
+        max_spatial_scale=cfg.DATA.TRAIN_JITTER_SCALES[0],
+    )
+    if frames is None:
+        return None
+    return preprocess_test_clip(cfg, frames)
+
+
+class VideoFolder(torch.utils.data.Dataset):
+    """
+    Test-time clips of arbitrary videos: for every video, `num_clips` clips uniformly spread over the
+    video, each with a center crop, preprocessed like the UCF101 / HMDB51 test clips.
+    Videos that can not be decoded are returned as zero clips with valid set to False.
+    """
+
+    def __init__(self, cfg, video_paths, num_clips=1, indices=None):
+        self.cfg = cfg
+        self.video_paths = video_paths
+        self.num_clips = num_clips
+        # indices of the videos (in video_paths) to load, e.g. the ones not extracted yet
+        self.indices = list(range(len(video_paths))) if indices is None else list(indices)
+
+    def _decode_clip(self, path, clip_idx):
+        return decode_test_clip(self.cfg, path, clip_idx, self.num_clips)
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            clips (tensor): `num_clips` x `channel` x `num frames` x `height` x `width`.
+            index (int): index of the video in video_paths.
+            valid (bool): whether all the clips could be decoded.
+        """
+        index = self.indices[index]
+        clips = []
+        try:
+            for clip_idx in range(self.num_clips):
+                clips.append(self._decode_clip(self.video_paths[index], clip_idx))
+        except Exception as e:
+            print("Failed to load video from {} with error {}".format(self.video_paths[index], e))
+            clips = [None]
+        if any(clip is None for clip in clips):
+            size = self.cfg.DATA.TEST_CROP_SIZE
+            return torch.zeros(self.num_clips, 3, self.cfg.DATA.NUM_FRAMES, size, size), index, False
+        return torch.stack(clips), index, True
+
+    def __len__(self):
+        return len(self.indices)
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import torch
+import torch.utils.data
+from torch import nn
+
+from eval_knn import build_knn_datasets, extract_features, knn_classifier, load_backbone
+from models.cpu_inference import CPU_MODES, CPUInferenceModel, configure_threads, feature_drift
+from utils import utils
+from utils.benchmark import measure_throughput
+from utils.parser import load_config
+
+
+def extract_split(model, dataset, args):
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        sampler=utils.DistributedEvalSampler(dataset, num_replicas=1, rank=0),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        drop_last=False,
+    )
+    return nn.functional.normalize(extract_features(model, data_loader), dim=1, p=2)
+
+
+def eval_cpu_inference(args):
+    """
+    k-NN accuracy, feature drift against fp32 and throughput of every CPU inference mode.
+    """
+    num_threads = configure_threads(args.num_threads)
+    print(f"Running on CPU with {num_threads} threads.")
+    config = load_config(args)
+    config.TEST.NUM_SPATIAL_CROPS = 1
+    dataset_train, dataset_val = build_knn_datasets(config, args.dataset)
+    train_labels = torch.tensor([s for s in dataset_train._labels]).long()
+    test_labels = torch.tensor([s for s in dataset_val._labels]).long()
+    if args.max_samples > 0:
+        dataset_train = torch.utils.data.Subset(dataset_train, range(min(args.max_samples, len(dataset_train))))
+        dataset_val = torch.utils.data.Subset(dataset_val, range(min(args.max_samples, len(dataset_val))))
+        train_labels, test_labels = train_labels[:len(dataset_train)], test_labels[:len(dataset_val)]
+    clip_shape = (3, config.DATA.NUM_FRAMES, config.DATA.TEST_CROP_SIZE, config.DATA.TEST_CROP_SIZE)
+
+    backbone = load_backbone(config, args.pretrained_weights, args.checkpoint_key, device="cpu")
+    modes = ["fp32"] + [mode for mode in args.modes if mode != "fp32"]
+    results, reference = {}, None
+    for mode in modes:
+        model = CPUInferenceModel(backbone, mode)
+        print(f"Extracting {mode} features...")
+        train_features = extract_split(model, dataset_train, args)
+        test_features = extract_split(model, dataset_val, args)
+        results[mode] = {}
+        for k in args.nb_knn:
+            top1, top5 = knn_classifier(train_features, train_labels, test_features, test_labels, k,
+                                        args.temperature)
+            results[mode][f"knn{k}_top1"] = top1
+            results[mode][f"knn{k}_top5"] = top5
+        if reference is None:
+            reference = torch.cat((train_features, test_features))
+        else:
+            results[mode].update(feature_drift(reference, torch.cat((train_features, test_features))))
+            for k in args.nb_knn:
+                results[mode][f"knn{k}_top1_drift"] = results[mode][f"knn{k}_top1"] - results["fp32"][f"knn{k}_top1"]
+        results[mode].update(measure_throughput(model, clip_shape, batch_size=args.batch_size,
+                                                num_iters=args.benchmark_iters, warmup=2, device="cpu"))
+        print(f"{mode}: {results[mode]}")
+
+    with (Path(args.output_dir) / "cpu_inference.json").open("w") as f:
+        json.dump({"num_threads": num_threads, "results": results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Accuracy drift and throughput of the CPU inference modes')
+    parser.add_argument('--pretrained_weights', required=True, type=str, help="Path to pretrained weights to evaluate.")
+    parser.add_argument("--checkpoint_key", default="teacher", type=str,
+        help='Key to use in the checkpoint (example: "teacher")')
+    parser.add_argument('--modes', default=["int8", "bf16"], nargs='+', choices=CPU_MODES,
+        help='CPU inference modes compared against fp32.')
+    parser.add_argument('--num_threads', default=0, type=int, help='Intra-op threads (0: torch default).')
+    parser.add_argument('--batch_size', default=8, type=int, help='Batch size of the extraction and benchmark.')
+    parser.add_argument('--benchmark_iters', default=10, type=int, help='Timed batches of the throughput benchmark.')
+    parser.add_argument('--max_samples', default=0, type=int,
+        help='Only use the first samples of each split (0: all of them).')
+    parser.add_argument('--nb_knn', default=[10, 20], nargs='+', type=int, help='Number of NN to use.')
+    parser.add_argument('--temperature', default=0.07, type=float, help='Temperature used in the voting coefficient')
+    parser.add_argument('--num_workers', default=4, type=int, help='Number of data loading workers.')
+    parser.add_argument('--dataset', default="ucf101", help='Dataset: ucf101 / hmdb51')
+    parser.add_argument('--output_dir', default=".", help='Path to save the report.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    os.makedirs(args.output_dir, exist_ok=True)
+    eval_cpu_inference(args)
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import torch
+import torch.backends.cudnn as cudnn
+import torch.utils.data
+from torch import nn
+
+from eval_knn import build_knn_datasets, extract_features, knn_classifier, load_backbone
+from models import get_distill_student
+from train_distill import subsample_frames
+from utils import utils
+from utils.benchmark import measure_throughput
+from utils.parser import load_config
+
+
+class StridedBackbone(nn.Module):
+    """
+    Backbone fed with every frame_stride-th frame of the clips, i.e. the student clips of train_distill.py.
+    """
+    def __init__(self, backbone, frame_stride):
+        super(StridedBackbone, self).__init__()
+        self.backbone = backbone
+        self.frame_stride = frame_stride
+        self.num_features = backbone.num_features
+
+    def forward(self, x):
+        return self.backbone(subsample_frames(x, self.frame_stride))
+
+
+def extract_split(model, dataset, args):
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        sampler=utils.DistributedEvalSampler(dataset, num_replicas=1, rank=0),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        drop_last=False,
+    )
+    return nn.functional.normalize(extract_features(model, data_loader), dim=1, p=2)
+
+
+@torch.no_grad()
+def eval_distill(args):
+    """
+    k-NN accuracy, throughput and size of the distilled student against its teacher.
+    """
+    config = load_config(args)
+    config.TEST.NUM_SPATIAL_CROPS = 1
+    dataset_train, dataset_val = build_knn_datasets(config, args.dataset)
+    train_labels = torch.tensor([s for s in dataset_train._labels]).long().cuda()
+    test_labels = torch.tensor([s for s in dataset_val._labels]).long().cuda()
+    clip_shape = (3, config.DATA.NUM_FRAMES, config.DATA.TEST_CROP_SIZE, config.DATA.TEST_CROP_SIZE)
+
+    frame_stride = config.DATA.NUM_FRAMES // config.DISTILL.NUM_FRAMES
+    models = {
+        "teacher": load_backbone(config, args.teacher_weights, "teacher"),
+        "student": StridedBackbone(load_backbone(config, args.student_weights, "student",
+                                                 model=get_distill_student(cfg=config, no_head=True)),
+                                   frame_stride).eval(),
+    }
+    results = {}
+    for name, model in models.items():
+        print(f"Extracting {name} features...")
+        train_features = extract_split(model, dataset_train, args).cuda()
+        test_features = extract_split(model, dataset_val, args).cuda()
+        results[name] = {"params_m": sum(p.numel() for p in model.parameters()) / 1e6}
+        for k in args.nb_knn:
+            top1, top5 = knn_classifier(train_features, train_labels, test_features, test_labels, k,
+                                        args.temperature)
+            results[name][f"knn{k}_top1"] = top1
+            results[name][f"knn{k}_top5"] = top5
+        results[name].update(measure_throughput(model, clip_shape, batch_size=args.batch_size,
+                                                num_iters=args.benchmark_iters))
+        print(f"{name}: {results[name]}")
+    results["student"]["speedup"] = results["student"]["clips_per_sec"] / results["teacher"]["clips_per_sec"]
+    for k in args.nb_knn:
+        results["student"][f"knn{k}_top1_gap"] = results["student"][f"knn{k}_top1"] - results["teacher"][f"knn{k}_top1"]
+
+    with (Path(args.output_dir) / "distill_report.json").open("w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('k-NN accuracy and throughput of a distilled student against its teacher')
+    parser.add_argument('--teacher_weights', required=True, type=str, help="train_ssl.py checkpoint of the teacher.")
+    parser.add_argument('--student_weights', required=True, type=str, help="train_distill.py checkpoint.")
+    parser.add_argument('--batch_size', default=32, type=int, help='Batch size of the extraction and benchmark.')
+    parser.add_argument('--benchmark_iters', default=20, type=int, help='Timed batches of the throughput benchmark.')
+    parser.add_argument('--nb_knn', default=[10, 20, 100, 200], nargs='+', type=int, help='Number of NN to use.')
+    parser.add_argument('--temperature', default=0.07, type=float, help='Temperature used in the voting coefficient')
+    parser.add_argument('--num_workers', default=8, type=int, help='Number of data loading workers.')
+    parser.add_argument('--dataset', default="ucf101", help='Dataset: ucf101 / hmdb51')
+    parser.add_argument('--output_dir', default=".", help='Path to save the report.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    os.makedirs(args.output_dir, exist_ok=True)
+    cudnn.benchmark = True
+    eval_distill(args)
@@ -13,7 +13,12 @@
 # limitations under the License.
 
 import argparse
+import hashlib
+import json
 import os
+import time
+
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
@@ -23,7 +28,11 @@ from torch import nn
 from datasets.hmdb51 import HMDB51
 from datasets.ucf101 import UCF101
 from models import get_vit_base_patch16_224
+from models.token_merging import TokenMergingWrapper
 from utils import utils
+from utils.ann import IVFPQIndex, recall_at_k
+from utils.benchmark import measure_throughput
+from utils.compile import compile_model
 from utils.parser import load_config
 
 
@@ -33,19 +42,22 @@ def extract_feature_pipeline(args):
     # config.DATA.PATH_TO_DATA_DIR = f"{os.path.expanduser('~')}/repo/mmaction2/data/{args.dataset}/knn_splits"
     # config.DATA.PATH_PREFIX = f"{os.path.expanduser('~')}/repo/mmaction2/data/{args.dataset}/videos"
     config.TEST.NUM_SPATIAL_CROPS = 1
-    if args.dataset == "ucf101":
-        dataset_train = UCFReturnIndexDataset(cfg=config, mode="train", num_retries=10)
-        dataset_val = UCFReturnIndexDataset(cfg=config, mode="val", num_retries=10)
-    elif args.dataset == "hmdb51":
-        dataset_train = HMDBReturnIndexDataset(cfg=config, mode="train", num_retries=10)
-        dataset_val = HMDBReturnIndexDataset(cfg=config, mode="val", num_retries=10)
-    else:
-        raise NotImplementedError(f"invalid dataset: {args.dataset}")
 
-    sampler = torch.utils.data.DistributedSampler(dataset_train, shuffle=False)
+    cache_dir = None
+    if args.feature_cache:
+        extra = f"checkpoint_key={args.checkpoint_key}," + token_merging_key(args)
+        cache_dir = os.path.join(args.feature_cache, feature_cache_key(checkpoint_digest(args.pretrained_weights),
+                                                                       config, args.dataset, extra=extra))
+        if is_feature_cache_complete(cache_dir):
+            print(f"Loading cached features from {cache_dir}")
+            return load_feature_cache(cache_dir)
+        if utils.get_rank() == 0:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    dataset_train, dataset_val = build_knn_datasets(config, args.dataset)
     data_loader_train = torch.utils.data.DataLoader(
         dataset_train,
-        sampler=sampler,
+        sampler=utils.DistributedEvalSampler(dataset_train),
         batch_size=args.batch_size_per_gpu,
         num_workers=args.num_workers,
         pin_memory=True,
@@ -53,6 +65,7 @@ def extract_feature_pipeline(args):
     )
     data_loader_val = torch.utils.data.DataLoader(
         dataset_val,
+        sampler=utils.DistributedEvalSampler(dataset_val),
         batch_size=args.batch_size_per_gpu,
         num_workers=args.num_workers,
         pin_memory=True,
@@ -61,27 +74,43 @@ def extract_feature_pipeline(args):
     print(f"Data loaded with {len(dataset_train)} train and {len(dataset_val)} val imgs.")
 
     # ============ building network ... ============
-    model = get_vit_base_patch16_224(cfg=config, no_head=True)
-    ckpt = torch.load(args.pretrained_weights)
-    # select_ckpt = "teacher"
-    renamed_checkpoint = {x[len("backbone."):]: y for x, y in ckpt.items() if x.startswith("backbone.")}
-    msg = model.load_state_dict(renamed_checkpoint, strict=False)
-    print(f"Loaded model with msg: {msg}")
-    model.cuda()
-    model.eval()
+    model = load_backbone(config, args.pretrained_weights, args.checkpoint_key)
+    if token_merging_key(args):
+        model = TokenMergingWrapper(model, args.tome_spatial_r, args.tome_temporal_r)
+        print(f"Token merging: {model.spatial_schedule} positions and {model.temporal_schedule} frames per block.")
+    if args.compile:
+        compile_model(model)
+    if args.measure_throughput:
+        clip_shape = (3, config.DATA.NUM_FRAMES, config.DATA.TEST_CROP_SIZE, config.DATA.TEST_CROP_SIZE)
+        stats = measure_throughput(model, clip_shape, batch_size=args.batch_size_per_gpu)
+        print(f"Inference throughput: {stats['clips_per_sec']:.1f} clips/s "
+              f"({stats['latency_ms']:.1f} ms per batch of {args.batch_size_per_gpu})")
+
+    train_labels = torch.tensor([s for s in dataset_train._labels]).long()
+    test_labels = torch.tensor([s for s in dataset_val._labels]).long()
 
     # ============ extract features ... ============
-    print("Extracting features for train set...")
-    train_features = extract_features(model, data_loader_train)
-    print("Extracting features for val set...")
-    test_features = extract_features(model, data_loader_val)
+    if cache_dir is not None:
+        print("Extracting features for train set...")
+        extract_features(model, data_loader_train, path=os.path.join(cache_dir, "trainfeat.npy"))
+        print("Extracting features for val set...")
+        extract_features(model, data_loader_val, path=os.path.join(cache_dir, "testfeat.npy"))
+        if utils.get_rank() == 0:
+            finalize_feature_cache(cache_dir, config, train_labels, test_labels, args.pretrained_weights, args.dataset)
+        # the other ranks read the labels and meta file written by rank 0
+        if utils.is_dist_avail_and_initialized():
+            dist.barrier()
+        train_features, test_features, train_labels, test_labels = load_feature_cache(cache_dir)
+    else:
+        print("Extracting features for train set...")
+        train_features = extract_features(model, data_loader_train)
+        print("Extracting features for val set...")
+        test_features = extract_features(model, data_loader_val)
 
     if utils.get_rank() == 0:
         train_features = nn.functional.normalize(train_features, dim=1, p=2)
         test_features = nn.functional.normalize(test_features, dim=1, p=2)
 
-    train_labels = torch.tensor([s for s in dataset_train._labels]).long()
-    test_labels = torch.tensor([s for s in dataset_val._labels]).long()
     # save features and labels
     if args.dump_features and dist.get_rank() == 0:
         torch.save(train_features.cpu(), os.path.join(args.dump_features, "trainfeat.pth"))
@@ -91,74 +120,207 @@ def extract_feature_pipeline(args):
     return train_features, test_features, train_labels, test_labels
 
 
+def build_knn_datasets(config, dataset):
+    if dataset == "ucf101":
+        dataset_train = UCFReturnIndexDataset(cfg=config, mode="train", num_retries=10)
+        dataset_val = UCFReturnIndexDataset(cfg=config, mode="val", num_retries=10)
+    elif dataset == "hmdb51":
+        dataset_train = HMDBReturnIndexDataset(cfg=config, mode="train", num_retries=10)
+        dataset_val = HMDBReturnIndexDataset(cfg=config, mode="val", num_retries=10)
+    else:
+        raise NotImplementedError(f"invalid dataset: {dataset}")
+    return dataset_train, dataset_val
+
+
+def load_backbone(config, pretrained_weights, checkpoint_key="teacher", device="cuda", model=None):
+    if model is None:
+        model = get_vit_base_patch16_224(cfg=config, no_head=True)
+    ckpt = torch.load(pretrained_weights, map_location="cpu")
+    # full training checkpoints (checkpointXXXX.pth) hold the networks under "student" / "teacher"
+    if checkpoint_key in ckpt:
+        ckpt = {x.replace("module.", "", 1): y for x, y in ckpt[checkpoint_key].items()}
+    renamed_checkpoint = {x[len("backbone."):]: y for x, y in ckpt.items() if x.startswith("backbone.")}
+    msg = model.load_state_dict(renamed_checkpoint, strict=False)
+    print(f"Loaded model with msg: {msg}")
+    model.to(device)
+    model.eval()
+    return model
+
+
+def token_merging_key(args):
+    """
+    Description of the token merging schedule, empty when merging is off.
+    """
+    if not any(getattr(args, "tome_spatial_r", [0])) and not any(getattr(args, "tome_temporal_r", [0])):
+        return ""
+    return f"tome_spatial={list(args.tome_spatial_r)},tome_temporal={list(args.tome_temporal_r)}"
+
+
+def checkpoint_digest(pretrained_weights):
+    """
+    Hash of the checkpoint bytes, read on rank 0 only and broadcast to the other ranks.
+    """
+    digest = [None]
+    if utils.get_rank() == 0:
+        sha = hashlib.sha256()
+        with open(pretrained_weights, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest[0] = sha.hexdigest()
+    if utils.is_dist_avail_and_initialized():
+        dist.broadcast_object_list(digest, src=0)
+    return digest[0]
+
+
+def feature_cache_key(weights_digest, config, dataset, extra=""):
+    """
+    Hash of the checkpoint digest (see checkpoint_digest) and of the full config,
+    so that features are only reused for the exact same weights, data pipeline
+    and model options. `extra` describes options that live outside of the config
+    (e.g. the checkpoint key selecting the student or the teacher).
+    """
+    sha = hashlib.sha256()
+    sha.update(weights_digest.encode())
+    sha.update(config.dump().encode())
+    sha.update(dataset.encode())
+    sha.update(extra.encode())
+    return sha.hexdigest()[:16]
+
+
+def is_feature_cache_complete(cache_dir):
+    return os.path.isfile(os.path.join(cache_dir, "meta.json"))
+
+
+def finalize_feature_cache(cache_dir, config, train_labels, test_labels, pretrained_weights, dataset):
+    np.save(os.path.join(cache_dir, "trainlabels.npy"), train_labels.numpy())
+    np.save(os.path.join(cache_dir, "testlabels.npy"), test_labels.numpy())
+    with open(os.path.join(cache_dir, "config.yaml"), "w") as f:
+        f.write(config.dump())
+    # written last: its presence marks the cache entry as complete
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump({"pretrained_weights": pretrained_weights, "dataset": dataset}, f)
+
+
+def load_feature_cache(cache_dir):
+    train_features = torch.from_numpy(np.load(os.path.join(cache_dir, "trainfeat.npy")))
+    test_features = torch.from_numpy(np.load(os.path.join(cache_dir, "testfeat.npy")))
+    train_labels = torch.from_numpy(np.load(os.path.join(cache_dir, "trainlabels.npy"))).long()
+    test_labels = torch.from_numpy(np.load(os.path.join(cache_dir, "testlabels.npy"))).long()
+    train_features = nn.functional.normalize(train_features, dim=1, p=2)
+    test_features = nn.functional.normalize(test_features, dim=1, p=2)
+    return train_features, test_features, train_labels, test_labels
+
+
 @torch.no_grad()
-def extract_features(model, data_loader):
+def extract_features(model, data_loader, path=None):
+    """
+    Extract the features of every sample of `data_loader.dataset`. Each rank
+    only processes the indices of its own sampler shard.
+
+    If `path` is given, the features are written straight into a shared
+    memory-mapped .npy file at the row of their sample index and the function
+    returns None; otherwise rank 0 receives the full feature matrix through a
+    single reduction at the end of the pass (other ranks return None).
+    """
     metric_logger = utils.MetricLogger(delimiter="  ")
-    features = None
+    num_samples = len(data_loader.dataset)
+    # the output width is known upfront for backbones; wrapped models (e.g. with a head) allocate lazily
+    feat_dim = getattr(getattr(model, "module", model), "num_features", None)
+    device = next(model.parameters()).device
+
+    features, counts = None, None
+    if path is not None:
+        assert feat_dim is not None, "memmap extraction needs a backbone exposing `num_features`"
+        if utils.get_rank() == 0:
+            np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(num_samples, feat_dim))
+        if utils.is_dist_avail_and_initialized():
+            dist.barrier()
+        features = np.lib.format.open_memmap(path, mode="r+")
+        print(f"Writing features into memmap {path} of shape {features.shape}")
+    else:
+        if feat_dim is not None:
+            features = torch.zeros(num_samples, feat_dim, device=device)
+        # padded samplers may hand the same sample to several ranks, count the writes
+        counts = torch.zeros(num_samples, device=device)
+
     for samples, index in metric_logger.log_every(data_loader, 10):
-        samples = samples.cuda(non_blocking=True)
-        index = index.cuda(non_blocking=True)
-        feats = model(samples).clone()
-
-        # init storage feature matrix
-        if dist.get_rank() == 0 and features is None:
-            features = torch.zeros(len(data_loader.dataset), feats.shape[-1])
-            # if args.use_cuda:
-            features = features.cuda(non_blocking=True)
-            print(f"Storing features into tensor of shape {features.shape}")
-
-        # get indexes from all processes
-        y_all = torch.empty(dist.get_world_size(), index.size(0), dtype=index.dtype, device=index.device)
-        y_l = list(y_all.unbind(0))
-        y_all_reduce = torch.distributed.all_gather(y_l, index, async_op=True)
-        y_all_reduce.wait()
-        index_all = torch.cat(y_l)
-
-        # share features between processes
-        feats_all = torch.empty(
-            dist.get_world_size(),
-            feats.size(0),
-            feats.size(1),
-            dtype=feats.dtype,
-            device=feats.device,
-        )
-        output_l = list(feats_all.unbind(0))
-        output_all_reduce = torch.distributed.all_gather(output_l, feats, async_op=True)
-        output_all_reduce.wait()
+        samples = samples.to(device, non_blocking=True)
+        feats = model(samples).float()
+        if path is not None:
+            features[index.numpy()] = feats.cpu().numpy()
+        else:
+            if features is None:
+                features = torch.zeros(num_samples, feats.shape[-1], device=device)
+            index = index.to(device, non_blocking=True)
+            features.index_copy_(0, index, feats)
+            counts.index_fill_(0, index, 1)
 
-        # update storage feature matrix
-        if dist.get_rank() == 0:
-            # if args.use_cuda:
-            features.index_copy_(0, index_all, torch.cat(output_l))
-            # else:
-            #     features.index_copy_(0, index_all.cpu(), torch.cat(output_l).cpu())
-    return features
+    if path is not None:
+        features.flush()
+        del features
+        if utils.is_dist_avail_and_initialized():
+            dist.barrier()
+        return None
+
+    if utils.is_dist_avail_and_initialized():
+        if feat_dim is None:
+            # lazily sized features: ranks without any batch (fewer samples than ranks) learn the width
+            width = torch.tensor(0 if features is None else features.shape[1], device=device)
+            dist.all_reduce(width, op=dist.ReduceOp.MAX)
+            if features is None:
+                features = torch.zeros(num_samples, int(width), device=device)
+        dist.reduce(features, dst=0)
+        dist.reduce(counts, dst=0)
+    if utils.get_rank() != 0:
+        return None
+    return features / counts.clamp(min=1).unsqueeze(1)
 
 
 @torch.no_grad()
-def knn_classifier(train_features, train_labels, test_features, test_labels, k, T, num_classes=1000):
-    top1, top5, total = 0.0, 0.0, 0
+def knn_search(train_features, test_features, k, index=None, nprobe=8):
+    """
+    Top-k inner product neighbors of every test feature in the train bank,
+    either exact (chunked brute force) or through an ANN `index`.
+    """
+    if index is not None:
+        return index.search(test_features, k, nprobe=nprobe)
     train_features = train_features.t()
-    num_test_images, num_chunks = test_labels.shape[0], 100
-    imgs_per_chunk = num_test_images // num_chunks
-    retrieval_one_hot = torch.zeros(k, num_classes).cuda()
+    num_test_images, num_chunks = test_features.shape[0], 100
+    imgs_per_chunk = max(1, num_test_images // num_chunks)
+    all_distances, all_indices = [], []
     for idx in range(0, num_test_images, imgs_per_chunk):
-        # get the features for test images
-        features = test_features[
-            idx : min((idx + imgs_per_chunk), num_test_images), :
-        ]
-        targets = test_labels[idx : min((idx + imgs_per_chunk), num_test_images)]
-        batch_size = targets.shape[0]
-
-        # calculate the dot product and compute top-k neighbors
+        features = test_features[idx : min((idx + imgs_per_chunk), num_test_images), :]
         similarity = torch.mm(features, train_features)
         distances, indices = similarity.topk(k, largest=True, sorted=True)
+        all_distances.append(distances)
+        all_indices.append(indices)
+    return torch.cat(all_distances), torch.cat(all_indices)
+
+
+@torch.no_grad()
+def knn_vote(distances, indices, train_labels, test_labels, k, T, num_classes=1000):
+    """
+    Weighted k-NN voting from precomputed (sorted) neighbors; only the first
+    `k` columns are used so one search can serve several values of k.
+    """
+    top1, top5, total = 0.0, 0.0, 0
+    num_test_images, num_chunks = test_labels.shape[0], 100
+    imgs_per_chunk = max(1, num_test_images // num_chunks)
+    retrieval_one_hot = torch.zeros(k, num_classes, device=distances.device)
+    for idx in range(0, num_test_images, imgs_per_chunk):
+        end = min((idx + imgs_per_chunk), num_test_images)
+        targets = test_labels[idx:end]
+        batch_size = targets.shape[0]
+        chunk_distances = distances[idx:end, :k]
+        chunk_indices = indices[idx:end, :k]
+        # the ANN index returns -1 when a query scanned fewer than k candidates
+        missing = chunk_indices < 0
         candidates = train_labels.view(1, -1).expand(batch_size, -1)
-        retrieved_neighbors = torch.gather(candidates, 1, indices)
+        retrieved_neighbors = torch.gather(candidates, 1, chunk_indices.clamp(min=0))
 
         retrieval_one_hot.resize_(batch_size * k, num_classes).zero_()
         retrieval_one_hot.scatter_(1, retrieved_neighbors.view(-1, 1), 1)
-        distances_transform = distances.clone().div_(T).exp_()
+        distances_transform = chunk_distances.clone().div_(T).exp_().masked_fill_(missing, 0)
         probs = torch.sum(
             torch.mul(
                 retrieval_one_hot.view(batch_size, -1, num_classes),
@@ -178,6 +340,23 @@ def knn_classifier(train_features, train_labels, test_features, test_labels, k,
     return top1, top5
 
 
+@torch.no_grad()
+def knn_classifier(train_features, train_labels, test_features, test_labels, k, T, num_classes=1000,
+                   index=None, nprobe=8):
+    distances, indices = knn_search(train_features, test_features, k, index=index, nprobe=nprobe)
+    return knn_vote(distances, indices, train_labels, test_labels, k, T, num_classes=num_classes)
+
+
+def build_ann_index(train_features, args):
+    index = IVFPQIndex(train_features.shape[1], nlist=args.ann_nlist, m=args.ann_m, nbits=args.ann_nbits)
+    start_time = time.time()
+    index.train(train_features)
+    index.add(train_features)
+    print(f"Built IVF-PQ index ({index.ntotal} vectors, nlist={index.nlist}, m={index.m}, "
+          f"nbits={index.nbits}) in {time.time() - start_time:.1f}s")
+    return index
+
+
 class UCFReturnIndexDataset(UCF101):
     def __getitem__(self, idx):
         img, _, _, _ = super(UCFReturnIndexDataset, self).__getitem__(idx)
@@ -208,6 +387,25 @@ if __name__ == '__main__':
         help='Path where to save computed features, empty for no saving')
     parser.add_argument('--load_features', default=None, help="""If the features have
         already been computed, where to find them.""")
+    parser.add_argument('--feature_cache', default=None, type=str, help="""Directory of memory-mapped
+        feature caches keyed by checkpoint hash + config; extraction is skipped when a matching entry exists.""")
+    parser.add_argument('--ann', default=False, type=utils.bool_flag,
+        help="Use an approximate IVF-PQ index instead of exact search for the k-NN classifier.")
+    parser.add_argument('--ann_nlist', default=1024, type=int, help='Number of inverted lists of the IVF-PQ index.')
+    parser.add_argument('--ann_m', default=64, type=int,
+        help='Number of product quantization sub-quantizers (must divide the feature dim).')
+    parser.add_argument('--ann_nbits', default=8, type=int, help='Bits per sub-quantizer code (<= 8).')
+    parser.add_argument('--ann_nprobe', default=16, type=int, help='Number of inverted lists scanned per query.')
+    parser.add_argument('--ann_recall', default=0, type=int, help="""Report the recall of the IVF-PQ search against
+        an exact search on this many randomly sampled test queries (0 to skip the exact search, -1 for all).""")
+    parser.add_argument('--tome_spatial_r', default=[0], nargs='+', type=int,
+        help="""Token merging: spatial positions merged after each block (one value for all blocks or one per block).""")
+    parser.add_argument('--tome_temporal_r', default=[0], nargs='+', type=int,
+        help="""Token merging: frames merged after each block (one value for all blocks or one per block).""")
+    parser.add_argument('--compile', default=False, type=utils.bool_flag,
+        help="Compile the backbone with torch.compile for feature extraction (eager fallback on failures).")
+    parser.add_argument('--measure_throughput', default=False, type=utils.bool_flag,
+        help="Report the inference throughput of the (possibly token-merged) backbone on random clips.")
     parser.add_argument('--num_workers', default=10, type=int, help='Number of data loading workers per GPU.')
     parser.add_argument("--dist_url", default="env://", type=str, help="""url used to set up
         distributed training; see https://pytorch.org/docs/stable/distributed.html""")
@@ -242,9 +440,43 @@ if __name__ == '__main__':
             train_labels = train_labels.cuda()
             test_labels = test_labels.cuda()
 
+        index = None
+        if args.ann:
+            index_path = os.path.join(args.load_features, "ann_index.pth") if args.load_features else None
+            if index_path is not None and os.path.isfile(index_path):
+                index = IVFPQIndex.load(index_path)
+                expected = {"dim": train_features.shape[1], "nlist": args.ann_nlist, "m": args.ann_m,
+                            "nbits": args.ann_nbits}
+                if index.config() != expected or index.ntotal != train_features.shape[0]:
+                    print(f"IVF-PQ index at {index_path} ({index.config()}, {index.ntotal} vectors) does not match "
+                          f"{expected} and {train_features.shape[0]} train features, rebuilding it")
+                    index = None
+                else:
+                    print(f"Loaded IVF-PQ index from {index_path}")
+            if index is None:
+                index = build_ann_index(train_features, args)
+            index.to(train_features.device)
+            if args.dump_features:
+                index.save(os.path.join(args.dump_features, "ann_index.pth"))
+
         print("Features are ready!\nStart the k-NN classification.")
+        # search once for the largest k, every smaller k votes on a prefix of the neighbors
+        max_k = max(args.nb_knn)
+        start_time = time.time()
+        distances, indices = knn_search(train_features, test_features, max_k,
+                                        index=index, nprobe=args.ann_nprobe)
+        print(f"{'IVF-PQ (nprobe=' + str(args.ann_nprobe) + ')' if args.ann else 'Exact'} "
+              f"search took {time.time() - start_time:.2f}s")
+        if args.ann and args.ann_recall != 0:
+            # exact search on a sample of the queries only, it is the cost the index avoids
+            queries = torch.arange(test_features.shape[0], device=test_features.device)
+            if 0 < args.ann_recall < test_features.shape[0]:
+                queries = torch.randperm(test_features.shape[0], device=test_features.device)[:args.ann_recall]
+            _, exact_indices = knn_search(train_features, test_features[queries], max_k)
+            for k in args.nb_knn:
+                recall = recall_at_k(indices[queries, :k], exact_indices[:, :k])
+                print(f"Recall@{k} of IVF-PQ vs exact search on {queries.numel()} queries: {recall:.4f}")
         for k in args.nb_knn:
-            top1, top5 = knn_classifier(train_features, train_labels,
-                test_features, test_labels, k, args.temperature)
+            top1, top5 = knn_vote(distances, indices, train_labels, test_labels, k, args.temperature)
             print(f"{k}-NN classifier result: Top1: {top1}, Top5: {top5}")
     dist.barrier()
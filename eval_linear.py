@@ -68,6 +68,7 @@ def eval_linear(args):
     )
     val_loader = torch.utils.data.DataLoader(
         dataset_val,
+        sampler=utils.DistributedEvalSampler(dataset_val),
         batch_size=args.batch_size_per_gpu,
         num_workers=args.num_workers,
         pin_memory=True,
@@ -75,6 +76,7 @@ def eval_linear(args):
 
     multi_crop_val_loader = torch.utils.data.DataLoader(
         multi_crop_val,
+        sampler=utils.DistributedEvalSampler(multi_crop_val),
         batch_size=args.batch_size_per_gpu,
         num_workers=args.num_workers,
         pin_memory=True,
@@ -249,10 +251,12 @@ def validate_network(val_loader, model, linear_classifier, n, avgpool):
             acc1, = utils.accuracy(output, target, topk=(1,))
 
         batch_size = inp.shape[0]
-        metric_logger.update(loss=loss.item())
+        metric_logger.meters['loss'].update(loss.item(), n=batch_size)
         metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
         if linear_classifier.module.num_labels >= 5:
             metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+    # every rank evaluated a disjoint shard of the val set
+    metric_logger.synchronize_between_processes()
     if linear_classifier.module.num_labels >= 5:
         print('* Acc@1 {top1.global_avg:.3f} Acc@5 {top5.global_avg:.3f} loss {losses.global_avg:.3f}'
               .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
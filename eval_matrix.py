@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.utils.data
+from torch import nn
+
+from eval_knn import UCFReturnIndexDataset, HMDBReturnIndexDataset, load_backbone, checkpoint_digest, \
+    feature_cache_key, finalize_feature_cache, is_feature_cache_complete, load_feature_cache, knn_search, knn_vote
+from utils import utils
+from utils.parser import load_config
+
+
+DATASETS = {
+    "ucf101": UCFReturnIndexDataset,
+    "hmdb51": HMDBReturnIndexDataset,
+}
+
+
+def get_dataset_config(args, dataset):
+    config = load_config(args)
+    config.DATA.PATH_TO_DATA_DIR = os.path.join(args.data_root, dataset, args.split_dir)
+    config.DATA.PATH_PREFIX = os.path.join(args.data_root, dataset, "videos")
+    config.TEST.NUM_SPATIAL_CROPS = 1
+    return config
+
+
+@torch.no_grad()
+def extract_features_multi(models, data_loader, paths):
+    """
+    Decode every clip of `data_loader` once and forward it through all
+    `models`, writing the features of models[i] into the shared memmap
+    paths[i] at the row of the sample index (see eval_knn.extract_features).
+    """
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    num_samples = len(data_loader.dataset)
+    if utils.get_rank() == 0:
+        for model, path in zip(models, paths):
+            np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(num_samples, model.num_features))
+    dist.barrier()
+    memmaps = [np.lib.format.open_memmap(path, mode="r+") for path in paths]
+
+    for samples, index in metric_logger.log_every(data_loader, 10):
+        samples = samples.cuda(non_blocking=True)
+        index = index.numpy()
+        for model, features in zip(models, memmaps):
+            features[index] = model(samples).float().cpu().numpy()
+
+    for features in memmaps:
+        features.flush()
+    del memmaps
+    dist.barrier()
+
+
+def extract_dataset(args, dataset, checkpoints, cache_dirs):
+    """
+    Fill the feature caches of all `checkpoints` that are not complete yet,
+    loading at most `args.models_per_pass` backbones per pass over the data.
+    """
+    config = get_dataset_config(args, dataset)
+    pending = [(ckpt, cache_dir) for ckpt, cache_dir in zip(checkpoints, cache_dirs)
+               if not is_feature_cache_complete(cache_dir)]
+    if not pending:
+        print(f"All features of {dataset} are cached.")
+        return
+
+    dataset_train = DATASETS[dataset](cfg=config, mode="train", num_retries=10)
+    dataset_val = DATASETS[dataset](cfg=config, mode="val", num_retries=10)
+    loaders = {}
+    for split, split_dataset in [("train", dataset_train), ("test", dataset_val)]:
+        loaders[split] = torch.utils.data.DataLoader(
+            split_dataset,
+            sampler=utils.DistributedEvalSampler(split_dataset),
+            batch_size=args.batch_size_per_gpu,
+            num_workers=args.num_workers,
+            pin_memory=True,
+            drop_last=False,
+        )
+    print(f"{dataset}: {len(dataset_train)} train and {len(dataset_val)} val videos, "
+          f"{len(pending)} checkpoint(s) to extract.")
+    train_labels = torch.tensor([s for s in dataset_train._labels]).long()
+    test_labels = torch.tensor([s for s in dataset_val._labels]).long()
+
+    group_size = args.models_per_pass if args.models_per_pass > 0 else len(pending)
+    for start in range(0, len(pending), group_size):
+        group = pending[start: start + group_size]
+        if utils.get_rank() == 0:
+            for _, cache_dir in group:
+                os.makedirs(cache_dir, exist_ok=True)
+        models = [load_backbone(config, ckpt, args.checkpoint_key) for ckpt, _ in group]
+        for split in ["train", "test"]:
+            print(f"Extracting {dataset} {split} features for {len(models)} checkpoint(s)...")
+            start_time = time.time()
+            extract_features_multi(models, loaders[split],
+                                   [os.path.join(cache_dir, f"{split}feat.npy") for _, cache_dir in group])
+            print(f"Done in {time.time() - start_time:.1f}s")
+        if utils.get_rank() == 0:
+            for ckpt, cache_dir in group:
+                finalize_feature_cache(cache_dir, config, train_labels, test_labels, ckpt, dataset)
+        del models
+        torch.cuda.empty_cache()
+    dist.barrier()
+
+
+def linear_probe(train_features, train_labels, test_features, test_labels, epochs=100, lr=0.1,
+                 batch_size=256, weight_decay=0.):
+    """
+    Train a linear classifier on cached (normalized) features and return its
+    top-1 accuracy on the test features.
+    """
+    num_classes = int(max(train_labels.max(), test_labels.max())) + 1
+    classifier = nn.Linear(train_features.shape[1], num_classes).to(train_features.device)
+    classifier.weight.data.normal_(mean=0.0, std=0.01)
+    classifier.bias.data.zero_()
+    optimizer = torch.optim.SGD(classifier.parameters(), lr, momentum=0.9, weight_decay=weight_decay)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs, eta_min=0)
+    for _ in range(epochs):
+        perm = torch.randperm(train_features.shape[0], device=train_features.device)
+        for idx in range(0, train_features.shape[0], batch_size):
+            batch = perm[idx: idx + batch_size]
+            loss = nn.CrossEntropyLoss()(classifier(train_features[batch]), train_labels[batch])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        scheduler.step()
+    with torch.no_grad():
+        predictions = classifier(test_features).argmax(dim=1)
+    return (predictions == test_labels).float().mean().item() * 100.0
+
+
+def evaluate_cell(args, cache_dir):
+    train_features, test_features, train_labels, test_labels = load_feature_cache(cache_dir)
+    train_features, test_features = train_features.cuda(), test_features.cuda()
+    train_labels, test_labels = train_labels.cuda(), test_labels.cuda()
+    results = {}
+    # one search for the largest k, the smaller ones vote on a prefix of the neighbors
+    distances, indices = knn_search(train_features, test_features, max(args.nb_knn))
+    for k in args.nb_knn:
+        top1, top5 = knn_vote(distances, indices, train_labels, test_labels, k, args.temperature)
+        results[f"knn{k}_top1"] = top1
+        results[f"knn{k}_top5"] = top5
+    if args.linear_epochs > 0:
+        results["linear_top1"] = linear_probe(train_features, train_labels, test_features, test_labels,
+                                              epochs=args.linear_epochs, lr=args.linear_lr,
+                                              batch_size=args.linear_batch_size)
+    return results
+
+
+def format_table(results, checkpoints, datasets, metrics):
+    header = ["checkpoint"] + [f"{dataset}/{metric}" for dataset in datasets for metric in metrics]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    for ckpt in checkpoints:
+        row = [os.path.basename(ckpt)]
+        for dataset in datasets:
+            for metric in metrics:
+                value = results[ckpt][dataset].get(metric)
+                row.append("-" if value is None else f"{value:.2f}")
+        lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines)
+
+
+def eval_matrix(args):
+    checkpoints = sorted(args.checkpoints)
+    results = {ckpt: {} for ckpt in checkpoints}
+    # hashed once, on rank 0, for all the datasets
+    digests = [checkpoint_digest(ckpt) for ckpt in checkpoints]
+    for dataset in args.datasets:
+        if dataset not in DATASETS:
+            raise NotImplementedError(f"invalid dataset: {dataset}")
+        config = get_dataset_config(args, dataset)
+        extra = f"checkpoint_key={args.checkpoint_key}"
+        cache_dirs = [os.path.join(args.output_dir, "features", feature_cache_key(digest, config, dataset, extra=extra))
+                      for digest in digests]
+        extract_dataset(args, dataset, checkpoints, cache_dirs)
+        if utils.get_rank() == 0:
+            for ckpt, cache_dir in zip(checkpoints, cache_dirs):
+                results[ckpt][dataset] = evaluate_cell(args, cache_dir)
+                print(f"{os.path.basename(ckpt)} / {dataset}: {results[ckpt][dataset]}")
+
+    if utils.is_main_process():
+        metrics = [f"knn{k}_top1" for k in args.nb_knn]
+        if args.linear_epochs > 0:
+            metrics.append("linear_top1")
+        table = format_table(results, checkpoints, args.datasets, metrics)
+        print(table)
+        with (Path(args.output_dir) / "eval_matrix.md").open("w") as f:
+            f.write(table + "\n")
+        with (Path(args.output_dir) / "eval_matrix.json").open("w") as f:
+            json.dump(results, f, indent=2)
+    dist.barrier()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Evaluate many checkpoints on many datasets with k-NN and linear probes')
+    parser.add_argument('--checkpoints', nargs='+', required=True, type=str,
+        help='Pretrained checkpoints to evaluate (e.g. a glob over checkpoint*.pth).')
+    parser.add_argument('--datasets', default=['ucf101', 'hmdb51'], nargs='+', type=str,
+        help='Datasets to evaluate on: ucf101 / hmdb51')
+    parser.add_argument('--data_root', default=f"{os.path.expanduser('~')}/repo/mmaction2/data", type=str,
+        help='Folder holding <dataset>/<split_dir> and <dataset>/videos for every dataset.')
+    parser.add_argument('--split_dir', default='knn_splits', type=str, help='Name of the split folder of each dataset.')
+    parser.add_argument("--checkpoint_key", default="teacher", type=str,
+        help='Key to use in the checkpoint (example: "teacher")')
+    parser.add_argument('--models_per_pass', default=0, type=int,
+        help='Number of backbones loaded at once per data pass (0: all of them).')
+    parser.add_argument('--batch_size_per_gpu', default=32, type=int, help='Per-GPU batch-size')
+    parser.add_argument('--num_workers', default=10, type=int, help='Number of data loading workers per GPU.')
+    parser.add_argument('--nb_knn', default=[10, 20], nargs='+', type=int, help='Number of NN to use.')
+    parser.add_argument('--temperature', default=0.07, type=float, help='Temperature used in the voting coefficient')
+    parser.add_argument('--linear_epochs', default=100, type=int,
+        help='Epochs of the linear probe on cached features (0 to skip it).')
+    parser.add_argument('--linear_lr', default=0.1, type=float, help='Learning rate of the linear probe.')
+    parser.add_argument('--linear_batch_size', default=256, type=int, help='Batch size of the linear probe.')
+    parser.add_argument('--output_dir', default=".", help='Path to save the feature caches and the result table.')
+    parser.add_argument("--dist_url", default="env://", type=str, help="""url used to set up
+        distributed training; see https://pytorch.org/docs/stable/distributed.html""")
+    parser.add_argument("--local_rank", default=0, type=int, help="Please ignore and do not set this argument.")
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    utils.init_distributed_mode(args)
+    print("git:\n  {}\n".format(utils.get_sha()))
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    cudnn.benchmark = True
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    eval_matrix(args)
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import torch
+
+from eval_knn import load_backbone
+from models import get_aux_token_vit
+from models.export import ExportableBackbone, export_onnx, export_torchscript
+from utils.parser import load_config
+
+
+def load_export_model(args, config):
+    if not args.aux_token:
+        return load_backbone(config, args.pretrained_weights, args.checkpoint_key, device="cpu")
+    model = get_aux_token_vit(cfg=config, no_head=True)
+    ckpt = torch.load(args.pretrained_weights, map_location="cpu")
+    if args.checkpoint_key in ckpt:
+        ckpt = {x.replace("module.", "", 1): y for x, y in ckpt[args.checkpoint_key].items()}
+    renamed_checkpoint = {x[len("backbone."):]: y for x, y in ckpt.items() if x.startswith("backbone.")}
+    msg = model.load_state_dict(renamed_checkpoint, strict=False)
+    print(f"Loaded model with msg: {msg}")
+    return model.eval()
+
+
+def parity_shapes(args, config):
+    """
+    Input shapes of the parity check: the export shape and variations of batch size, number of frames
+    and resolution, none of which may be frozen into the exported graph.
+    """
+    T, S, ts = config.DATA.NUM_FRAMES, config.DATA.TEST_CROP_SIZE, config.TIMESFORMER.TUBELET_SIZE
+    shapes = [(1, 3, T, S, S), (2, 3, T, S, S), (1, 3, 2 * T, S, S), (1, 3, max(ts, T // 2 // ts * ts), S, S),
+              (1, 3, T, S - 32, S + 32)]
+    return shapes + [tuple(shape) for shape in args.extra_shapes]
+
+
+@torch.no_grad()
+def check_parity(eager, run_exported, shapes, atol):
+    """
+    Max absolute difference between the eager backbone and the exported graph on random clips.
+    """
+    results = []
+    for shape in shapes:
+        x = torch.randn(shape)
+        reference = eager(x)
+        if isinstance(reference, tuple):
+            reference = torch.cat(reference, dim=1)
+        exported = torch.as_tensor(run_exported(x))
+        max_diff = (reference - exported).abs().max().item()
+        results.append({"shape": list(shape), "max_abs_diff": max_diff, "ok": max_diff <= atol})
+        print(f"parity {list(shape)}: max abs diff {max_diff:.2e} {'ok' if max_diff <= atol else 'FAILED'}")
+    return results
+
+
+def export(args):
+    config = load_config(args)
+    model = load_export_model(args, config)
+    example = torch.randn(1, 3, config.DATA.NUM_FRAMES, config.DATA.TEST_CROP_SIZE, config.DATA.TEST_CROP_SIZE)
+    shapes = parity_shapes(args, config)
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    report = {"pretrained_weights": args.pretrained_weights,
+              "num_features": ExportableBackbone(model).num_features}
+
+    # the export-friendly forward itself must match the eager one
+    report["exportable"] = check_parity(model, ExportableBackbone(model), shapes, args.atol)
+
+    if "torchscript" in args.formats:
+        path = export_torchscript(model, example, os.path.join(args.output_dir, "backbone.ts"))
+        print(f"Saved TorchScript graph to {path}")
+        traced = torch.jit.load(path)
+        report["torchscript"] = check_parity(model, traced, shapes, args.atol)
+
+    if "onnx" in args.formats:
+        path = export_onnx(model, example, os.path.join(args.output_dir, "backbone.onnx"), args.opset)
+        print(f"Saved ONNX graph to {path}")
+        try:
+            import onnxruntime
+        except ImportError:
+            print("onnxruntime is not installed, skipping the ONNX parity check.")
+        else:
+            session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            report["onnx"] = check_parity(
+                model, lambda x: session.run(None, {"video": x.numpy()})[0], shapes, args.atol)
+
+    with (Path(args.output_dir) / "export_report.json").open("w") as f:
+        json.dump(report, f, indent=2)
+    failed = [name for name, results in report.items()
+              if isinstance(results, list) and not all(r["ok"] for r in results)]
+    if failed:
+        raise RuntimeError(f"exported graphs do not match the eager model: {failed}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Export a TimeSformer backbone to TorchScript / ONNX')
+    parser.add_argument('--pretrained_weights', required=True, type=str, help="Path to pretrained weights to export.")
+    parser.add_argument("--checkpoint_key", default="teacher", type=str,
+        help='Key to use in the checkpoint (example: "teacher")')
+    parser.add_argument('--aux_token', action='store_true', help='Export the aux token backbone (get_aux_token_vit).')
+    parser.add_argument('--formats', default=["torchscript", "onnx"], nargs='+', choices=["torchscript", "onnx"],
+        help='Graph formats to export.')
+    parser.add_argument('--opset', default=14, type=int, help='ONNX opset version.')
+    parser.add_argument('--atol', default=1e-4, type=float, help='Max absolute difference of the parity check.')
+    parser.add_argument('--extra_shapes', default=[], nargs='*', type=lambda s: [int(v) for v in s.split(",")],
+        help='Additional parity check input shapes, e.g. 4,3,16,160,160.')
+    parser.add_argument('--output_dir', default=".", help='Path to save the exported graphs.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    export(args)
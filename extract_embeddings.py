@@ -0,0 +1,175 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+import torch.multiprocessing as mp
+import torch.utils.data
+from torch import nn
+
+from datasets.video_folder import VideoFolder, list_videos
+from eval_knn import load_backbone, checkpoint_digest, feature_cache_key
+from utils import utils
+from utils.parser import load_config
+
+# status of every video in status.npy
+PENDING, DONE, FAILED = 0, 1, 2
+
+
+def prepare_output(args, config, videos, dim):
+    """
+    Create the output files, or check that the existing ones were produced with the same
+    checkpoint, config and videos so that the extraction resumes where it stopped:
+      ids.txt          one video id per line, in row order
+      embeddings.npy   float16 memmap, one row per video (or per clip: row video * num_clips + clip)
+      status.npy       uint8 memmap, PENDING / DONE / FAILED for every video
+      meta.json        written last, describes the files above
+    Returns the indices of the videos left to extract.
+    """
+    out = Path(args.output_dir)
+    key = feature_cache_key(checkpoint_digest(args.pretrained_weights), config, "video_folder",
+                            f"checkpoint_key={args.checkpoint_key},num_clips={args.num_clips}")
+    num_rows = len(videos) * (args.num_clips if args.per_clip else 1)
+    meta = {"pretrained_weights": args.pretrained_weights, "key": key, "num_videos": len(videos),
+            "num_clips": args.num_clips, "per_clip": args.per_clip, "shape": [num_rows, dim], "dtype": "float16"}
+    ids = [video_id for video_id, _ in videos]
+
+    if (out / "meta.json").exists():
+        with (out / "meta.json").open("r") as f:
+            previous = json.load(f)
+        with (out / "ids.txt").open("r") as f:
+            previous_ids = f.read().splitlines()
+        assert previous == meta and previous_ids == ids, \
+            f"{out} holds embeddings of other videos or of another checkpoint / config, use another output_dir"
+        status = np.load(out / "status.npy", mmap_mode="r+")
+        if args.retry_failed:
+            status[status == FAILED] = PENDING
+            status.flush()
+        print(f"Resuming: {int((status == DONE).sum())} done, {int((status == FAILED).sum())} failed, "
+              f"{int((status == PENDING).sum())} pending.")
+    else:
+        out.mkdir(parents=True, exist_ok=True)
+        with (out / "ids.txt").open("w") as f:
+            f.write("\n".join(ids) + "\n")
+        np.lib.format.open_memmap(out / "embeddings.npy", mode="w+", dtype=np.float16, shape=(num_rows, dim))
+        status = np.lib.format.open_memmap(out / "status.npy", mode="w+", dtype=np.uint8, shape=(len(videos),))
+        # written last: its presence marks the output files as created
+        with (out / "meta.json").open("w") as f:
+            json.dump(meta, f, indent=2)
+    return np.nonzero(status == PENDING)[0].tolist()
+
+
+@torch.no_grad()
+def run_worker(worker_id, args, video_paths, pending):
+    """
+    Extract the embeddings of the pending videos worker_id, worker_id + num_workers, ... on the device of
+    the worker, writing them into the shared memmaps. Videos are marked DONE / FAILED only after their
+    embeddings have been flushed to disk, so an interrupted run resumes from a consistent state.
+    """
+    num_workers = len(args.devices) * args.procs_per_device
+    device = args.devices[worker_id % len(args.devices)]
+    if torch.device(device).type == "cuda":
+        # a bare "cuda" keeps the current device
+        if torch.device(device).index is not None:
+            torch.cuda.set_device(device)
+    elif args.threads_per_proc > 0:
+        torch.set_num_threads(args.threads_per_proc)
+    config = load_config(args)
+    model = load_backbone(config, args.pretrained_weights, args.checkpoint_key, device=device)
+    use_amp = args.fp16 and torch.device(device).type == "cuda"
+
+    dataset = VideoFolder(config, video_paths, num_clips=args.num_clips, indices=pending[worker_id::num_workers])
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=torch.device(device).type == "cuda",
+        drop_last=False,
+    )
+    out = Path(args.output_dir)
+    embeddings = np.load(out / "embeddings.npy", mmap_mode="r+")
+    status = np.load(out / "status.npy", mmap_mode="r+")
+
+    unflushed, start_time, num_done = [], time.time(), 0
+    for it, (clips, index, valid) in enumerate(data_loader):
+        B = clips.size(0)
+        # clips of all the videos of the batch go through the model together
+        with torch.cuda.amp.autocast(enabled=use_amp):
+            features = model(clips.flatten(0, 1).to(device, non_blocking=True)).float()
+        features = nn.functional.normalize(features, dim=-1).view(B, args.num_clips, -1)
+        index = index.numpy()
+        if args.per_clip:
+            rows = (index[:, None] * args.num_clips + np.arange(args.num_clips)[None]).reshape(-1)
+            embeddings[rows] = features.flatten(0, 1).cpu().numpy().astype(np.float16)
+        else:
+            embeddings[index] = nn.functional.normalize(features.mean(1), dim=-1).cpu().numpy().astype(np.float16)
+        unflushed.append((index, valid.numpy()))
+        num_done += B
+
+        if (it + 1) % args.flush_every == 0 or it + 1 == len(data_loader):
+            embeddings.flush()
+            for index, valid in unflushed:
+                status[index] = np.where(valid, DONE, FAILED)
+            status.flush()
+            unflushed = []
+            print(f"[worker {worker_id}] {num_done}/{len(dataset)} videos, "
+                  f"{num_done / (time.time() - start_time):.1f} videos/s")
+
+
+def extract_embeddings(args):
+    config = load_config(args)
+    videos = list_videos(args.input)
+    assert len(videos) > 0, f"no videos found in {args.input}"
+    print(f"{len(videos)} videos found in {args.input}")
+    # the embedding width is read from the model before any worker starts
+    dim = load_backbone(config, args.pretrained_weights, args.checkpoint_key, device="cpu").num_features
+    pending = prepare_output(args, config, videos, dim)
+    if not pending:
+        print("All embeddings are extracted.")
+        return
+    video_paths = [path for _, path in videos]
+    num_workers = len(args.devices) * args.procs_per_device
+    if num_workers == 1:
+        run_worker(0, args, video_paths, pending)
+    else:
+        mp.spawn(run_worker, args=(args, video_paths, pending), nprocs=num_workers)
+    status = np.load(Path(args.output_dir) / "status.npy", mmap_mode="r")
+    print(f"Done: {int((status == DONE).sum())} videos extracted, {int((status == FAILED).sum())} failed, "
+          f"{int((status == PENDING).sum())} pending.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Embeddings of every video of a folder or manifest')
+    parser.add_argument('--input', required=True, type=str,
+        help='Folder searched recursively for videos, or manifest with one `path` or `id<TAB>path` per line.')
+    parser.add_argument('--pretrained_weights', required=True, type=str, help="Path to pretrained weights to evaluate.")
+    parser.add_argument("--checkpoint_key", default="teacher", type=str,
+        help='Key to use in the checkpoint (example: "teacher")')
+    parser.add_argument('--output_dir', required=True, type=str,
+        help='Path to save the embeddings, an existing output of the same run is resumed.')
+    parser.add_argument('--num_clips', default=1, type=int, help='Number of clips uniformly sampled per video.')
+    parser.add_argument('--per_clip', action='store_true',
+        help='Store one embedding per clip instead of their average per video.')
+    parser.add_argument('--retry_failed', action='store_true', help='Retry the videos that failed to decode.')
+    parser.add_argument('--devices', default=['cuda'], nargs='+', type=str,
+        help='Devices to run on, e.g. "cuda:0 cuda:1" or "cpu".')
+    parser.add_argument('--procs_per_device', default=1, type=int,
+        help='Number of worker processes per device (e.g. a pool of CPU processes with --devices cpu).')
+    parser.add_argument('--threads_per_proc', default=0, type=int,
+        help='Torch threads of every CPU worker process (0: torch default).')
+    parser.add_argument('--fp16', default=True, type=utils.bool_flag,
+        help='Run the model with autocast on cuda devices.')
+    parser.add_argument('--batch_size', default=16, type=int, help='Number of videos per batch.')
+    parser.add_argument('--num_workers', default=8, type=int, help='Number of data loading workers per process.')
+    parser.add_argument('--flush_every', default=20, type=int, help='Number of batches between flushes to disk.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    cudnn.benchmark = True
+    extract_embeddings(args)
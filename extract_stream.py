@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import torch
+import torch.backends.cudnn as cudnn
+
+from datasets.stream import iter_video_frames
+from eval_knn import load_backbone
+from models.streaming import StreamingExtractor
+from utils.parser import load_config
+from utils.storage import IncrementalNpyWriter
+
+
+def extract_video(args, config, extractor, video_path):
+    """
+    Write the window features of one video to <output_dir>/<video name>_features.npy, with the index of the
+    first (decoded) frame of every window in <video name>_frames.npy, flushing them every
+    `args.flush_every` windows.
+    """
+    name = Path(video_path).stem
+    feature_path = os.path.join(args.output_dir, f"{name}_features.npy")
+    frame_path = os.path.join(args.output_dir, f"{name}_frames.npy")
+    chunks = iter_video_frames(video_path, sampling_rate=config.DATA.SAMPLING_RATE,
+                               scale=config.DATA.TRAIN_JITTER_SCALES[0], crop_size=config.DATA.TEST_CROP_SIZE,
+                               mean=config.DATA.MEAN, std=config.DATA.STD, chunk_size=args.chunk_size)
+    num_windows = 0
+    with IncrementalNpyWriter(feature_path, extractor.model.num_features) as features, \
+            IncrementalNpyWriter(frame_path, dtype="int64") as frames:
+        for start, feature in extractor(chunks):
+            features.write(feature.float().cpu().numpy())
+            frames.write([start * config.DATA.SAMPLING_RATE])
+            num_windows += 1
+            if num_windows % args.flush_every == 0:
+                features.flush()
+                frames.flush()
+    return num_windows
+
+
+def extract_stream(args):
+    config = load_config(args)
+    window = args.window if args.window > 0 else config.DATA.NUM_FRAMES
+    model = load_backbone(config, args.pretrained_weights, args.checkpoint_key, device=args.device)
+    extractor = StreamingExtractor(model, window=window, stride=args.stride, batch_size=args.batch_size)
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    with (Path(args.output_dir) / "stream_config.json").open("w") as f:
+        json.dump({"pretrained_weights": args.pretrained_weights, "window": window, "stride": args.stride,
+                   "sampling_rate": config.DATA.SAMPLING_RATE}, f, indent=2)
+
+    for video_path in args.videos:
+        start_time = time.time()
+        num_windows = extract_video(args, config, extractor, video_path)
+        print(f"{video_path}: {num_windows} windows in {time.time() - start_time:.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Sliding-window features of long videos')
+    parser.add_argument('--videos', nargs='+', required=True, type=str, help='Videos to extract features from.')
+    parser.add_argument('--pretrained_weights', required=True, type=str, help="Path to pretrained weights to evaluate.")
+    parser.add_argument("--checkpoint_key", default="teacher", type=str,
+        help='Key to use in the checkpoint (example: "teacher")')
+    parser.add_argument('--window', default=0, type=int,
+        help='Number of (sampled) frames per window, DATA.NUM_FRAMES if 0.')
+    parser.add_argument('--stride', default=4, type=int, help='Number of (sampled) frames between windows.')
+    parser.add_argument('--batch_size', default=8, type=int, help='Number of windows run through the model at once.')
+    parser.add_argument('--chunk_size', default=32, type=int, help='Number of frames decoded at once.')
+    parser.add_argument('--flush_every', default=64, type=int, help='Number of windows between flushes to disk.')
+    parser.add_argument('--device', default="cuda", type=str, help='Device to run the model on.')
+    parser.add_argument('--output_dir', default=".", help='Path to save the features.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    cudnn.benchmark = True
+    extract_stream(args)
@@ -1,6 +1,7 @@
 import argparse
 import json
 import os
+import time
 import torch
 import torch.backends.cudnn as cudnn
 from pathlib import Path
@@ -8,7 +9,10 @@ from torch import nn
 from tqdm import tqdm
 
 from datasets import UCF101, HMDB51, Kinetics
+from eval_knn import checkpoint_digest, feature_cache_key
 from models import get_vit_base_patch16_224, get_aux_token_vit, SwinTransformer3D
+from models.early_exit import EarlyExitHeads, early_exit_predict
+from models.pruning import apply_pruning_spec
 from utils import utils
 from utils.meters import TestMeter
 from utils.parser import load_config
@@ -27,6 +31,9 @@ def eval_linear(args):
     # config.DATA.PATH_TO_DATA_DIR = f"{os.path.expanduser('~')}/repo/mmaction2/data/{args.dataset}/splits"
     # config.DATA.PATH_PREFIX = f"{os.path.expanduser('~')}/repo/mmaction2/data/{args.dataset}/videos"
     config.TEST.NUM_SPATIAL_CROPS = 1
+    if args.freeze_blocks > 0 and (config.DATA.USE_FLOW or config.MODEL.TWO_TOKEN or args.arch != "vit_base"):
+        # forward_partial runs the blocks of a TimeSformer (prepare_tokens / forward_blocks)
+        raise NotImplementedError("--freeze_blocks is only supported with the vit_base TimeSformer")
     if args.dataset == "ucf101":
         dataset_train = UCF101(cfg=config, mode="train", num_retries=10)
         dataset_val = UCF101(cfg=config, mode="val", num_retries=10)
@@ -53,6 +60,8 @@ def eval_linear(args):
         num_workers=args.num_workers,
         pin_memory=True,
     )
+    # the model is not wrapped in DDP, every rank trains its own copy: rank 0 validates its copy on the full
+    # val set (see validate_network)
     val_loader = torch.utils.data.DataLoader(
         dataset_val,
         batch_size=args.batch_size_per_gpu,
@@ -89,13 +98,20 @@ def eval_linear(args):
         else:
             raise Exception(f"invalid model: {args.arch}")
 
-    ckpt = torch.load(args.pretrained_weights)
-    #  select_ckpt = 'motion_teacher' if args.use_flow else "teacher"
-    if "teacher" in ckpt:
-        ckpt = ckpt["teacher"]
-    renamed_checkpoint = {x[len("backbone."):]: y for x, y in ckpt.items() if x.startswith("backbone.")}
-    msg = model.load_state_dict(renamed_checkpoint, strict=False)
-    print(f"Loaded model with msg: {msg}")
+    if args.pruned_checkpoint:
+        # recovery fine-tuning of a prune_timesformer.py model: shrink the blocks, then load the pruned weights
+        ckpt = torch.load(args.pruned_checkpoint, map_location="cpu")
+        apply_pruning_spec(model, ckpt["pruning"])
+        msg = model.load_state_dict(ckpt["state_dict"], strict=False)
+        print(f"Loaded pruned model with msg: {msg}")
+    else:
+        ckpt = torch.load(args.pretrained_weights)
+        #  select_ckpt = 'motion_teacher' if args.use_flow else "teacher"
+        if "teacher" in ckpt:
+            ckpt = ckpt["teacher"]
+        renamed_checkpoint = {x[len("backbone."):]: y for x, y in ckpt.items() if x.startswith("backbone.")}
+        msg = model.load_state_dict(renamed_checkpoint, strict=False)
+        print(f"Loaded model with msg: {msg}")
     model.cuda()
     # model.eval()
     print(f"Model {args.arch} {args.patch_size}x{args.patch_size} built.")
@@ -125,8 +141,28 @@ def eval_linear(args):
     #     weight_decay=0, # we do not apply weight decay
     # )
     
+    if args.freeze_blocks > 0:
+        freeze_prefix(model, args.freeze_blocks)
+        print(f"Froze the patch embedding and the first {args.freeze_blocks} blocks, "
+              f"{sum(p.numel() for p in model.parameters() if p.requires_grad)} trainable parameters left.")
+    cache = None
+    if args.activation_cache and args.freeze_blocks > 0:
+        # activations depend on the weights, the data pipeline (config, dataset) and the code producing them
+        weights = args.pruned_checkpoint or args.pretrained_weights
+        extra = f"freeze_blocks={args.freeze_blocks},cache_augs={args.cache_augs},{utils.get_sha()}"
+        key = feature_cache_key(checkpoint_digest(weights), config, f"{args.dataset}/train", extra=extra)
+        meta = {"weights": weights, "dataset": args.dataset, "freeze_blocks": args.freeze_blocks,
+                "cache_augs": args.cache_augs, "key": key}
+        cache = ActivationCache(os.path.join(args.activation_cache, key), args.cache_augs, meta=meta)
+        print(f"Caching the activations of the frozen blocks in {cache.root}")
+    exits = None
+    if args.early_exit_blocks:
+        assert args.freeze_blocks == 0, "early exit heads are trained with full fine-tuning"
+        exits = EarlyExitHeads(model.embed_dim, args.num_labels, args.early_exit_blocks).cuda()
+        print(f"Early exit heads after blocks {exits.exit_blocks}.")
+
     optimizer = torch.optim.SGD(
-        model.parameters(),
+        [p for p in model.parameters() if p.requires_grad] + (list(exits.parameters()) if exits else []),
         args.lr * (args.batch_size_per_gpu * utils.get_world_size()) / 256., # linear scaling rule
         momentum=0.9,
         weight_decay=0.0001, # we apply weight decay for finetuning
@@ -144,19 +180,24 @@ def eval_linear(args):
         state_dict=model,         ### chpt에서 linear classifier의 state_dict 불러 옴
         optimizer=optimizer,
         scheduler=scheduler,
+        exits=exits,
     )
     start_epoch = to_restore["epoch"]
     best_acc = to_restore["best_acc"]
 
+    epoch_stats = []
     for epoch in range(start_epoch, args.epochs):
         train_loader.sampler.set_epoch(epoch)
 
-        train_stats = train(model, optimizer, train_loader, epoch, args.n_last_blocks, args.avgpool_patchtokens)
+        train_stats = train(model, optimizer, train_loader, epoch, args.n_last_blocks, args.avgpool_patchtokens,
+                            freeze_blocks=args.freeze_blocks, cache=cache, exits=exits,
+                            exit_weight=args.early_exit_weight)
+        epoch_stats.append(train_stats)
         scheduler.step()
 
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                      'epoch': epoch}
-        if epoch % args.val_freq == 0 or epoch == args.epochs - 1:
+        if (epoch % args.val_freq == 0 or epoch == args.epochs - 1) and utils.is_main_process():
             test_stats = validate_network(val_loader, model, args.n_last_blocks, args.avgpool_patchtokens)
             print(f"Accuracy at epoch {epoch} of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
             best_acc = max(best_acc, test_stats["acc1"])
@@ -173,11 +214,36 @@ def eval_linear(args):
                 "scheduler": scheduler.state_dict(),
                 "best_acc": best_acc,
             }
+            if exits is not None:
+                save_dict["exits"] = exits.state_dict()
             torch.save(save_dict, os.path.join(args.output_dir, "checkpoint.pth.tar"))
 
-    test_stats = validate_network_multi_view(multi_crop_val_loader, model, args.n_last_blocks,
-                                             args.avgpool_patchtokens, config)
-    print(test_stats)
+    test_stats = {}
+    if utils.is_main_process():
+        test_stats = validate_network_multi_view(multi_crop_val_loader, model, args.n_last_blocks,
+                                                 args.avgpool_patchtokens, config)
+        print(test_stats)
+
+    # memory / throughput / accuracy of this freeze depth, aggregated over the epochs run here
+    if utils.is_main_process() and epoch_stats:
+        report = {
+            "freeze_blocks": args.freeze_blocks,
+            "activation_cache": bool(cache),
+            "peak_mem_mb": max(stats["peak_mem_mb"] for stats in epoch_stats),
+            "clips_per_sec": sum(stats["clips_per_sec"] for stats in epoch_stats) / len(epoch_stats),
+            "best_acc": best_acc,
+            "multi_view_top1": test_stats.get("top1_acc"),
+        }
+        print(f"Partial fine-tuning report: {report}")
+        with (Path(args.output_dir) / "partial_ft_report.json").open("w") as f:
+            json.dump(report, f, indent=4)
+
+    # average blocks executed vs accuracy of every exit threshold
+    if exits is not None and utils.is_main_process():
+        exit_stats = validate_early_exit(val_loader, model, exits, args.exit_thresholds)
+        with (Path(args.output_dir) / "early_exit_report.json").open("w") as f:
+            json.dump({"exit_blocks": exits.exit_blocks, "depth": len(model.blocks), "thresholds": exit_stats},
+                      f, indent=4)
 
     print("Training of the supervised linear classifier on frozen features completed.\n"
           "Top-1 test accuracy: {acc:.1f}".format(acc=best_acc))
@@ -225,15 +291,92 @@ def eval_linear(args):
 #     print("Averaged stats:", metric_logger)
 #     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
-def train(model, optimizer, loader, epoch, n, avgpool):
+def freeze_prefix(model, freeze_blocks):
+    """
+    Freeze the patch embedding, the CLS / positional / time embeddings and the
+    first `freeze_blocks` blocks of a TimeSformer.
+    """
+    frozen = [model.patch_embed] + list(model.blocks[:freeze_blocks])
+    for module in frozen:
+        for p in module.parameters():
+            p.requires_grad = False
+    for name in ["cls_token", "pos_embed", "time_embed"]:
+        if hasattr(model, name):
+            getattr(model, name).requires_grad = False
+    return frozen
+
+
+class ActivationCache(object):
+    """
+    Disk cache of the frozen-prefix outputs, one fp16 file per clip and
+    augmentation slot. Epoch e reads / writes slot e % num_augs, so every clip
+    is run through the frozen blocks num_augs times over the whole training.
+    """
+    def __init__(self, root, num_augs=1, meta=None):
+        self.root = root
+        self.num_augs = num_augs
+        os.makedirs(root, exist_ok=True)
+        meta_path = os.path.join(root, "meta.json")
+        if utils.is_main_process() and meta is not None and not os.path.isfile(meta_path):
+            with open(meta_path, "w") as f:
+                json.dump(meta, f, indent=2)
+        if utils.is_dist_avail_and_initialized():
+            torch.distributed.barrier()
+        if meta is not None:
+            with open(meta_path, "r") as f:
+                assert json.load(f) == meta, f"{root} holds activations of another run, use another --activation_cache"
+
+    def _path(self, idx, aug):
+        return os.path.join(self.root, f"{idx}_{aug}.pth")
+
+    def load(self, sample_idx, epoch):
+        aug = epoch % self.num_augs
+        paths = [self._path(int(idx), aug) for idx in sample_idx]
+        if not all(os.path.isfile(path) for path in paths):
+            return None
+        return torch.stack([torch.load(path, map_location="cpu") for path in paths])
+
+    def save(self, x, sample_idx, epoch):
+        aug = epoch % self.num_augs
+        x = x.half().cpu()
+        for idx, activation in zip(sample_idx, x):
+            torch.save(activation.clone(), self._path(int(idx), aug))
+
+
+def forward_partial(model, inp, freeze_blocks, cache=None, sample_idx=None, epoch=0):
+    """
+    Forward pass where the frozen prefix (patch embedding + first
+    `freeze_blocks` blocks) runs without autograd, or is read from `cache`.
+    """
+    x = cache.load(sample_idx, epoch) if cache is not None else None
+    if x is None:
+        with torch.no_grad():
+            x, B, T, W = model.prepare_tokens(inp.cuda(non_blocking=True))
+            x = model.forward_blocks(x, B, T, W, end=freeze_blocks)
+        if cache is not None:
+            cache.save(x, sample_idx, epoch)
+    else:
+        x = x.cuda(non_blocking=True).float()
+    B, W = inp.shape[0], inp.shape[-1] // model.patch_embed.patch_size[1]
+    T = inp.shape[2] // model.patch_embed.tubelet_size
+    x = model.forward_blocks(x, B, T, W, start=freeze_blocks)
+    return model.forward_norm(x, B, T)
+
+
+def train(model, optimizer, loader, epoch, n, avgpool, freeze_blocks=0, cache=None, exits=None, exit_weight=1.0):
     model.train()
+    if freeze_blocks > 0:
+        # frozen blocks behave as in inference (no stochastic depth), which also keeps cached outputs valid
+        for module in [model.patch_embed] + list(model.blocks[:freeze_blocks]):
+            module.eval()
     # linear_classifier.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
+    torch.cuda.reset_peak_memory_stats()
+    num_clips, start_time = 0, time.time()
     for (inp, target, sample_idx, meta) in metric_logger.log_every(loader, 20, header):
         # move to gpu
-        inp = inp.cuda(non_blocking=True)
         target = target.cuda(non_blocking=True)
 
         # forward
@@ -244,12 +387,22 @@ def train(model, optimizer, loader, epoch, n, avgpool):
         #     #     output.append(torch.mean(intermediate_output[-1][:, 1:], dim=1))
         #     # output = torch.cat(output, dim=-1)
 
-        output = model(inp)
+        exit_logits = []
+        if freeze_blocks > 0:
+            output = forward_partial(model, inp, freeze_blocks, cache=cache, sample_idx=sample_idx, epoch=epoch)
+        elif exits is not None:
+            exit_logits, output = exits(model, inp.cuda(non_blocking=True))
+        else:
+            output = model(inp.cuda(non_blocking=True))
 
         # output = linear_classifier(output)
 
         # compute cross entropy loss
         loss = nn.CrossEntropyLoss()(output, target)
+        if exit_logits:
+            loss_exits = sum(nn.CrossEntropyLoss()(logits, target) for logits in exit_logits) / len(exit_logits)
+            loss = loss + exit_weight * loss_exits
+            metric_logger.update(loss_exits=loss_exits.item())
 
         # compute the gradients
         optimizer.zero_grad()
@@ -260,52 +413,17 @@ def train(model, optimizer, loader, epoch, n, avgpool):
 
         # log
         torch.cuda.synchronize()
+        num_clips += inp.shape[0]
         metric_logger.update(loss=loss.item())
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
-
-
-# @torch.no_grad()
-# def validate_network(val_loader, model, linear_classifier, n, avgpool):
-#     linear_classifier.eval()
-#     metric_logger = utils.MetricLogger(delimiter="  ")
-#     header = 'Test:'
-#     for (inp, target, sample_idx, meta) in metric_logger.log_every(val_loader, 20, header):
-#         # move to gpu
-#         inp = inp.cuda(non_blocking=True)
-#         target = target.cuda(non_blocking=True)
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats["peak_mem_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+    stats["clips_per_sec"] = num_clips / (time.time() - start_time)
+    return stats
 
-#         # forward
-#         with torch.no_grad():
-#             # intermediate_output = model.get_intermediate_layers(inp, n)
-#             # output = [x[:, 0] for x in intermediate_output]
-#             # if avgpool:
-#             #     output.append(torch.mean(intermediate_output[-1][:, 1:], dim=1))
-#             # output = torch.cat(output, dim=-1)
-#             output = model(inp)
-#         output = linear_classifier(output)
-#         loss = nn.CrossEntropyLoss()(output, target)
-
-#         if linear_classifier.module.num_labels >= 5:
-#             acc1, acc5 = utils.accuracy(output, target, topk=(1, 5))
-#         else:
-#             acc1, = utils.accuracy(output, target, topk=(1,))
-
-#         batch_size = inp.shape[0]
-#         metric_logger.update(loss=loss.item())
-#         metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-#         if linear_classifier.module.num_labels >= 5:
-#             metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
-#     if linear_classifier.module.num_labels >= 5:
-#         print('* Acc@1 {top1.global_avg:.3f} Acc@5 {top5.global_avg:.3f} loss {losses.global_avg:.3f}'
-#               .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
-#     else:
-#         print('* Acc@1 {top1.global_avg:.3f} loss {losses.global_avg:.3f}'
-#               .format(top1=metric_logger.acc1, losses=metric_logger.loss))
-#     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 @torch.no_grad()
 def validate_network(val_loader, model, n, avgpool):
@@ -338,10 +456,11 @@ def validate_network(val_loader, model, n, avgpool):
         
 
         batch_size = inp.shape[0]
-        metric_logger.update(loss=loss.item())
+        metric_logger.meters['loss'].update(loss.item(), n=batch_size)
         metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
         # if linear_classifier.module.num_labels >= 5:
             # metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+    # no reduction across ranks: the ranks train different copies of the model, only rank 0 validates its own
     # if linear_classifier.module.num_labels >= 5:
         # print('* Acc@1 {top1.global_avg:.3f} Acc@5 {top5.global_avg:.3f} loss {losses.global_avg:.3f}'
         #       .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
@@ -351,6 +470,31 @@ def validate_network(val_loader, model, n, avgpool):
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+@torch.no_grad()
+def validate_early_exit(val_loader, model, exits, thresholds):
+    """
+    Top-1 accuracy and average number of blocks executed per clip with early exits, for every threshold.
+    """
+    model.eval()
+    exits.eval()
+    stats = []
+    for threshold in thresholds:
+        metric_logger = utils.MetricLogger(delimiter="  ")
+        header = 'Early exit {:.2f}:'.format(threshold)
+        for (inp, target, sample_idx, meta) in metric_logger.log_every(val_loader, 20, header):
+            inp = inp.cuda(non_blocking=True)
+            target = target.cuda(non_blocking=True)
+            predictions, blocks_run = early_exit_predict(model, exits, inp, threshold)
+            batch_size = inp.shape[0]
+            metric_logger.meters['acc1'].update(100. * (predictions == target).float().mean().item(), n=batch_size)
+            metric_logger.meters['blocks'].update(blocks_run.float().mean().item(), n=batch_size)
+        print('* threshold {:.2f} Acc@1 {top1.global_avg:.3f} blocks {blocks.global_avg:.2f}/{depth}'
+              .format(threshold, top1=metric_logger.acc1, blocks=metric_logger.blocks, depth=len(model.blocks)))
+        stats.append({"threshold": threshold, "acc1": metric_logger.acc1.global_avg,
+                      "avg_blocks": metric_logger.blocks.global_avg})
+    return stats
+
+
 @torch.no_grad()
 def validate_network_multi_view(val_loader, model, n, avgpool, cfg):
     # linear_classifier.eval()
@@ -389,7 +533,7 @@ def validate_network_multi_view(val_loader, model, n, avgpool, cfg):
 
         test_meter.iter_tic()
 
-    test_meter.finalize_metrics()
+    test_meter.finalize_metrics(synchronize=False)
     return test_meter.stats
 
 
@@ -440,6 +584,19 @@ if __name__ == '__main__':
     parser.add_argument('--num_labels', default=1000, type=int, help='Number of labels for linear classifier')
     parser.add_argument('--dataset', default="ucf101", help='Dataset: ucf101 / hmdb51')
     parser.add_argument('--use_flow', default=False, type=utils.bool_flag, help="use flow teacher")
+    parser.add_argument('--freeze_blocks', default=0, type=int, help="""Freeze the patch embedding and the
+        first K blocks and run them without autograd; only the remaining blocks are fine-tuned (0: full fine-tuning).""")
+    parser.add_argument('--activation_cache', default='', type=str,
+                        help="Directory to cache the outputs of the frozen blocks per clip (fp16, on disk).")
+    parser.add_argument('--cache_augs', default=1, type=int,
+                        help="Number of cached augmentations per clip; epoch e uses slot e %% cache_augs.")
+    parser.add_argument('--pruned_checkpoint', default='', type=str,
+                        help="prune_timesformer.py checkpoint to fine-tune instead of --pretrained_weights.")
+    parser.add_argument('--early_exit_blocks', default=[], type=int, nargs='*',
+                        help="Train early exit classifiers on the CLS token after these numbers of blocks (e.g. 4 6 8 10).")
+    parser.add_argument('--early_exit_weight', default=1.0, type=float, help="Weight of the early exit losses.")
+    parser.add_argument('--exit_thresholds', default=[0.5, 0.7, 0.8, 0.9, 0.95, 0.99], type=float, nargs='+',
+                        help="Confidence thresholds of the early exit evaluation.")
 
     # config file
     parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
@@ -1,3 +1,3 @@
-from .timesformer import get_vit_base_patch16_224, get_aux_token_vit
+from .timesformer import get_vit_base_patch16_224, get_aux_token_vit, get_distill_student
 from .swin_transformer import SwinTransformer3D
 from .s3d import S3D
@@ -0,0 +1,73 @@
+"""
+CPU inference of the TimeSformer backbones (VisionTransformer / AuxTokenVisionTransformer).
+
+Modes:
+    fp32: the eager model.
+    int8: dynamic int8 quantization of the linears of the attention blocks (qkv, proj, temporal_fc and
+          MLP), weights quantized once and activations quantized on the fly; patch embedding, norms and
+          the optional head stay in fp32.
+    bf16: bfloat16 autocast, for CPUs with native bf16 support (AVX512-BF16 / AMX).
+"""
+
+import os
+
+import torch
+import torch.nn as nn
+
+CPU_MODES = ("fp32", "int8", "bf16")
+
+
+def configure_threads(num_threads=0, num_interop_threads=1):
+    """
+    Intra-op threads of this process (0: one per physical core as seen by torch) and inter-op
+    threads. A single inter-op thread avoids oversubscription, the blocks run sequentially anyway.
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+        os.environ.setdefault("OMP_NUM_THREADS", str(num_threads))
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work started
+        pass
+    return torch.get_num_threads()
+
+
+def quantize_block_linears(model):
+    """
+    Dynamic int8 quantization of the nn.Linear layers inside model.blocks.
+    """
+    names = {name for name, module in model.named_modules()
+             if isinstance(module, nn.Linear) and name.startswith("blocks.")}
+    return torch.quantization.quantize_dynamic(model, qconfig_spec=names, dtype=torch.qint8)
+
+
+class CPUInferenceModel(nn.Module):
+    """
+    Inference wrapper running `model` on CPU in one of CPU_MODES. Outputs are fp32, like the eager model.
+    """
+    def __init__(self, model, mode="int8"):
+        super(CPUInferenceModel, self).__init__()
+        assert mode in CPU_MODES, "unknown CPU inference mode {}".format(mode)
+        model = model.cpu().eval()
+        self.mode = mode
+        self.model = quantize_block_linears(model) if mode == "int8" else model
+        self.num_features = self.embed_dim = model.num_features
+
+    @torch.no_grad()
+    def forward(self, x, **kwargs):
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=self.mode == "bf16"):
+            out = self.model(x.float(), **kwargs)
+        if isinstance(out, tuple):
+            return tuple(o.float() for o in out)
+        return out.float()
+
+
+@torch.no_grad()
+def feature_drift(reference, features):
+    """
+    Cosine similarity between the rows of fp32 `reference` features and the same rows computed in
+    another mode: mean and minimum over the rows.
+    """
+    similarity = nn.functional.cosine_similarity(reference.float(), features.float(), dim=1)
+    return {"cosine_mean": similarity.mean().item(), "cosine_min": similarity.min().item()}
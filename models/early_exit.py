@@ -0,0 +1,66 @@
+"""
+Confidence-based early exit for fine-tuned TimeSformer classifiers (VisionTransformer).
+
+Lightweight classifiers (LayerNorm + Linear) read the CLS token after some intermediate blocks. At
+inference, a clip leaves the network at the first exit whose softmax confidence reaches the threshold,
+and the remaining blocks only run on the clips that have not exited yet.
+"""
+
+import torch
+import torch.nn as nn
+
+
+class EarlyExitHeads(nn.Module):
+    """
+    Classifiers on the CLS token after blocks `exit_blocks` (number of blocks run, e.g. [4, 6, 8, 10]).
+    """
+    def __init__(self, embed_dim, num_labels, exit_blocks):
+        super(EarlyExitHeads, self).__init__()
+        self.exit_blocks = sorted(exit_blocks)
+        self.heads = nn.ModuleList([
+            nn.Sequential(nn.LayerNorm(embed_dim, eps=1e-6), nn.Linear(embed_dim, num_labels))
+            for _ in self.exit_blocks
+        ])
+        for head in self.heads:
+            nn.init.normal_(head[1].weight, std=0.01)
+            nn.init.zeros_(head[1].bias)
+
+    def forward(self, model, inp):
+        """
+        Training forward: logits of every exit and of the full model (as model(inp)).
+        """
+        x, B, T, W = model.prepare_tokens(inp)
+        exit_logits, start = [], 0
+        for end, head in zip(self.exit_blocks, self.heads):
+            x = model.forward_blocks(x, B, T, W, start=start, end=end)
+            exit_logits.append(head(x[:, 0]))
+            start = end
+        x = model.forward_blocks(x, B, T, W, start=start)
+        return exit_logits, model.forward_norm(x, B, T)
+
+
+@torch.no_grad()
+def early_exit_predict(model, exits, inp, threshold):
+    """
+    Predictions of `model` with early exits at confidence `threshold`, and the number of blocks run per
+    clip. Clips that exit are removed from the batch before the next blocks.
+    """
+    assert model.attention_type != 'space_only', "early exit removes clips from a b x (1 + h w t) x m batch"
+    x, B, T, W = model.prepare_tokens(inp)
+    predictions = torch.zeros(B, dtype=torch.long, device=x.device)
+    blocks_run = torch.full((B,), len(model.blocks), dtype=torch.long, device=x.device)
+    active = torch.arange(B, device=x.device)
+    start = 0
+    for end, head in zip(exits.exit_blocks, exits.heads):
+        x = model.forward_blocks(x, active.numel(), T, W, start=start, end=end)
+        start = end
+        confidence, prediction = head(x[:, 0]).softmax(dim=-1).max(dim=-1)
+        done = confidence >= threshold
+        predictions[active[done]] = prediction[done]
+        blocks_run[active[done]] = end
+        x, active = x[~done], active[~done]
+        if active.numel() == 0:
+            return predictions, blocks_run
+    x = model.forward_blocks(x, active.numel(), T, W, start=start)
+    predictions[active] = model.forward_norm(x, active.numel(), T).argmax(dim=-1)
+    return predictions, blocks_run
@@ -0,0 +1,126 @@
+"""
+Export-friendly forward of the divided space-time TimeSformer backbones
+(get_vit_base_patch16_224 / get_aux_token_vit) for TorchScript tracing and ONNX export.
+
+The eager forward resizes the positional and time embeddings only when the input does not match them, and
+rearranges tokens with einops patterns bound to python ints; both get frozen into a traced graph. Here the
+embeddings are always interpolated to the size of the input (an identity when the sizes already match) and
+all layout changes are reshape / permute / expand on traced sizes, so the exported graph keeps the batch
+size, the number of frames and the resolution dynamic.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def divided_block_forward(blk, x, B, T):
+    """
+    Forward of a divided space-time Block on b x (1 + n t [+ 1]) x m tokens, equivalent to Block.forward.
+    """
+    C = x.size(2)
+    num_aux = blk.class_tokens - 1
+    N = (x.size(1) - blk.class_tokens) // T
+    cls_token, patches = x[:, :1], x[:, 1:1 + N * T]
+
+    # Temporal
+    res_temporal = blk.temporal_attn(blk.temporal_norm1(patches.reshape(B * N, T, C)))
+    patches = patches + blk.temporal_fc(res_temporal.reshape(B, N * T, C))
+
+    # Spatial
+    xs = [cls_token.expand(B, T, C).reshape(B * T, 1, C),
+          patches.reshape(B, N, T, C).permute(0, 2, 1, 3).reshape(B * T, N, C)]
+    if num_aux:
+        aux_cls_token = x[:, -1:]
+        xs.append(aux_cls_token.expand(B, T, C).reshape(B * T, 1, C))
+    res_spatial = blk.attn(blk.norm1(torch.cat(xs, dim=1)))
+    # averaging the CLS tokens for every frame
+    tokens = [cls_token + res_spatial[:, 0].reshape(B, T, C).mean(1, keepdim=True),
+              patches + res_spatial[:, 1:1 + N].reshape(B, T, N, C).permute(0, 2, 1, 3).reshape(B, N * T, C)]
+    if num_aux:
+        tokens.append(aux_cls_token + res_spatial[:, -1].reshape(B, T, C).mean(1, keepdim=True))
+    x = torch.cat(tokens, dim=1)
+
+    # Mlp
+    return x + blk.mlp(blk.norm2(x))
+
+
+class ExportableBackbone(nn.Module):
+    """
+    Eval-mode backbone with the export-friendly forward above. Returns the normalized CLS features
+    (concatenated with the aux CLS features for AuxTokenVisionTransformer), like the eager backbone.
+    """
+    def __init__(self, model):
+        super(ExportableBackbone, self).__init__()
+        assert model.attention_type == 'divided_space_time', "only divided space-time attention can be exported"
+        assert all(blk.temporal_window <= 0 for blk in model.blocks), \
+            "windowed temporal attention branches on the number of frames and can not be exported"
+        self.model = model.eval()
+        self.n_cls_tokens = getattr(model, "n_cls_tokens", 1)
+        self.num_features = model.num_features * self.n_cls_tokens
+
+    def embed(self, x):
+        model = self.model
+        B, C_in = x.size(0), x.size(1)
+        patch_embed = model.patch_embed
+        if patch_embed.tubelet_size == 1:
+            x = x.permute(0, 2, 1, 3, 4).reshape(-1, C_in, x.size(3), x.size(4))
+            x = patch_embed.proj(x)
+        else:
+            x = patch_embed.proj(x)
+            x = x.permute(0, 2, 1, 3, 4).reshape(-1, x.size(1), x.size(3), x.size(4))
+        H, W = x.size(2), x.size(3)
+        T = x.size(0) // B
+        x = x.flatten(2).transpose(1, 2)  # (b t) x (h w) x m
+        C = x.size(2)
+
+        # positional embeddings, always interpolated to the h x w grid of the input
+        pos_embed = model.pos_embed
+        P = int(round((pos_embed.size(1) - self.n_cls_tokens) ** 0.5))
+        patch_pos_embed = pos_embed[:, 1:1 + P * P].transpose(1, 2).reshape(1, C, P, P)
+        patch_pos_embed = F.interpolate(patch_pos_embed, size=(H, W), mode='nearest')
+        x = x + patch_pos_embed.flatten(2).transpose(1, 2)
+
+        # time embeddings, always interpolated to the number of frames of the input
+        time_embed = model.time_embed.transpose(1, 2)
+        if model.time_embed_interp == 'nearest':
+            time_embed = F.interpolate(time_embed, size=T, mode='nearest')
+        else:
+            time_embed = F.interpolate(time_embed, size=T, mode=model.time_embed_interp, align_corners=False)
+        x = x.reshape(B, T, H * W, C) + time_embed.transpose(1, 2).unsqueeze(2)
+        x = x.permute(0, 2, 1, 3).reshape(B, H * W * T, C)  # (h w t) layout
+
+        tokens = [(model.cls_token + pos_embed[:, :1]).expand(B, 1, C), x]
+        if self.n_cls_tokens == 2:
+            tokens.append((model.aux_cls_token + pos_embed[:, -1:]).expand(B, 1, C))
+        return torch.cat(tokens, dim=1), B, T
+
+    def forward(self, x):
+        x, B, T = self.embed(x)
+        for blk in self.model.blocks:
+            x = divided_block_forward(blk, x, B, T)
+        x = self.model.norm(x)
+        if self.n_cls_tokens == 2:
+            return torch.cat((x[:, 0], x[:, -1]), dim=1)
+        return x[:, 0]
+
+
+def export_torchscript(model, example, path):
+    exportable = ExportableBackbone(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(exportable, example, check_trace=False)
+    traced.save(path)
+    return path
+
+
+def export_onnx(model, example, path, opset_version=14):
+    exportable = ExportableBackbone(model)
+    with torch.no_grad():
+        torch.onnx.export(
+            exportable, example, path,
+            input_names=["video"],
+            output_names=["features"],
+            dynamic_axes={"video": {0: "batch", 2: "frames", 3: "height", 4: "width"}, "features": {0: "batch"}},
+            opset_version=opset_version,
+        )
+    return path
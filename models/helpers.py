@@ -94,7 +94,8 @@ def resume_checkpoint(model, checkpoint_path, optimizer=None, loss_scaler=None,
 
 
 def load_pretrained(model, cfg=None, num_classes=1000, in_chans=3, filter_fn=None, img_size=224, num_frames=8,
-                    num_patches=196, attention_type='divided_space_time', pretrained_model="", strict=True):
+                    num_patches=196, attention_type='divided_space_time', pretrained_model="", strict=True,
+                    tubelet_size=1, time_embed_interp='nearest'):
     if cfg is None:
         cfg = getattr(model, 'default_cfg')
     if cfg is None or 'url' not in cfg or not cfg['url']:
@@ -172,10 +173,18 @@ def load_pretrained(model, cfg=None, num_classes=1000, in_chans=3, filter_fn=Non
         new_pos_embed = torch.cat((cls_pos_embed, new_pos_embed), 1)
         state_dict['pos_embed'] = new_pos_embed
 
+    ## Inflating 2D patch embedding weights to tubelets, averaged over the tubelet frames
+    patch_weight = state_dict.get('patch_embed.proj.weight')
+    if tubelet_size > 1 and patch_weight is not None and patch_weight.dim() == 4:
+        state_dict['patch_embed.proj.weight'] = patch_weight.unsqueeze(2).repeat(1, 1, tubelet_size, 1, 1) / tubelet_size
+
     ## Resizing time embeddings in case they don't match
     if 'time_embed' in state_dict and num_frames != state_dict['time_embed'].size(1):
         time_embed = state_dict['time_embed'].transpose(1, 2)
-        new_time_embed = F.interpolate(time_embed, size=(num_frames), mode='nearest')
+        if time_embed_interp == 'nearest':
+            new_time_embed = F.interpolate(time_embed, size=(num_frames), mode='nearest')
+        else:
+            new_time_embed = F.interpolate(time_embed, size=(num_frames), mode=time_embed_interp, align_corners=False)
         state_dict['time_embed'] = new_time_embed.transpose(1, 2)
 
     ## Initializing temporal attention
@@ -0,0 +1,186 @@
+"""
+Structured pruning of the TimeSformer blocks (models/timesformer.py): heads of `attn` and `temporal_attn`
+and hidden units of `mlp` are scored on calibration clips and physically removed, so that the pruned
+Attention / Mlp modules run smaller matmuls.
+
+Importance of a head / hidden unit, from the input a of `proj` (heads) or `fc2` (hidden units):
+    activation: mean |a| (l2 norm over the head dims for heads), times the norm of its output weights.
+    gradient: first-order Taylor estimate |sum a * dL/da| of the loss change when removing it.
+"""
+
+import torch
+import torch.nn as nn
+
+from models.timesformer import Attention, Mlp
+
+IMPORTANCE_MODES = ("activation", "gradient")
+
+
+def _prunable(model):
+    """
+    (name, module, output linear) of the prunable modules of every block.
+    """
+    for i, blk in enumerate(model.blocks):
+        yield f"blocks.{i}.attn", blk.attn, blk.attn.proj
+        if hasattr(blk, "temporal_attn"):
+            yield f"blocks.{i}.temporal_attn", blk.temporal_attn, blk.temporal_attn.proj
+        yield f"blocks.{i}.mlp", blk.mlp, blk.mlp.fc2
+
+
+def _num_groups(module):
+    return module.num_heads if isinstance(module, Attention) else module.fc1.out_features
+
+
+class ImportanceRecorder(object):
+    """
+    Accumulates the importance of every head / hidden unit over the forward (and backward) passes run
+    while recording, through hooks on the inputs of the output linears.
+    """
+
+    def __init__(self, model, mode="activation"):
+        assert mode in IMPORTANCE_MODES, "unknown importance mode {}".format(mode)
+        self.mode = mode
+        self.scores = {}
+        self.handles = []
+        for name, module, out_linear in _prunable(model):
+            self.scores[name] = torch.zeros(_num_groups(module), device=out_linear.weight.device)
+            self.handles.append(out_linear.register_forward_hook(self._hook(name, module, out_linear)))
+
+    def _group(self, x, module):
+        # ... x (heads x head_dim) -> (tokens, heads, head_dim); ... x hidden -> (tokens, hidden, 1)
+        if isinstance(module, Attention):
+            return x.reshape(-1, module.num_heads, module.head_dim)
+        return x.reshape(-1, x.size(-1), 1)
+
+    def _hook(self, name, module, out_linear):
+        def hook(_, inputs, output):
+            a = inputs[0]
+            if self.mode == "activation":
+                with torch.no_grad():
+                    groups = self._group(a.float(), module)
+                    weight_norm = self._group(out_linear.weight.float(), module).norm(dim=(0, 2))
+                    self.scores[name] += groups.norm(dim=2).mean(0) * weight_norm
+            elif a.requires_grad:
+                def grad_hook(grad):
+                    with torch.no_grad():
+                        taylor = self._group((a * grad).float(), module).sum(dim=(0, 2))
+                        self.scores[name] += taylor.abs()
+                a.register_hook(grad_hook)
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def compute_importance(model, loader, num_batches=32, mode="activation", device="cuda"):
+    """
+    Importance of the heads / hidden units of `model` over `num_batches` batches of (clips, labels, ...)
+    of `loader`. The gradient mode needs a classifier (model.head) and the labels.
+    """
+    if mode == "gradient":
+        assert getattr(model, "head", None) is not None and not isinstance(model.head, nn.Identity), \
+            "gradient importance needs a fine-tuned classifier head"
+    recorder = ImportanceRecorder(model, mode)
+    model.eval()
+    try:
+        for it, (inp, target, *_) in enumerate(loader):
+            if it == num_batches:
+                break
+            inp = inp.to(device, non_blocking=True)
+            if mode == "activation":
+                with torch.no_grad():
+                    model(inp)
+            else:
+                loss = nn.CrossEntropyLoss()(model(inp), target.to(device, non_blocking=True))
+                loss.backward()
+                model.zero_grad(set_to_none=True)
+    finally:
+        recorder.remove()
+    return recorder.scores
+
+
+def select_kept(scores, prune_ratio, multiple=1, min_keep=1):
+    """
+    Sorted indices of the most important groups, keeping (1 - prune_ratio) of them rounded up to a
+    multiple of `multiple` (e.g. GEMM-friendly hidden sizes).
+    """
+    n = scores.numel()
+    num_keep = max(min_keep, n - int(round(prune_ratio * n)))
+    num_keep = min(n, -(-num_keep // multiple) * multiple)
+    return torch.sort(torch.topk(scores, num_keep).indices).values
+
+
+@torch.no_grad()
+def prune_attention(attn, kept):
+    """
+    Attention with only the `kept` heads of `attn`. The other heads are removed from qkv and proj, the
+    scale is unchanged.
+    """
+    kept = torch.as_tensor(kept, dtype=torch.long, device=attn.qkv.weight.device)
+    dim, H, hd = attn.qkv.in_features, attn.num_heads, attn.head_dim
+    new = Attention(dim, num_heads=len(kept), qkv_bias=attn.qkv.bias is not None, qk_scale=attn.scale,
+                    attn_drop=attn.attn_drop.p, proj_drop=attn.proj_drop.p, head_dim=hd)
+    new.to(attn.qkv.weight.device, attn.qkv.weight.dtype)
+    new.qkv.weight.copy_(attn.qkv.weight.view(3, H, hd, dim)[:, kept].reshape(-1, dim))
+    if attn.qkv.bias is not None:
+        new.qkv.bias.copy_(attn.qkv.bias.view(3, H, hd)[:, kept].reshape(-1))
+    new.proj.weight.copy_(attn.proj.weight.view(dim, H, hd)[:, kept].reshape(dim, -1))
+    new.proj.bias.copy_(attn.proj.bias)
+    return new
+
+
+@torch.no_grad()
+def prune_mlp(mlp, kept):
+    """
+    Mlp with only the `kept` hidden units of `mlp`.
+    """
+    kept = torch.as_tensor(kept, dtype=torch.long, device=mlp.fc1.weight.device)
+    new = Mlp(in_features=mlp.fc1.in_features, hidden_features=len(kept), out_features=mlp.fc2.out_features,
+              act_layer=type(mlp.act), drop=mlp.drop.p)
+    new.to(mlp.fc1.weight.device, mlp.fc1.weight.dtype)
+    new.fc1.weight.copy_(mlp.fc1.weight[kept])
+    new.fc1.bias.copy_(mlp.fc1.bias[kept])
+    new.fc2.weight.copy_(mlp.fc2.weight[:, kept])
+    new.fc2.bias.copy_(mlp.fc2.bias)
+    return new
+
+
+def _replace(model, name, module):
+    parent, attr = name.rsplit(".", 1)
+    setattr(model.get_submodule(parent), attr, module)
+
+
+def prune_model(model, scores, head_prune_ratio=0.25, mlp_prune_ratio=0.25, mlp_multiple=64):
+    """
+    Remove the least important heads and hidden units of every block in place, with the same ratios in
+    every block. Returns the pruning spec of the model (see pruning_spec).
+    """
+    for name, module, _ in list(_prunable(model)):
+        if isinstance(module, Attention):
+            _replace(model, name, prune_attention(module, select_kept(scores[name], head_prune_ratio)))
+        else:
+            _replace(model, name, prune_mlp(module, select_kept(scores[name], mlp_prune_ratio, mlp_multiple)))
+    return pruning_spec(model)
+
+
+def pruning_spec(model):
+    """
+    Number of heads / hidden units left in every prunable module, stored with pruned checkpoints.
+    """
+    return {name: _num_groups(module) for name, module, _ in _prunable(model)}
+
+
+def apply_pruning_spec(model, spec):
+    """
+    Shrink the modules of a freshly built model to `spec`, so that a pruned state dict can be loaded into it.
+    """
+    for name, module, _ in list(_prunable(model)):
+        if spec[name] == _num_groups(module):
+            continue
+        if isinstance(module, Attention):
+            _replace(model, name, prune_attention(module, range(spec[name])))
+        else:
+            _replace(model, name, prune_mlp(module, range(spec[name])))
+    return model
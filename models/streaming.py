@@ -0,0 +1,76 @@
+"""
+Sliding-window features of long videos with the divided space-time VisionTransformer.
+
+Windows of consecutive frames overlap, but the per-frame patch embeddings (patch projection, CLS token and
+positional embeddings) do not depend on the window, so every frame is embedded once and the cached tokens
+are shared by all windows covering it. Time embeddings and attention blocks depend on the position of a
+frame inside its window and are run per window.
+"""
+
+import torch
+
+
+class StreamingExtractor(object):
+    """
+    Features of the windows of `window` frames starting every `stride` frames of a stream of frame chunks
+    (c x t x h x w tensors, e.g. datasets.stream.iter_video_frames), as a generator of
+    (first frame index, feature) pairs. Windows are run through the blocks `batch_size` at a time, and only
+    the cached tokens of the windows not computed yet are kept, so memory does not grow with the video.
+    If the last frames are not covered by a window, a final window ending at the last frame is added.
+    """
+    def __init__(self, model, window=8, stride=4, batch_size=8):
+        self.model = model
+        self.tubelet_size = model.patch_embed.tubelet_size
+        assert window % self.tubelet_size == 0 and stride % self.tubelet_size == 0, \
+            "window and stride must be multiples of the tubelet size {}".format(self.tubelet_size)
+        # window, stride and token offsets are counted in time steps (tubelets) below
+        self.window = window // self.tubelet_size
+        self.stride = stride // self.tubelet_size
+        self.batch_size = batch_size
+
+    def _run_windows(self, tokens, offset, starts, W):
+        B, T = len(starts), self.window
+        x = torch.stack([tokens[start - offset: start - offset + T] for start in starts])
+        x = self.model.add_time_embed(x.flatten(0, 1), B, T)
+        x = self.model.forward_blocks(x, B, T, W)
+        features = self.model.forward_norm(x, B, T)
+        for start, feature in zip(starts, features):
+            yield start * self.tubelet_size, feature
+
+    @torch.no_grad()
+    def __call__(self, chunks):
+        device = next(self.model.parameters()).device
+        tokens, offset, W = None, 0, None
+        next_start, last_end, pending = 0, 0, []
+        leftover = None
+        for frames in chunks:
+            if leftover is not None:
+                frames = torch.cat((leftover, frames), dim=1)
+            usable = frames.size(1) // self.tubelet_size * self.tubelet_size
+            frames, leftover = frames[:, :usable], frames[:, usable:]
+            if usable == 0:
+                continue
+            x, _, W = self.model.embed_patches(frames.unsqueeze(0).to(device, non_blocking=True))
+            tokens = x if tokens is None else torch.cat((tokens, x), dim=0)
+            num_steps = offset + tokens.size(0)
+
+            while next_start + self.window <= num_steps:
+                pending.append(next_start)
+                last_end = next_start + self.window
+                next_start += self.stride
+                if len(pending) == self.batch_size:
+                    yield from self._run_windows(tokens, offset, pending, W)
+                    pending = []
+
+            # keep the tokens of the pending windows and of a possible final window
+            keep_from = max(0, min(pending[0] if pending else next_start, num_steps - self.window))
+            tokens = tokens[keep_from - offset:]
+            offset = keep_from
+
+        if tokens is None:
+            return
+        num_steps = offset + tokens.size(0)
+        if last_end < num_steps and num_steps >= self.window:
+            pending.append(num_steps - self.window)
+        if pending:
+            yield from self._run_windows(tokens, offset, pending, W)
@@ -3,7 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 import numpy as np
-from timm.models.layers import DropPath, trunc_normal_
+from timm.models.layers import trunc_normal_
+
+from models.vit_utils import DropPath, drop_path_residual
 
 # from mmcv.runner import load_checkpoint
 # from mmaction.utils import get_root_logger
@@ -135,6 +137,53 @@ class WindowAttention3D(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        # materialized nH x N x N biases, per number of window tokens N
+        self._bias_cache = {}
+
+    def train(self, mode=True):
+        self.clear_bias_cache()
+        return super().train(mode)
+
+    def clear_bias_cache(self):
+        """
+        Drop the cached biases. Needed after writes to the table that bypass its version counter, e.g. the
+        EMA teacher update through `.data`.
+        """
+        self._bias_cache = {}
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_bias_cache()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def __getstate__(self):
+        # cached biases may be non-leaf tensors, which can not be deep-copied or pickled
+        state = self.__dict__.copy()
+        state["_bias_cache"] = {}
+        return state
+
+    def relative_position_bias(self, N):
+        """
+        nH x N x N relative position bias of windows of N tokens. It is gathered from the table once and
+        reused until the table changes (e.g. an optimizer step or a checkpoint load); in-place writes through
+        `.data` are not tracked and must be followed by clear_bias_cache. When it is part of the autograd
+        graph, it is reused only until the backward pass runs through it, i.e. within one step.
+        """
+        table = self.relative_position_bias_table
+        requires_grad = torch.is_grad_enabled() and table.requires_grad
+        key = (table._version, table.data_ptr(), table.device, table.dtype, requires_grad)
+        cached = self._bias_cache.get(N)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        bias = table[self.relative_position_index[:N, :N].reshape(-1)].reshape(N, N, -1)  # Wd*Wh*Ww,Wd*Wh*Ww,nH
+        bias = bias.permute(2, 0, 1).contiguous()  # nH, Wd*Wh*Ww, Wd*Wh*Ww
+        if requires_grad:
+            def drop_cached_bias(grad):
+                # the graph of this bias is freed by the backward pass, the next step gathers it again
+                self._bias_cache.pop(N, None)
+                return None
+            bias.register_hook(drop_cached_bias)
+        self._bias_cache[N] = (key, bias)
+        return bias
 
     def forward(self, x, mask=None):
         """ Forward function.
@@ -149,11 +198,7 @@ class WindowAttention3D(nn.Module):
         q = q * self.scale
         attn = q @ k.transpose(-2, -1)
 
-        relative_position_bias = self.relative_position_bias_table[
-            self.relative_position_index[:N, :N].reshape(-1)].reshape(
-            N, N, -1)  # Wd*Wh*Ww,Wd*Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wd*Wh*Ww, Wd*Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)  # B_, nH, N, N
+        attn = attn + self.relative_position_bias(N).unsqueeze(0)  # B_, nH, N, N
 
         if mask is not None:
             nW = mask.shape[0]
@@ -187,11 +232,13 @@ class SwinTransformerBlock3D(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        drop_path_skip_compute (bool, optional): Only run the residual branches on the samples kept
+            by stochastic depth. Default: False
     """
 
     def __init__(self, dim, num_heads, window_size=(2, 7, 7), shift_size=(0, 0, 0),
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
-                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, use_checkpoint=False):
+                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, use_checkpoint=False, drop_path_skip_compute=False):
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
@@ -209,7 +256,7 @@ class SwinTransformerBlock3D(nn.Module):
             dim, window_size=self.window_size, num_heads=num_heads,
             qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
 
-        self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        self.drop_path = DropPath(drop_path, skip_compute=drop_path_skip_compute) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
@@ -219,39 +266,22 @@ class SwinTransformerBlock3D(nn.Module):
         window_size, shift_size = get_window_size((D, H, W), self.window_size, self.shift_size)
 
         x = self.norm1(x)
-        # pad feature maps to multiples of window size
-        pad_l = pad_t = pad_d0 = 0
-        pad_d1 = (window_size[0] - D % window_size[0]) % window_size[0]
-        pad_b = (window_size[1] - H % window_size[1]) % window_size[1]
-        pad_r = (window_size[2] - W % window_size[2]) % window_size[2]
-        x = F.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
-        _, Dp, Hp, Wp, _ = x.shape
-        # cyclic shift
-        if any(i > 0 for i in shift_size):
-            shifted_x = torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
-            attn_mask = mask_matrix
-        else:
-            shifted_x = x
-            attn_mask = None
-        # partition windows
-        x_windows = window_partition(shifted_x, window_size)  # B*nW, Wd*Wh*Ww, C
+        # padding, cyclic shift and window partition in one gather of the flattened tokens
+        index, inverse_index, padded = window_gather_index(D, H, W, window_size, shift_size, x.device)
+        x = x.reshape(B, D * H * W, C)
+        if padded:
+            # the padding positions of the index read an appended zero token
+            x = F.pad(x, (0, 0, 0, 1))
+        x_windows = x[:, index].view(-1, reduce(mul, window_size), C)  # B*nW, Wd*Wh*Ww, C
         # W-MSA/SW-MSA
+        attn_mask = mask_matrix if any(i > 0 for i in shift_size) else None
         attn_windows = self.attn(x_windows, mask=attn_mask)  # B*nW, Wd*Wh*Ww, C
-        # merge windows
-        attn_windows = attn_windows.view(-1, *(window_size + (C,)))
-        shifted_x = window_reverse(attn_windows, window_size, B, Dp, Hp, Wp)  # B D' H' W' C
-        # reverse cyclic shift
-        if any(i > 0 for i in shift_size):
-            x = torch.roll(shifted_x, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
-        else:
-            x = shifted_x
-
-        if pad_d1 > 0 or pad_r > 0 or pad_b > 0:
-            x = x[:, :D, :H, :W, :].contiguous()
-        return x
+        # merge windows, reverse cyclic shift and remove the padding in one gather
+        x = attn_windows.view(B, -1, C)[:, inverse_index]
+        return x.view(B, D, H, W, C)
 
     def forward_part2(self, x):
-        return self.drop_path(self.mlp(self.norm2(x)))
+        return self.mlp(self.norm2(x))
 
     def forward(self, x, mask_matrix):
         """ Forward function.
@@ -261,17 +291,18 @@ class SwinTransformerBlock3D(nn.Module):
             mask_matrix: Attention mask for cyclic shift.
         """
 
-        shortcut = x
-        if self.use_checkpoint:
-            x = checkpoint.checkpoint(self.forward_part1, x, mask_matrix)
-        else:
-            x = self.forward_part1(x, mask_matrix)
-        x = shortcut + self.drop_path(x)
+        def part1(y):
+            if self.use_checkpoint:
+                return checkpoint.checkpoint(self.forward_part1, y, mask_matrix)
+            return self.forward_part1(y, mask_matrix)
 
-        if self.use_checkpoint:
-            x = x + checkpoint.checkpoint(self.forward_part2, x)
-        else:
-            x = x + self.forward_part2(x)
+        def part2(y):
+            if self.use_checkpoint:
+                return checkpoint.checkpoint(self.forward_part2, y)
+            return self.forward_part2(y)
+
+        x = x + drop_path_residual(self.drop_path, part1, x)
+        x = x + drop_path_residual(self.drop_path, part2, x)
 
         return x
 
@@ -315,8 +346,32 @@ class PatchMerging(nn.Module):
         return x
 
 
-# cache each stage results
-@lru_cache()
+@lru_cache(maxsize=32)
+def window_gather_index(D, H, W, window_size, shift_size, device):
+    """
+    Gather indices replacing pad + torch.roll + window_partition (and their reverse) of D x H x W tokens:
+        index (nW*Wd*Wh*Ww): flat token of every window position, D*H*W for the padding positions.
+        inverse_index (D*H*W): window position of every token.
+        padded (bool): whether the volume is padded to multiples of the window size.
+    """
+    Dp = int(np.ceil(D / window_size[0])) * window_size[0]
+    Hp = int(np.ceil(H / window_size[1])) * window_size[1]
+    Wp = int(np.ceil(W / window_size[2])) * window_size[2]
+    # torch.roll by -shift: position p of the shifted volume holds position (p + shift) % size
+    d = (torch.arange(Dp) + shift_size[0]) % Dp
+    h = (torch.arange(Hp) + shift_size[1]) % Hp
+    w = (torch.arange(Wp) + shift_size[2]) % Wp
+    d, h, w = torch.meshgrid(d, h, w)
+    flat = (d * H + h) * W + w
+    flat = flat.masked_fill((d >= D) | (h >= H) | (w >= W), D * H * W)
+    index = window_partition(flat[None, ..., None], window_size).reshape(-1)
+    inverse_index = torch.empty(D * H * W + 1, dtype=torch.long)
+    inverse_index[index] = torch.arange(index.numel())
+    return index.to(device), inverse_index[:D * H * W].to(device), (Dp, Hp, Wp) != (D, H, W)
+
+
+# cache each stage results, bounded as the devices and input sizes seen can grow
+@lru_cache(maxsize=32)
 def compute_mask(D, H, W, window_size, shift_size, device):
     img_mask = torch.zeros((1, D, H, W, 1), device=device)  # 1 Dp Hp Wp 1
     cnt = 0
@@ -348,6 +403,7 @@ class BasicLayer(nn.Module):
         drop_path (float | tuple[float], optional): Stochastic depth rate. Default: 0.0
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
+        drop_path_skip_compute (bool, optional): See SwinTransformerBlock3D. Default: False
     """
 
     def __init__(self,
@@ -363,7 +419,8 @@ class BasicLayer(nn.Module):
                  drop_path=0.,
                  norm_layer=nn.LayerNorm,
                  downsample=None,
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 drop_path_skip_compute=False):
         super().__init__()
         self.window_size = window_size
         self.shift_size = tuple(i // 2 for i in window_size)
@@ -385,6 +442,7 @@ class BasicLayer(nn.Module):
                 drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
                 norm_layer=norm_layer,
                 use_checkpoint=use_checkpoint,
+                drop_path_skip_compute=drop_path_skip_compute,
             )
             for i in range(depth)])
 
@@ -482,6 +540,8 @@ class SwinTransformer3D(nn.Module):
         patch_norm (bool): If True, add normalization after patch embedding. Default: False.
         frozen_stages (int): Stages to be frozen (stop grad and set eval mode).
             -1 means not freezing any parameters.
+        drop_path_skip_compute (bool): Only run the residual branches on the samples kept by
+            stochastic depth. Default: False.
     """
 
     def __init__(self,
@@ -502,7 +562,8 @@ class SwinTransformer3D(nn.Module):
                  norm_layer=nn.LayerNorm,
                  patch_norm=False,
                  frozen_stages=-1,
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 drop_path_skip_compute=False):
         super().__init__()
 
         self.pretrained = pretrained
@@ -540,7 +601,8 @@ class SwinTransformer3D(nn.Module):
                 drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])],
                 norm_layer=norm_layer,
                 downsample=PatchMerging if i_layer < self.num_layers - 1 else None,
-                use_checkpoint=use_checkpoint)
+                use_checkpoint=use_checkpoint,
+                drop_path_skip_compute=drop_path_skip_compute)
             self.layers.append(layer)
 
         self.num_features = int(embed_dim * 2 ** (self.num_layers - 1))
@@ -681,7 +743,45 @@ class SwinTransformer3D(nn.Module):
 
         return x[:, :, 0, 0, 0]
 
+    def clear_bias_cache(self):
+        """Drop the cached relative position biases of every block (see WindowAttention3D.clear_bias_cache)."""
+        for m in self.modules():
+            if isinstance(m, WindowAttention3D):
+                m.clear_bias_cache()
+
     def train(self, mode=True):
         """Convert the model into training mode while keep layers freezed."""
         super(SwinTransformer3D, self).train(mode)
         self._freeze_stages()
+
+
+if __name__ == '__main__':
+    # one training step and one eval forward through the cached biases and the shifted window gathers
+    model = SwinTransformer3D(embed_dim=48, depths=[2, 2], num_heads=[3, 6], window_size=(2, 7, 7))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    sample = torch.randn(2, 3, 8, 112, 112)
+    for _ in range(2):
+        loss = model(sample).pow(2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    assert model.layers[0].blocks[0].attn.relative_position_bias_table.grad is not None
+    model.eval()
+    with torch.no_grad():
+        out1, out2 = model(sample), model(sample)
+    assert torch.equal(out1, out2)
+
+    # EMA-style update through .data, which does not bump the version counter of the tables
+    attn = model.layers[0].blocks[0].attn
+    N = attn.relative_position_index.size(0)
+    with torch.no_grad():
+        bias_before = attn.relative_position_bias(N).clone()
+        for p in model.parameters():
+            p.data.mul_(0.5).add_(0.5 * torch.randn_like(p))
+        model.clear_bias_cache()
+        out3 = model(sample)
+        assert not torch.equal(attn.relative_position_bias(N), bias_before), "stale relative position bias"
+        assert torch.equal(attn.relative_position_bias(N), attn.relative_position_bias_table[
+            attn.relative_position_index.reshape(-1)].reshape(N, N, -1).permute(2, 0, 1))
+    assert not torch.equal(out1, out3)
+    print(out1.shape, loss.item())
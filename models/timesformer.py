@@ -10,7 +10,7 @@ import torch.nn.functional as F
 from einops import rearrange
 
 from models.helpers import load_pretrained
-from models.vit_utils import DropPath, to_2tuple, trunc_normal_
+from models.vit_utils import DropPath, drop_path_residual, to_2tuple, trunc_normal_
 from models.vit_utils import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 
 
@@ -53,22 +53,24 @@ class Mlp(nn.Module):
 
 
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., with_qkv=True):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., with_qkv=True,
+                 head_dim=None):
         super().__init__()
         self.num_heads = num_heads
-        head_dim = dim // num_heads
-        self.scale = qk_scale or head_dim ** -0.5
+        # head_dim is only set for attentions with pruned heads (num_heads * head_dim < dim)
+        self.head_dim = head_dim or dim // num_heads
+        self.scale = qk_scale or self.head_dim ** -0.5
         self.with_qkv = with_qkv
         if self.with_qkv:
-            self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
-            self.proj = nn.Linear(dim, dim)
+            self.qkv = nn.Linear(dim, num_heads * self.head_dim * 3, bias=qkv_bias)
+            self.proj = nn.Linear(num_heads * self.head_dim, dim)
             self.proj_drop = nn.Dropout(proj_drop)
         self.attn_drop = nn.Dropout(attn_drop)
 
     def forward(self, x, return_attn=False):
         B, N, C = x.shape
         if self.with_qkv:
-            qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+            qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
             q, k, v = qkv[0], qkv[1], qkv[2]
         else:
             qkv = x.reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
@@ -78,7 +80,7 @@ class Attention(nn.Module):
         attn = attn.softmax(dim=-1)
         attn = self.attn_drop(attn)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
         if self.with_qkv:
             x = self.proj(x)
             x = self.proj_drop(x)
@@ -90,10 +92,14 @@ class Attention(nn.Module):
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0.1, act_layer=nn.GELU, norm_layer=nn.LayerNorm, attention_type='divided_space_time'):
+                 drop_path=0.1, act_layer=nn.GELU, norm_layer=nn.LayerNorm, attention_type='divided_space_time',
+                 drop_path_skip_compute=False, layout_stable=False, temporal_window=0, temporal_dilated=False):
         super().__init__()
         self.attention_type = attention_type
         self.class_tokens = 1
+        self.layout_stable = layout_stable
+        self.temporal_window = temporal_window
+        self.temporal_dilated = temporal_dilated
         assert (attention_type in ['divided_space_time', 'space_only', 'joint_space_time'])
 
         self.norm1 = norm_layer(dim)
@@ -108,19 +114,49 @@ class Block(nn.Module):
             self.temporal_fc = nn.Linear(dim, dim)
 
         # drop path
-        self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        self.drop_path = DropPath(drop_path, skip_compute=drop_path_skip_compute) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
+    # residual branches, each acting independently on the rows of its input (see drop_path_residual)
+    def _attn_branch(self, x):
+        return self.attn(self.norm1(x))
+
+    def _temporal_branch(self, x):
+        return self._windowed_temporal_attn(self.temporal_norm1(x))
+
+    def _windowed_temporal_attn(self, x):
+        """
+        Temporal attention over (b h w) x t x m sequences. With a temporal window w < t, frames only
+        attend within groups of w consecutive frames, or, for dilated blocks, within the t / w frames
+        sharing the same position in their window, so that alternating blocks mix all frames at
+        O(t w + t^2 / w) cost instead of O(t^2).
+        """
+        BN, T, C = x.shape
+        w = self.temporal_window
+        if w <= 0 or T <= w or T % w != 0:
+            # e.g. frames reduced by token merging: attend over all of them
+            return self.temporal_attn(x)
+        if self.temporal_dilated:
+            x = x.view(BN, T // w, w, C).transpose(1, 2).reshape(BN * w, T // w, C)
+            x = self.temporal_attn(x)
+            return x.view(BN, w, T // w, C).transpose(1, 2).reshape(BN, T, C)
+        return self.temporal_attn(x.reshape(BN * (T // w), w, C)).view(BN, T, C)
+
+    def _mlp_branch(self, x):
+        return self.mlp(self.norm2(x))
+
     def forward(self, x, B, T, W, return_attn=False):
         num_spatial_tokens = (x.size(1) - self.class_tokens) // T
         H = num_spatial_tokens // W
 
         if self.attention_type in ['space_only', 'joint_space_time']:
-            x = x + self.drop_path(self.attn(self.norm1(x)))
-            x = x + self.drop_path(self.mlp(self.norm2(x)))
+            x = x + drop_path_residual(self.drop_path, self._attn_branch, x)
+            x = x + drop_path_residual(self.drop_path, self._mlp_branch, x)
             return x
+        elif self.layout_stable:
+            return self._forward_divided_stable(x, B, T, return_attn=return_attn)
         elif self.attention_type == 'divided_space_time':
             # Temporal
             if self.class_tokens == 1:
@@ -128,7 +164,7 @@ class Block(nn.Module):
             else:
                 xt = x[:, 1:-1, :]
             xt = rearrange(xt, 'b (h w t) m -> (b h w) t m', b=B, h=H, w=W, t=T)
-            res_temporal = self.drop_path(self.temporal_attn(self.temporal_norm1(xt)))
+            res_temporal = drop_path_residual(self.drop_path, self._temporal_branch, xt)
             res_temporal = rearrange(res_temporal, '(b h w) t m -> b (h w t) m', b=B, h=H, w=W, t=T)
             res_temporal = self.temporal_fc(res_temporal)
             if self.class_tokens == 1:
@@ -156,7 +192,7 @@ class Block(nn.Module):
                 _, attn = self.attn(self.norm1(xs), return_attn=return_attn)
                 return attn
             else:
-                res_spatial = self.drop_path(self.attn(self.norm1(xs)))
+                res_spatial = drop_path_residual(self.drop_path, self._attn_branch, xs)
 
             # Taking care of CLS token
             cls_token = res_spatial[:, 0, :]
@@ -181,15 +217,62 @@ class Block(nn.Module):
                 x = torch.cat((init_cls_token, x), 1) + torch.cat((cls_token, res), 1)
             else:
                 x = torch.cat((init_cls_token, x, init_aux_cls_token), 1) + torch.cat((cls_token, res, aux_cls_token), 1)
-            x = x + self.drop_path(self.mlp(self.norm2(x)))
+            x = x + drop_path_residual(self.drop_path, self._mlp_branch, x)
             return x
 
+    def _forward_divided_stable(self, x, B, T, return_attn=False):
+        """
+        Divided space-time attention without the rearrange / cat / repeat copies of forward.
+        The (h w t) token layout makes the temporal sequences a free view once normalized, and the
+        spatial sequences (CLS token, patches of one frame[, aux CLS token]) are written once into a
+        (b t) buffer, with the CLS tokens broadcast into place. Numerically equivalent to forward.
+        """
+        C = x.size(-1)
+        L = x.size(1) - self.class_tokens + 1  # end of the patch tokens
+        N = (L - 1) // T
+
+        # Temporal
+        xt = x[:, 1:L]
+        res_temporal = drop_path_residual(self.drop_path, self._windowed_temporal_attn,
+                                          self.temporal_norm1(xt).view(B * N, T, C))
+        res_temporal = self.temporal_fc(res_temporal.view(B, N * T, C))
+
+        # Spatial
+        xs = x.new_empty(B, T, self.class_tokens + N, C)
+        xs[:, :, 0] = x[:, :1]
+        if self.class_tokens != 1:
+            xs[:, :, -1] = x[:, -1:]
+        xs_patches = xs[:, :, 1:N + 1]
+        xs_patches.copy_(xt.view(B, N, T, C).transpose(1, 2))
+        xs_patches += res_temporal.view(B, N, T, C).transpose(1, 2)
+        xs = xs.view(B * T, self.class_tokens + N, C)
+        if return_attn:
+            _, attn = self.attn(self.norm1(xs), return_attn=return_attn)
+            return attn
+        res_spatial = drop_path_residual(self.drop_path, self._attn_branch, xs).view(B, T, -1, C)
+
+        # Taking care of CLS tokens (averaging for every frame) and going back to the (h w t) layout
+        out = torch.empty_like(x)
+        out[:, 0] = x[:, 0] + res_spatial[:, :, 0].mean(1)
+        if self.class_tokens != 1:
+            out[:, -1] = x[:, -1] + res_spatial[:, :, -1].mean(1)
+        out_patches = out[:, 1:L].view(B, N, T, C)
+        out_patches.copy_(xs_patches.transpose(1, 2))
+        out_patches += res_spatial[:, :, 1:N + 1].transpose(1, 2)
+
+        # Mlp
+        x = out
+        x = x + drop_path_residual(self.drop_path, self._mlp_branch, x)
+        return x
+
 
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
+    With tubelet_size > 1, every token embeds tubelet_size consecutive frames (3D conv with
+    temporal stride tubelet_size) and the returned T is the reduced temporal length.
     """
 
-    def __init__(self, img_size=224, patch_size=16, in_chans=3, embed_dim=768):
+    def __init__(self, img_size=224, patch_size=16, in_chans=3, embed_dim=768, tubelet_size=1):
         super().__init__()
         img_size = to_2tuple(img_size)
         patch_size = to_2tuple(patch_size)
@@ -197,13 +280,24 @@ class PatchEmbed(nn.Module):
         self.img_size = img_size
         self.patch_size = patch_size
         self.num_patches = num_patches
+        self.tubelet_size = tubelet_size
 
-        self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
+        if tubelet_size == 1:
+            self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
+        else:
+            self.proj = nn.Conv3d(in_chans, embed_dim, kernel_size=(tubelet_size,) + patch_size,
+                                  stride=(tubelet_size,) + patch_size)
 
     def forward(self, x):
         B, C, T, H, W = x.shape
-        x = rearrange(x, 'b c t h w -> (b t) c h w')
-        x = self.proj(x)
+        if self.tubelet_size == 1:
+            x = rearrange(x, 'b c t h w -> (b t) c h w')
+            x = self.proj(x)
+        else:
+            assert T % self.tubelet_size == 0, f"{T} frames are not divisible by tubelet size {self.tubelet_size}"
+            x = self.proj(x)
+            T = x.size(2)
+            x = rearrange(x, 'b m t h w -> (b t) m h w')
         W = x.size(-1)
         x = x.flatten(2).transpose(1, 2)
         return x, T, W
@@ -215,15 +309,18 @@ class VisionTransformer(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0.1, hybrid_backbone=None, norm_layer=nn.LayerNorm, num_frames=8,
-                 attention_type='divided_space_time', dropout=0.):
+                 attention_type='divided_space_time', dropout=0., drop_path_skip_compute=False, tubelet_size=1,
+                 layout_stable_block=False, temporal_window=0, time_embed_interp='nearest'):
         super().__init__()
         self.attention_type = attention_type
         self.depth = depth
         self.dropout = nn.Dropout(dropout)
         self.num_classes = num_classes
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
+        self.time_embed_interp = time_embed_interp
         self.patch_embed = PatchEmbed(
-            img_size=img_size, patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim)
+            img_size=img_size, patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim,
+            tubelet_size=tubelet_size)
         num_patches = self.patch_embed.num_patches
 
         # Positional Embeddings
@@ -231,7 +328,7 @@ class VisionTransformer(nn.Module):
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
         self.pos_drop = nn.Dropout(p=drop_rate)
         if self.attention_type != 'space_only':
-            self.time_embed = nn.Parameter(torch.zeros(1, num_frames, embed_dim))
+            self.time_embed = nn.Parameter(torch.zeros(1, num_frames // tubelet_size, embed_dim))
             self.time_drop = nn.Dropout(p=drop_rate)
 
         # Attention Blocks
@@ -240,7 +337,8 @@ class VisionTransformer(nn.Module):
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
-                attention_type=self.attention_type)
+                attention_type=self.attention_type, drop_path_skip_compute=drop_path_skip_compute,
+                layout_stable=layout_stable_block, temporal_window=temporal_window, temporal_dilated=i % 2 == 1)
             for i in range(self.depth)])
         self.norm = norm_layer(embed_dim)
 
@@ -282,8 +380,34 @@ class VisionTransformer(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
-    def forward_features(self, x, get_all=False, get_attn=False):
+    def _resize_time_embed(self, T):
+        """
+        Time embeddings interpolated to T frames when the clip length differs from the training one.
+        """
+        if T == self.time_embed.size(1):
+            return self.time_embed
+        time_embed = self.time_embed.transpose(1, 2)
+        if self.time_embed_interp == 'nearest':
+            new_time_embed = F.interpolate(time_embed, size=(T), mode='nearest')
+        else:
+            new_time_embed = F.interpolate(time_embed, size=(T), mode=self.time_embed_interp, align_corners=False)
+        return new_time_embed.transpose(1, 2)
+
+    def prepare_tokens(self, x):
+        """
+        Patch embedding, CLS token, positional and time embeddings.
+        Returns the token sequence b x (1 + h w t) x m along with B, T, W.
+        """
         B = x.shape[0]
+        x, T, W = self.embed_patches(x)
+        x = self.add_time_embed(x, B, T)
+        return x, B, T, W
+
+    def embed_patches(self, x):
+        """
+        Patch embedding, CLS token and positional embeddings of every frame independently.
+        Returns the per-frame tokens (b t) x (1 + h w) x m along with T and W.
+        """
         x, T, W = self.patch_embed(x)
         cls_tokens = self.cls_token.expand(x.size(0), -1, -1)
         x = torch.cat((cls_tokens, x), dim=1)
@@ -304,36 +428,46 @@ class VisionTransformer(nn.Module):
         else:
             x = x + self.pos_embed
         x = self.pos_drop(x)
+        return x, T, W
 
-        # Time Embeddings
+    def add_time_embed(self, x, B, T):
+        """
+        Time embeddings of the per-frame tokens of embed_patches, laid out as b x (1 + h w t) x m.
+        """
         if self.attention_type != 'space_only':
             cls_tokens = x[:B, 0, :].unsqueeze(1)
             x = x[:, 1:]
             x = rearrange(x, '(b t) n m -> (b n) t m', b=B, t=T)
             # Resizing time embeddings in case they don't match
-            if T != self.time_embed.size(1):
-                time_embed = self.time_embed.transpose(1, 2)
-                new_time_embed = F.interpolate(time_embed, size=(T), mode='nearest')
-                new_time_embed = new_time_embed.transpose(1, 2)
-                x = x + new_time_embed
-            else:
-                x = x + self.time_embed
+            x = x + self._resize_time_embed(T)
             x = self.time_drop(x)
             x = rearrange(x, '(b n) t m -> b (n t) m', b=B, t=T)
             x = torch.cat((cls_tokens, x), dim=1)
+        return x
 
-        if get_attn:
-            for i, blk in enumerate(self.blocks):
-                if i < len(self.blocks) - 1:
-                    x = blk(x, B, T, W)
-                else:
-                    # return attention of the last block
-                    return blk(x, B, T, W, return_attn=True)
-
-        # Attention blocks
-        for blk in self.blocks:
+    def drop_tokens(self, x, B, T, keep_ratio):
+        """
+        Randomly keep a fraction `keep_ratio` of the spatial positions of every
+        clip, the same positions in all frames, along with the CLS token.
+        Works on the output of prepare_tokens, so every kept token carries its
+        own positional and time embeddings.
+        """
+        N = (x.size(1) - 1) // T
+        num_keep = max(1, int(N * keep_ratio))
+        keep = torch.rand(B, N, device=x.device).argsort(dim=1)[:, :num_keep]
+        patches = x[:, 1:].reshape(B, N, T, x.size(-1))  # tokens are laid out as (h w t)
+        patches = torch.gather(patches, 1, keep[:, :, None, None].expand(-1, -1, T, x.size(-1)))
+        return torch.cat((x[:, :1], patches.flatten(1, 2)), dim=1)
+
+    def forward_blocks(self, x, B, T, W, start=0, end=None):
+        """
+        Run the attention blocks self.blocks[start:end] on prepared tokens.
+        """
+        for blk in self.blocks[start:end]:
             x = blk(x, B, T, W)
+        return x
 
+    def forward_norm(self, x, B, T, get_all=False):
         # Predictions for space-only baseline
         if self.attention_type == 'space_only':
             x = rearrange(x, '(b t) n m -> b t n m', b=B, t=T)
@@ -344,8 +478,24 @@ class VisionTransformer(nn.Module):
             return x
         return x[:, 0]
 
-    def forward(self, x, use_head=False):
-        x = self.forward_features(x)
+    def forward_features(self, x, get_all=False, get_attn=False, token_keep_ratio=None):
+        x, B, T, W = self.prepare_tokens(x)
+        if token_keep_ratio is not None and token_keep_ratio < 1 and self.training:
+            assert self.attention_type != 'space_only', "token dropping needs the (h w t) token layout"
+            x = self.drop_tokens(x, B, T, token_keep_ratio)
+            W = 1  # the kept positions no longer form a grid, the blocks see them as an n x 1 grid
+
+        if get_attn:
+            x = self.forward_blocks(x, B, T, W, end=-1)
+            # return attention of the last block
+            return self.blocks[-1](x, B, T, W, return_attn=True)
+
+        # Attention blocks
+        x = self.forward_blocks(x, B, T, W)
+        return self.forward_norm(x, B, T, get_all=get_all)
+
+    def forward(self, x, use_head=False, token_keep_ratio=None):
+        x = self.forward_features(x, token_keep_ratio=token_keep_ratio)
         if use_head:
             x = self.head(x)
         return x
@@ -355,20 +505,14 @@ class VisionTransformer(nn.Module):
         return [x, ]
 
     def get_last_selfattention(self, x):
-        x = self.prepare_tokens(x)
-        for i, blk in enumerate(self.blocks):
-            if i < len(self.blocks) - 1:
-                x = blk(x)
-            else:
-                # return attention of the last block
-                return blk(x, return_attention=True)
+        return self.forward_features(x, get_attn=True)
 
 
 def _conv_filter(state_dict, patch_size=16):
     """ convert patch embedding weight from manual patchify + linear proj to conv"""
     out_dict = {}
     for k, v in state_dict.items():
-        if 'patch_embed.proj.weight' in k:
+        if 'patch_embed.proj.weight' in k and v.ndim != 5:
             if v.shape[-1] != patch_size:
                 patch_size = v.shape[-1]
             v = v.reshape((v.shape[0], 3, patch_size, patch_size))
@@ -474,13 +618,7 @@ class FlowTokenVisionTransformer(VisionTransformer):
             x = x[:, 1:-1]
             x = rearrange(x, '(b t) n m -> (b n) t m', b=B, t=T)
             # Resizing time embeddings in case they don't match
-            if T != self.time_embed.size(1):
-                time_embed = self.time_embed.transpose(1, 2)
-                new_time_embed = F.interpolate(time_embed, size=(T), mode='nearest')
-                new_time_embed = new_time_embed.transpose(1, 2)
-                x = x + new_time_embed
-            else:
-                x = x + self.time_embed
+            x = x + self._resize_time_embed(T)
             x = self.time_drop(x)
             x = rearrange(x, '(b n) t m -> b (n t) m', b=B, t=T)
             x = torch.cat((cls_tokens, x, aux_cls_tokens), dim=1)
@@ -554,13 +692,7 @@ class AuxTokenVisionTransformer(VisionTransformer):
             x = x[:, 1:-1]
             x = rearrange(x, '(b t) n m -> (b n) t m', b=B, t=T)
             # Resizing time embeddings in case they don't match
-            if T != self.time_embed.size(1):
-                time_embed = self.time_embed.transpose(1, 2)
-                new_time_embed = F.interpolate(time_embed, size=(T), mode='nearest')
-                new_time_embed = new_time_embed.transpose(1, 2)
-                x = x + new_time_embed
-            else:
-                x = x + self.time_embed
+            x = x + self._resize_time_embed(T)
             x = self.time_drop(x)
             x = rearrange(x, '(b n) t m -> b (n t) m', b=B, t=T)
             x = torch.cat((cls_tokens, x, aux_cls_tokens), dim=1)
@@ -595,7 +727,12 @@ def get_vit_base_patch16_224(cfg, no_head=False, **kwargs):
                             patch_size=patch_size, embed_dim=768, depth=12, num_heads=12, mlp_ratio=4,
                             qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0.,
                             attn_drop_rate=0., drop_path_rate=0.1, num_frames=cfg.DATA.NUM_FRAMES,
-                            attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, **kwargs)
+                            attention_type=cfg.TIMESFORMER.ATTENTION_TYPE,
+                            drop_path_skip_compute=cfg.TIMESFORMER.DROP_PATH_SKIP_COMPUTE,
+                            tubelet_size=cfg.TIMESFORMER.TUBELET_SIZE,
+                            layout_stable_block=cfg.TIMESFORMER.LAYOUT_STABLE_BLOCK,
+                            temporal_window=cfg.TIMESFORMER.TEMPORAL_WINDOW,
+                            time_embed_interp=cfg.TIMESFORMER.TIME_EMBED_INTERP, **kwargs)
     vit.attention_type = cfg.TIMESFORMER.ATTENTION_TYPE
     vit.default_cfg = default_cfgs['vit_base_patch16_224']
     vit.num_patches = (cfg.DATA.TRAIN_CROP_SIZE // patch_size) * (cfg.DATA.TRAIN_CROP_SIZE // patch_size)
@@ -603,7 +740,9 @@ def get_vit_base_patch16_224(cfg, no_head=False, **kwargs):
     if pretrained_model:
         load_pretrained(vit, num_classes=vit.num_classes, in_chans=kwargs.get('in_chans', 3),
                         filter_fn=_conv_filter, img_size=cfg.DATA.TRAIN_CROP_SIZE, num_patches=vit.num_patches,
-                        attention_type=vit.attention_type, pretrained_model=pretrained_model)
+                        num_frames=cfg.DATA.NUM_FRAMES // cfg.TIMESFORMER.TUBELET_SIZE,
+                        attention_type=vit.attention_type, pretrained_model=pretrained_model,
+                        tubelet_size=cfg.TIMESFORMER.TUBELET_SIZE, time_embed_interp=cfg.TIMESFORMER.TIME_EMBED_INTERP)
     if no_head:
         vit.head = None
     return vit
@@ -615,18 +754,49 @@ def get_aux_token_vit(cfg, no_head=False, **kwargs):
                             patch_size=patch_size, embed_dim=768, depth=12, num_heads=12, mlp_ratio=4,
                             qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0.,
                             attn_drop_rate=0., drop_path_rate=0.1, num_frames=cfg.DATA.NUM_FRAMES,
-                            attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, **kwargs)
+                            attention_type=cfg.TIMESFORMER.ATTENTION_TYPE,
+                            drop_path_skip_compute=cfg.TIMESFORMER.DROP_PATH_SKIP_COMPUTE,
+                            tubelet_size=cfg.TIMESFORMER.TUBELET_SIZE,
+                            layout_stable_block=cfg.TIMESFORMER.LAYOUT_STABLE_BLOCK,
+                            temporal_window=cfg.TIMESFORMER.TEMPORAL_WINDOW,
+                            time_embed_interp=cfg.TIMESFORMER.TIME_EMBED_INTERP, **kwargs)
     vit.attention_type = cfg.TIMESFORMER.ATTENTION_TYPE
     vit.default_cfg = default_cfgs['vit_base_patch16_224']
     vit.num_patches = (cfg.DATA.TRAIN_CROP_SIZE // patch_size) * (cfg.DATA.TRAIN_CROP_SIZE // patch_size)
     pretrained_model = cfg.TIMESFORMER.PRETRAINED_MODEL
     load_pretrained(vit, num_classes=vit.num_classes, in_chans=kwargs.get('in_chans', 3),
                     filter_fn=_conv_filter, img_size=cfg.DATA.TRAIN_CROP_SIZE, num_patches=vit.num_patches+1,
-                    attention_type=vit.attention_type, pretrained_model=pretrained_model)
+                    num_frames=cfg.DATA.NUM_FRAMES // cfg.TIMESFORMER.TUBELET_SIZE,
+                    attention_type=vit.attention_type, pretrained_model=pretrained_model,
+                    tubelet_size=cfg.TIMESFORMER.TUBELET_SIZE, time_embed_interp=cfg.TIMESFORMER.TIME_EMBED_INTERP)
+    if no_head:
+        vit.head = None
+    return vit
+
+
+def get_distill_student(cfg, no_head=False, **kwargs):
+    """
+    Smaller divided space-time student of train_distill.py (DISTILL.* options), on DISTILL.NUM_FRAMES frames.
+    """
+    patch_size = 16
+    vit = VisionTransformer(img_size=cfg.DATA.TRAIN_CROP_SIZE, num_classes=cfg.MODEL.NUM_CLASSES,
+                            patch_size=patch_size, embed_dim=cfg.DISTILL.EMBED_DIM, depth=cfg.DISTILL.DEPTH,
+                            num_heads=cfg.DISTILL.NUM_HEADS, mlp_ratio=4, qkv_bias=True,
+                            norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0.,
+                            drop_path_rate=0.1, num_frames=cfg.DISTILL.NUM_FRAMES,
+                            attention_type=cfg.TIMESFORMER.ATTENTION_TYPE,
+                            drop_path_skip_compute=cfg.TIMESFORMER.DROP_PATH_SKIP_COMPUTE,
+                            tubelet_size=cfg.TIMESFORMER.TUBELET_SIZE,
+                            layout_stable_block=cfg.TIMESFORMER.LAYOUT_STABLE_BLOCK,
+                            temporal_window=cfg.TIMESFORMER.TEMPORAL_WINDOW,
+                            time_embed_interp=cfg.TIMESFORMER.TIME_EMBED_INTERP, **kwargs)
+    vit.attention_type = cfg.TIMESFORMER.ATTENTION_TYPE
+    vit.num_patches = (cfg.DATA.TRAIN_CROP_SIZE // patch_size) * (cfg.DATA.TRAIN_CROP_SIZE // patch_size)
     if no_head:
         vit.head = None
     return vit
 
+
 if __name__ == '__main__':
     from utils.parser import parse_args, load_config
 
@@ -0,0 +1,119 @@
+"""
+Token merging (ToMe, Bolya et al. 2023) for inference with the divided space-time VisionTransformer.
+
+Between blocks, the most similar spatial positions (compared on their features averaged over frames) are
+merged in every frame, and the most similar frames (compared on their features averaged over positions) are
+merged at every position, so the remaining tokens always form an n x t grid that divided attention can run on.
+Merged tokens are size-weighted averages of the tokens they replace.
+"""
+
+import torch
+import torch.nn as nn
+
+
+def bipartite_soft_matching(metric, r):
+    """
+    Split the n tokens of `metric` (b x n x c) into two alternating sets A and B, match every token of A
+    to its most similar token of B, and keep the r most similar edges.
+    Returns a `merge(x)` function that merges the r matched tokens of A into B along dim 1 of any tensor
+    x of shape b x n x ... (summing them), reducing it to b x (n - r) x ...
+    """
+    r = min(r, metric.shape[1] // 2)
+    if r <= 0:
+        return lambda x: x
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        unm_idx = edge_idx[:, r:]  # unmerged tokens of A
+        src_idx = edge_idx[:, :r]  # merged tokens of A
+        dst_idx = node_idx.gather(1, src_idx)  # their match in B
+
+    def _expand(idx, x):
+        return idx.view(idx.shape + (1,) * (x.dim() - 2)).expand((-1, -1) + x.shape[2:])
+
+    def merge(x):
+        src, dst = x[:, ::2], x[:, 1::2]
+        unm = src.gather(1, _expand(unm_idx, src))
+        src = src.gather(1, _expand(src_idx, src))
+        dst = dst.scatter_add(1, _expand(dst_idx, src), src)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge
+
+
+def merge_wavg(merge, x, size):
+    """
+    Size-weighted average merge of x (b x n x ...) with token sizes `size` (b x n).
+    """
+    weight = size.view(size.shape + (1,) * (x.dim() - 2))
+    x = merge(x * weight)
+    size = merge(size)
+    return x / size.view(size.shape + (1,) * (x.dim() - 2)), size
+
+
+def merge_spatial(x, size, r, B, T):
+    """
+    Merge r spatial positions of the tokens x (b x (1 + n t) x m, laid out as (n t)) in every frame.
+    """
+    cls_token, patches = x[:, :1], x[:, 1:].reshape(B, -1, T, x.size(-1))
+    merge = bipartite_soft_matching(patches.mean(dim=2), r)
+    patches, size = merge_wavg(merge, patches, size)
+    return torch.cat((cls_token, patches.flatten(1, 2)), dim=1), size
+
+
+def merge_temporal(x, size, r, B, T):
+    """
+    Merge r frames of the tokens x (b x (1 + n t) x m, laid out as (n t)) at every spatial position.
+    Returns the new number of frames.
+    """
+    cls_token, patches = x[:, :1], x[:, 1:].reshape(B, -1, T, x.size(-1)).transpose(1, 2)
+    merge = bipartite_soft_matching(patches.mean(dim=2), r)
+    patches, size = merge_wavg(merge, patches, size)
+    T = patches.size(1)
+    patches = patches.transpose(1, 2).flatten(1, 2)
+    return torch.cat((cls_token, patches), dim=1), size, T
+
+
+def parse_schedule(values, depth):
+    """
+    A single value applies after every block, otherwise one value per block is expected.
+    """
+    values = list(values)
+    if len(values) == 1:
+        values = values * depth
+    assert len(values) == depth, "merge schedule needs 1 or {} values, got {}".format(depth, len(values))
+    return values
+
+
+class TokenMergingWrapper(nn.Module):
+    """
+    Inference wrapper around a divided space-time VisionTransformer that merges
+    spatial_schedule[i] positions and temporal_schedule[i] frames after block i.
+    Returns the normalized CLS features, like VisionTransformer.forward.
+    """
+    def __init__(self, model, spatial_schedule=(0,), temporal_schedule=(0,)):
+        super(TokenMergingWrapper, self).__init__()
+        assert model.attention_type == 'divided_space_time', "token merging needs divided space-time attention"
+        self.model = model
+        self.num_features = self.embed_dim = model.embed_dim
+        self.spatial_schedule = parse_schedule(spatial_schedule, len(model.blocks))
+        self.temporal_schedule = parse_schedule(temporal_schedule, len(model.blocks))
+
+    @torch.no_grad()
+    def forward(self, x):
+        x, B, T, W = self.model.prepare_tokens(x)
+        N = (x.size(1) - 1) // T
+        spatial_size = x.new_ones(B, N)
+        temporal_size = x.new_ones(B, T)
+        for blk, r_spatial, r_temporal in zip(self.model.blocks, self.spatial_schedule, self.temporal_schedule):
+            x = blk(x, B, T, W)
+            if r_spatial > 0:
+                x, spatial_size = merge_spatial(x, spatial_size, r_spatial, B, T)
+                W = 1  # merged positions no longer form an h x w grid
+            if r_temporal > 0 and T > 1:
+                x, temporal_size, T = merge_temporal(x, temporal_size, r_temporal, B, T)
+        return self.model.forward_norm(x, B, T)
@@ -167,13 +167,62 @@ def drop_path(x, drop_prob: float = 0., training: bool = False):
     return output
 
 
+def drop_path_subset(x, fn, drop_prob: float = 0., training: bool = False):
+    """Compute-skipping variant of drop_path: returns drop_path(fn(x)), but evaluates the residual
+    branch `fn` only on the kept samples (rows of dim 0) and scatters them back into a zero tensor.
+    `fn` must act independently on every sample. The expectation matches drop_path.
+    """
+    if drop_prob == 0. or not training:
+        return fn(x)
+    keep_prob = 1 - drop_prob
+    keep = (keep_prob + torch.rand(x.shape[0], device=x.device)).floor_().bool()
+    keep_idx = keep.nonzero(as_tuple=False).squeeze(1)
+    if keep_idx.numel() == 0:
+        # every sample is dropped: fn may not accept 0 rows (views with an inferred batch size), so it runs
+        # on one row with zero weight, which keeps all its parameters in the graph (DDP)
+        out = fn(x[:1]) * 0.
+        return out.new_zeros((x.shape[0],) + out.shape[1:]) + out
+    out = fn(x.index_select(0, keep_idx)).div(keep_prob)
+    return out.new_zeros((x.shape[0],) + out.shape[1:]).index_copy(0, keep_idx, out)
+
+
 class DropPath(nn.Module):
     """Drop paths (Stochastic Depth) per sample  (when applied in main path of residual blocks).
+    With skip_compute, use forward_residual to run the residual branch on kept samples only.
     """
 
-    def __init__(self, drop_prob=None):
+    def __init__(self, drop_prob=None, skip_compute=False):
         super(DropPath, self).__init__()
         self.drop_prob = drop_prob
+        self.skip_compute = skip_compute
 
     def forward(self, x):
         return drop_path(x, self.drop_prob, self.training)
+
+    def forward_residual(self, fn, x):
+        if self.skip_compute:
+            return drop_path_subset(x, fn, self.drop_prob, self.training)
+        return self(fn(x))
+
+
+def drop_path_residual(drop_path_module, fn, x):
+    """drop_path_module(fn(x)) for a DropPath or nn.Identity module, skipping the compute of
+    dropped samples when the module is a DropPath built with skip_compute=True.
+    """
+    if isinstance(drop_path_module, DropPath):
+        return drop_path_module.forward_residual(fn, x)
+    return drop_path_module(fn(x))
+
+
+if __name__ == '__main__':
+    # drop_path_subset with every sample dropped, through a branch that infers its batch size in a view
+    linear = nn.Linear(8, 8)
+    x = torch.randn(4, 6, 8, requires_grad=True)
+    out = drop_path_subset(x, lambda y: linear(y.view(-1, 3, 8)).view(y.size(0), -1, 8), drop_prob=1.0,
+                           training=True)
+    assert out.shape == x.shape and not out.any()
+    out.sum().backward()
+    assert linear.weight.grad is not None and not linear.weight.grad.any()
+    out = drop_path_subset(x, linear, drop_prob=0.5, training=True)
+    assert out.shape == x.shape
+    print("drop_path_subset ok")
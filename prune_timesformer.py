@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import torch
+import torch.backends.cudnn as cudnn
+
+from datasets import UCF101, HMDB51
+from models import get_vit_base_patch16_224
+from models.pruning import IMPORTANCE_MODES, compute_importance, prune_model
+from utils.benchmark import measure_throughput
+from utils.parser import load_config
+
+
+def load_model(config, args, device):
+    """
+    Fine-tuned classifier (fine_tune.py checkpoint, with its head) or pretrained SVT backbone.
+    """
+    ckpt = torch.load(args.pretrained_weights, map_location="cpu")
+    if "state_dict" in ckpt:
+        model = get_vit_base_patch16_224(cfg=config, no_head=False)
+        msg = model.load_state_dict(ckpt["state_dict"])
+    else:
+        model = get_vit_base_patch16_224(cfg=config, no_head=True)
+        if args.checkpoint_key in ckpt:
+            ckpt = {x.replace("module.", "", 1): y for x, y in ckpt[args.checkpoint_key].items()}
+        renamed_checkpoint = {x[len("backbone."):]: y for x, y in ckpt.items() if x.startswith("backbone.")}
+        msg = model.load_state_dict(renamed_checkpoint, strict=False)
+    print(f"Loaded model with msg: {msg}")
+    return model.to(device)
+
+
+def benchmark(model, clip_shape, args, device):
+    stats = measure_throughput(model.eval(), clip_shape, batch_size=args.batch_size, num_iters=args.benchmark_iters,
+                               device=device)
+    stats["params_m"] = sum(p.numel() for p in model.parameters()) / 1e6
+    return stats
+
+
+def prune(args):
+    config = load_config(args)
+    config.TEST.NUM_SPATIAL_CROPS = 1
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = load_model(config, args, device)
+    clip_shape = (3, config.DATA.NUM_FRAMES, config.DATA.TEST_CROP_SIZE, config.DATA.TEST_CROP_SIZE)
+    report = {"dense": benchmark(model, clip_shape, args, device)}
+    print(f"dense: {report['dense']}")
+
+    # calibration clips from the train split
+    if args.dataset == "ucf101":
+        dataset = UCF101(cfg=config, mode="train", num_retries=10)
+    elif args.dataset == "hmdb51":
+        dataset = HMDB51(cfg=config, mode="train", num_retries=10)
+    else:
+        raise NotImplementedError(f"invalid dataset: {args.dataset}")
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                         num_workers=args.num_workers, drop_last=False)
+    scores = compute_importance(model, loader, num_batches=args.calib_batches, mode=args.importance, device=device)
+    spec = prune_model(model, scores, head_prune_ratio=args.head_prune_ratio,
+                       mlp_prune_ratio=args.mlp_prune_ratio, mlp_multiple=args.mlp_multiple)
+    report["pruned"] = benchmark(model, clip_shape, args, device)
+    report["pruned"]["speedup"] = report["pruned"]["clips_per_sec"] / report["dense"]["clips_per_sec"]
+    report["pruning"] = spec
+    print(f"pruned: {report['pruned']}")
+
+    # fine_tune.py --pruned_checkpoint rebuilds the pruned shapes from "pruning" before loading "state_dict"
+    torch.save({"state_dict": model.state_dict(), "pruning": spec, "args": args},
+               os.path.join(args.output_dir, "pruned.pth"))
+    with (Path(args.output_dir) / "pruning_report.json").open("w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Attention-head and MLP structured pruning of a TimeSformer')
+    parser.add_argument('--pretrained_weights', required=True, type=str,
+        help="fine_tune.py checkpoint (classifier) or train_ssl.py checkpoint (backbone) to prune.")
+    parser.add_argument("--checkpoint_key", default="teacher", type=str,
+        help='Key to use in a train_ssl.py checkpoint (example: "teacher")')
+    parser.add_argument('--importance', default="activation", choices=IMPORTANCE_MODES,
+        help='Importance of the heads / hidden units; gradient needs a fine-tuned classifier.')
+    parser.add_argument('--calib_batches', default=32, type=int, help='Number of calibration batches.')
+    parser.add_argument('--head_prune_ratio', default=0.25, type=float,
+        help='Fraction of the heads of every attn / temporal_attn removed.')
+    parser.add_argument('--mlp_prune_ratio', default=0.25, type=float,
+        help='Fraction of the hidden units of every mlp removed.')
+    parser.add_argument('--mlp_multiple', default=64, type=int,
+        help='Round the number of kept hidden units up to a multiple of this.')
+    parser.add_argument('--batch_size', default=8, type=int, help='Batch size of the calibration and benchmark.')
+    parser.add_argument('--benchmark_iters', default=20, type=int, help='Timed batches of the latency benchmark.')
+    parser.add_argument('--num_workers', default=8, type=int, help='Number of data loading workers.')
+    parser.add_argument('--dataset', default="ucf101", help='Calibration dataset: ucf101 / hmdb51')
+    parser.add_argument('--output_dir', default=".", help='Path to save the pruned checkpoint and the report.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    os.makedirs(args.output_dir, exist_ok=True)
+    cudnn.benchmark = True
+    prune(args)
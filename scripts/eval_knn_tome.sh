@@ -0,0 +1,34 @@
+#!/bin/bash
+
+PROJECT_PATH="$HOME/repo/svt"
+CHECKPOINT="path/to/checkpoint.pth"
+DATASET="ucf101"
+DATA_PATH="${HOME}/repo/mmaction2/data/${DATASET}"
+
+cd "$PROJECT_PATH" || exit
+
+export CUDA_VISIBLE_DEVICES=0
+# throughput vs k-NN accuracy for increasing spatial / temporal merge rates
+for SPATIAL_R in 0 8 16; do
+  for TEMPORAL_R in 0 1; do
+    echo "tome_spatial_r=${SPATIAL_R} tome_temporal_r=${TEMPORAL_R}"
+    python -m torch.distributed.launch \
+      --nproc_per_node=1 \
+      --master_port="$RANDOM" \
+      eval_knn.py \
+      --arch "vit_base" \
+      --pretrained_weights "$CHECKPOINT" \
+      --batch_size_per_gpu 128 \
+      --nb_knn 5 \
+      --temperature 0.07 \
+      --num_workers 4 \
+      --dataset "$DATASET" \
+      --tome_spatial_r "$SPATIAL_R" \
+      --tome_temporal_r "$TEMPORAL_R" \
+      --measure_throughput true \
+      --opts \
+      DATA.PATH_TO_DATA_DIR "${DATA_PATH}/knn_splits" \
+      DATA.PATH_PREFIX "${DATA_PATH}/videos" \
+      | grep -E "throughput|NN classifier"
+  done
+done
@@ -0,0 +1,21 @@
+#!/bin/bash
+
+PROJECT_PATH="$HOME/repo/svt"
+CHECKPOINT_DIR="path/to/pretrain/output"
+DATA_ROOT="${HOME}/repo/mmaction2/data"
+
+cd "$PROJECT_PATH" || exit
+
+export CUDA_VISIBLE_DEVICES=0,1,2,3
+python -m torch.distributed.launch \
+  --nproc_per_node=4 \
+  --master_port="$RANDOM" \
+  eval_matrix.py \
+  --checkpoints "$CHECKPOINT_DIR"/checkpoint0*.pth \
+  --datasets ucf101 hmdb51 \
+  --data_root "$DATA_ROOT" \
+  --batch_size_per_gpu 32 \
+  --nb_knn 10 20 \
+  --temperature 0.07 \
+  --num_workers 8 \
+  --output_dir "$CHECKPOINT_DIR/eval_matrix"
@@ -0,0 +1,181 @@
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+
+from datasets.decoder import temporal_sampling
+from datasets.video_folder import decode_test_clip, preprocess_test_clip
+from eval_knn import load_backbone
+from utils import utils
+from utils.parser import load_config
+from utils.serving import DynamicBatcher, LatencyStats
+
+
+class EmbeddingService(object):
+    """
+    Video embeddings of clip paths or uint8 frames, computed by the shared DynamicBatcher. Decoding and
+    preprocessing run in the thread of the request, so that they overlap with the batches on the device.
+    """
+
+    def __init__(self, config, batcher, num_clips=1):
+        self.config = config
+        self.batcher = batcher
+        self.stats = batcher.stats
+        self.num_clips = num_clips
+
+    def _embed_clips(self, clips):
+        features = np.stack([future.result() for future in [self.batcher.submit(clip) for clip in clips]])
+        feature = features.mean(0)
+        return feature / max(np.linalg.norm(feature), 1e-12)
+
+    def embed_path(self, path, num_clips=None):
+        num_clips = num_clips or self.num_clips
+        start_time = time.time()
+        try:
+            clips = [decode_test_clip(self.config, path, clip_idx, num_clips) for clip_idx in range(num_clips)]
+        except Exception as e:
+            print("Failed to load video from {} with error {}".format(path, e))
+            clips = [None]
+        self.stats.add("decode", time.time() - start_time)
+        if any(clip is None for clip in clips):
+            self.stats.count("failed")
+            return None
+        return self._embed_clips(clips)
+
+    def embed_frames(self, frames):
+        """
+        Embedding of a `num frames` x `height` x `width` x `channel` uint8 array, uniformly sampled to
+        NUM_FRAMES frames.
+        """
+        start_time = time.time()
+        frames = torch.as_tensor(frames)
+        frames = temporal_sampling(frames, 0, frames.shape[0] - 1, self.config.DATA.NUM_FRAMES)
+        clip = preprocess_test_clip(self.config, frames)
+        self.stats.add("decode", time.time() - start_time)
+        return self._embed_clips([clip])
+
+
+class EmbeddingRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /stats: latency (p50 / p99) and throughput counters.
+    POST /embed: JSON {"paths": [...], "num_clips": n} or an .npy uint8 array of frames
+                 (Content-Type: application/x-npy), `t` x `h` x `w` x `c` for one clip or
+                 `n` x `t` x `h` x `w` x `c` for n clips. Returns {"embeddings": [...], "valid": [...]},
+                 null embeddings for the videos that could not be decoded.
+    """
+    service = None
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self._send_json(404, {"error": "unknown path {}".format(self.path)})
+        self._send_json(200, self.service.stats.summary())
+
+    def do_POST(self):
+        if self.path != "/embed":
+            return self._send_json(404, {"error": "unknown path {}".format(self.path)})
+        start_time = time.time()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type") == "application/x-npy":
+                frames = np.load(io.BytesIO(body), allow_pickle=False)
+                assert frames.dtype == np.uint8 and frames.ndim in (4, 5), "expected uint8 t x h x w x c frames"
+                embeddings = [self.service.embed_frames(clip) for clip in frames.reshape((-1,) + frames.shape[-4:])]
+            else:
+                request = json.loads(body)
+                embeddings = [self.service.embed_path(path, request.get("num_clips")) for path in request["paths"]]
+        except Exception as e:
+            self.service.stats.count("errors")
+            return self._send_json(400, {"error": str(e)})
+        self.service.stats.add("request", time.time() - start_time)
+        self.service.stats.count("requests")
+        self._send_json(200, {
+            "embeddings": [e.tolist() if e is not None else None for e in embeddings],
+            "valid": [e is not None for e in embeddings],
+        })
+
+    def address_string(self):
+        # client_address is an empty string on unix sockets
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(EmbeddingRequestHandler, self).log_message(format, *args)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+
+def serve(args):
+    config = load_config(args)
+    device = "cuda" if torch.cuda.is_available() and not args.cpu else "cpu"
+    model = load_backbone(config, args.pretrained_weights, args.checkpoint_key, device=device)
+    batcher = DynamicBatcher(model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                             device=device, fp16=args.fp16, stats=LatencyStats(args.stats_window))
+    EmbeddingRequestHandler.service = EmbeddingService(config, batcher, num_clips=args.num_clips)
+    if args.unix_socket:
+        server = UnixHTTPServer(args.unix_socket, EmbeddingRequestHandler)
+        print(f"Serving embeddings on unix socket {args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), EmbeddingRequestHandler)
+        print(f"Serving embeddings on http://{args.host}:{args.port}")
+    server.daemon_threads = True
+    server.verbose = args.verbose
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.summary(), indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Local embedding service with dynamic batching')
+    parser.add_argument('--pretrained_weights', required=True, type=str, help="Path to pretrained weights to serve.")
+    parser.add_argument("--checkpoint_key", default="teacher", type=str,
+        help='Key to use in the checkpoint (example: "teacher")')
+    parser.add_argument('--host', default="127.0.0.1", type=str, help='Address to listen on.')
+    parser.add_argument('--port', default=8765, type=int, help='Port to listen on.')
+    parser.add_argument('--unix_socket', default="", type=str,
+        help='Listen on this unix socket path instead of a TCP port.')
+    parser.add_argument('--max_batch_size', default=16, type=int, help='Maximum number of clips per batch.')
+    parser.add_argument('--max_wait_ms', default=10, type=float,
+        help='Maximum time a clip waits for other clips to fill its batch.')
+    parser.add_argument('--num_clips', default=1, type=int,
+        help='Default number of clips uniformly sampled per video path, their embeddings are averaged.')
+    parser.add_argument('--fp16', default=True, type=utils.bool_flag, help='Run the model with autocast on cuda.')
+    parser.add_argument('--cpu', action='store_true', help='Serve on CPU even if cuda is available.')
+    parser.add_argument('--stats_window', default=10000, type=int,
+        help='Number of most recent requests of the latency percentiles.')
+    parser.add_argument('--verbose', action='store_true', help='Log every request.')
+    parser.add_argument("--cfg", dest="cfg_file", help="Path to the config file", type=str,
+                        default="models/configs/Kinetics/TimeSformer_divST_8x32_224.yaml")
+    parser.add_argument("--opts", help="See utils/defaults.py for all options", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    cudnn.benchmark = True
+    serve(args)
@@ -0,0 +1,273 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.backends.cudnn as cudnn
+import torch.nn as nn
+import torch.nn.functional as F
+
+from datasets import Kinetics
+from models import get_vit_base_patch16_224, get_distill_student
+from train_ssl import DINOLoss, get_args_parser
+from utils import utils
+from utils.parser import load_config
+from vision_transformer import DINOHead
+
+
+def subsample_frames(x, stride):
+    """
+    Every stride-th frame of b x c x t x h x w clips.
+    """
+    return x[:, :, ::stride] if stride > 1 else x
+
+
+class DistillStudent(utils.MultiCropWrapper):
+    """
+    Multi-crop student on temporally strided crops, returning the DINO-head outputs of all the crops and
+    the backbone features of the global crops projected to the width of the teacher features.
+    """
+    def __init__(self, backbone, head, teacher_dim, frame_stride=1, global_crops=2, vary_fr=False):
+        super(DistillStudent, self).__init__(backbone, head, vary_fr=vary_fr)
+        self.feature_proj = nn.Linear(backbone.embed_dim, teacher_dim)
+        self.frame_stride = frame_stride
+        self.global_crops = global_crops
+
+    def forward(self, x, **kwargs):
+        x = [subsample_frames(inp, self.frame_stride) for inp in x]
+        features, output = super(DistillStudent, self).forward(x, return_backbone_feat=True, **kwargs)
+        global_features = features[:self.global_crops * x[0].size(0)]
+        return self.feature_proj(global_features), output
+
+
+def load_teacher(config, args):
+    """
+    Frozen pretrained SVT teacher: backbone and DINO head of the "teacher" network of a train_ssl.py checkpoint.
+    """
+    backbone = get_vit_base_patch16_224(cfg=config, no_head=True)
+    teacher = utils.MultiCropWrapper(
+        backbone,
+        DINOHead(backbone.embed_dim, args.out_dim, args.use_bn_in_head),
+        vary_fr=config.DATA.RAND_FR,
+    )
+    ckpt = torch.load(args.teacher_weights, map_location="cpu")
+    state_dict = {x.replace("module.", "", 1): y for x, y in ckpt["teacher"].items()}
+    check_teacher_head(state_dict, teacher.head)
+    msg = teacher.load_state_dict(state_dict)
+    print(f"Loaded pretrained teacher with msg: {msg}")
+    for p in teacher.parameters():
+        p.requires_grad = False
+    # the teacher outputs are centered like during its own training
+    center = ckpt["dino_loss"]["center"] if "dino_loss" in ckpt else None
+    return teacher.eval(), center
+
+
+def check_teacher_head(state_dict, head):
+    """
+    The teacher checkpoint must hold a single-token DINOHead with the shapes of `head`. train_ssl.py saves a
+    ShardedDINOHead whole, but two-stream / two-token runs save a MultiDINOHead.
+    """
+    if any(k.startswith("head.aux_mlp.") for k in state_dict):
+        raise ValueError("the teacher checkpoint comes from a two-stream / two-token run (MultiDINOHead), "
+                         "distillation needs a single-token DINOHead teacher")
+    weight_v = state_dict.get("head.last_layer.weight_v")
+    if weight_v is None or weight_v.shape != head.last_layer.weight_v.shape:
+        raise ValueError("the teacher head last layer has shape {}, expected {} (check --out_dim, and that a "
+                         "--shard_head checkpoint was saved with its gathered last layer)".format(
+                             None if weight_v is None else tuple(weight_v.shape),
+                             tuple(head.last_layer.weight_v.shape)))
+
+
+def feature_loss(student_features, teacher_features):
+    return (1 - F.cosine_similarity(student_features, teacher_features.float(), dim=-1)).mean()
+
+
+def train_distill(args):
+    utils.init_distributed_mode(args)
+    utils.fix_random_seeds(args.seed)
+    print("git:\n  {}\n".format(utils.get_sha()))
+    print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
+    cudnn.benchmark = True
+
+    # ============ preparing data ... ============
+    config = load_config(args)
+    if utils.is_main_process():
+        json.dump(vars(args), open(Path(args.output_dir) / "config.txt", "w"), indent=4)
+    config.DATA.PATH_TO_DATA_DIR = args.data_path
+    dataset = Kinetics(cfg=config, mode="train", num_retries=10, get_flow=config.DATA.USE_FLOW)
+    sampler = torch.utils.data.DistributedSampler(dataset, shuffle=True)
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        sampler=sampler,
+        batch_size=args.batch_size_per_gpu,
+        num_workers=args.num_workers,
+        pin_memory=True,
+        drop_last=True,
+    )
+    print(f"Train data loaded: there are {len(dataset)} images.")
+
+    # ============ building the frozen teacher and the student ... ============
+    assert not (config.MODEL.TWO_STREAM or config.MODEL.TWO_TOKEN), "distillation needs a single-token teacher"
+    assert config.DATA.NUM_FRAMES % config.DISTILL.NUM_FRAMES == 0, \
+        "the student frames must be a stride of the teacher frames"
+    teacher, center = load_teacher(config, args)
+    student = DistillStudent(
+        get_distill_student(cfg=config, no_head=True),
+        DINOHead(config.DISTILL.EMBED_DIM, args.out_dim, use_bn=args.use_bn_in_head,
+                 norm_last_layer=args.norm_last_layer),
+        teacher_dim=teacher.backbone.embed_dim,
+        frame_stride=config.DATA.NUM_FRAMES // config.DISTILL.NUM_FRAMES,
+        vary_fr=config.DATA.RAND_FR,
+    )
+    teacher, student = teacher.cuda(), student.cuda()
+    student = nn.parallel.DistributedDataParallel(student, device_ids=[args.gpu], find_unused_parameters=False)
+    print(f"Student: {config.DISTILL.DEPTH} blocks of width {config.DISTILL.EMBED_DIM} on "
+          f"{config.DISTILL.NUM_FRAMES} frames, distilled from a frozen timesformer teacher.")
+
+    # ============ preparing loss ... ============
+    dino_loss = DINOLoss(
+        args.out_dim,
+        args.local_crops_number + 2,  # total number of crops = 2 global crops + local_crops_number
+        args.warmup_teacher_temp,
+        args.teacher_temp,
+        args.warmup_teacher_temp_epochs,
+        args.epochs,
+    ).cuda()
+    if center is not None:
+        dino_loss.center.copy_(center)
+
+    # ============ preparing optimizer ... ============
+    params_groups = utils.get_params_groups(student)
+    if args.optimizer == "adamw":
+        optimizer = torch.optim.AdamW(params_groups)  # to use with ViTs
+    elif args.optimizer == "sgd":
+        optimizer = torch.optim.SGD(params_groups, lr=0, momentum=0.9)  # lr is set by scheduler
+    elif args.optimizer == "lars":
+        optimizer = utils.LARS(params_groups)  # to use with convnet and large batches
+    fp16_scaler = None
+    if args.use_fp16:
+        fp16_scaler = torch.cuda.amp.GradScaler()
+
+    # ============ init schedulers ... ============
+    lr_schedule = utils.cosine_scheduler(
+        args.lr * (args.batch_size_per_gpu * utils.get_world_size()) / 256.,  # linear scaling rule
+        args.min_lr,
+        args.epochs, len(data_loader),
+        warmup_epochs=args.warmup_epochs,
+    )
+    wd_schedule = utils.cosine_scheduler(
+        args.weight_decay,
+        args.weight_decay_end,
+        args.epochs, len(data_loader),
+    )
+    print(f"Loss, optimizer and schedulers ready.")
+
+    # ============ optionally resume training ... ============
+    to_restore = {"epoch": 0}
+    utils.restart_from_checkpoint(
+        os.path.join(args.output_dir, "checkpoint.pth"),
+        run_variables=to_restore,
+        student=student,
+        optimizer=optimizer,
+        fp16_scaler=fp16_scaler,
+        dino_loss=dino_loss,
+    )
+    start_epoch = to_restore["epoch"]
+
+    start_time = time.time()
+    print("Starting distillation !")
+    for epoch in range(start_epoch, args.epochs):
+        data_loader.sampler.set_epoch(epoch)
+
+        train_stats = train_one_epoch(student, teacher, dino_loss, data_loader, optimizer, lr_schedule,
+                                      wd_schedule, epoch, fp16_scaler, args, cfg=config)
+
+        save_dict = {
+            'student': student.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'epoch': epoch + 1,
+            'args': args,
+            'dino_loss': dino_loss.state_dict(),
+        }
+        if fp16_scaler is not None:
+            save_dict['fp16_scaler'] = fp16_scaler.state_dict()
+        utils.save_on_master(save_dict, os.path.join(args.output_dir, 'checkpoint.pth'))
+        if args.saveckp_freq and epoch % args.saveckp_freq == 0:
+            utils.save_on_master(save_dict, os.path.join(args.output_dir, f'checkpoint{epoch:04}.pth'))
+        log_stats = {**{f'train_{k}': v for k, v in train_stats.items()}, 'epoch': epoch}
+        if utils.is_main_process():
+            with (Path(args.output_dir) / "log.txt").open("a") as f:
+                f.write(json.dumps(log_stats) + "\n")
+    total_time = time.time() - start_time
+    total_time_str = str(datetime.timedelta(seconds=int(total_time)))
+    print('Training time {}'.format(total_time_str))
+
+
+def train_one_epoch(student, teacher, dino_loss, data_loader, optimizer, lr_schedule, wd_schedule, epoch,
+                    fp16_scaler, args, cfg=None):
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Epoch: [{}/{}]'.format(epoch, args.epochs)
+    for it, (images, _, _, meta) in enumerate(metric_logger.log_every(data_loader, 10, header)):
+        # update weight decay and learning rate according to their schedule
+        it = len(data_loader) * epoch + it  # global training iteration
+        for i, param_group in enumerate(optimizer.param_groups):
+            param_group["lr"] = lr_schedule[it]
+            if i == 0:  # only the first group is regularized
+                param_group["weight_decay"] = wd_schedule[it]
+
+        images = [im.cuda(non_blocking=True) for im in images]
+        with torch.cuda.amp.autocast(fp16_scaler is not None):
+            # only the 2 global views pass through the teacher, with all their frames
+            with torch.no_grad():
+                teacher_features, teacher_output = teacher(images[:2], return_backbone_feat=True)
+            student_features, student_output = student(images)
+            loss_head = dino_loss(student_output, teacher_output, epoch)
+            loss_feat = feature_loss(student_features, teacher_features)
+            loss = cfg.DISTILL.HEAD_WEIGHT * loss_head + cfg.DISTILL.FEATURE_WEIGHT * loss_feat
+
+        if not math.isfinite(loss.item()):
+            print("Loss is {}, stopping training".format(loss.item()), force=True)
+            sys.exit(1)
+
+        # student update
+        optimizer.zero_grad()
+        if fp16_scaler is None:
+            loss.backward()
+            if args.clip_grad:
+                utils.clip_gradients(student, args.clip_grad)
+            utils.cancel_gradients_last_layer(epoch, student, args.freeze_last_layer)
+            optimizer.step()
+        else:
+            fp16_scaler.scale(loss).backward()
+            if args.clip_grad:
+                fp16_scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
+                utils.clip_gradients(student, args.clip_grad)
+            utils.cancel_gradients_last_layer(epoch, student, args.freeze_last_layer)
+            fp16_scaler.step(optimizer)
+            fp16_scaler.update()
+
+        # logging
+        torch.cuda.synchronize()
+        metric_logger.update(loss=loss.item())
+        metric_logger.update(loss_head=loss_head.item())
+        metric_logger.update(loss_feat=loss_feat.item())
+        metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+        metric_logger.update(wd=optimizer.param_groups[0]["weight_decay"])
+    # gather the stats from all processes
+    metric_logger.synchronize_between_processes()
+    print("Averaged stats:", metric_logger)
+    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SVT distillation', parents=[get_args_parser()])
+    parser.add_argument('--teacher_weights', required=True, type=str,
+        help='train_ssl.py checkpoint of the pretrained SVT teacher (its "teacher" network is used).')
+    args = parser.parse_args()
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    train_distill(args)
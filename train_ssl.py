@@ -32,14 +32,18 @@ from torchvision import models as torchvision_models
 
 from utils import utils
 import vision_transformer as vits
-from vision_transformer import DINOHead, MultiDINOHead
+from vision_transformer import DINOHead, MultiDINOHead, ShardedDINOHead
 
 from datasets import Kinetics
 from datasets.rand_conv import RandConv
 from models import get_vit_base_patch16_224, get_aux_token_vit, SwinTransformer3D, S3D
+from utils.compile import compile_model
+from utils.zero import CHECKPOINT_MODES, build_optimizer, is_sharded, optimizer_state_dict, restart_shard, save_shard
 from utils.parser import load_config
 from eval_knn import extract_features, knn_classifier, UCFReturnIndexDataset, HMDBReturnIndexDataset
 
+TEACHER_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
 torchvision_archs = sorted(name for name in torchvision_models.__dict__
                            if name.islower() and not name.startswith("__")
                            and callable(torchvision_models.__dict__[name]))
@@ -61,6 +65,11 @@ def get_args_parser():
         mixed precision training (--use_fp16 false) to avoid unstabilities.""")
     parser.add_argument('--out_dim', default=65536, type=int, help="""Dimensionality of
         the DINO head output. For complex and large datasets large values (like 65k) work well.""")
+    parser.add_argument('--shard_head', default=False, type=utils.bool_flag,
+        help="""Whether to shard the output dimension of the DINO head last layer (and of the loss) across the
+        GPUs. Divides the memory of the last layer, its gradients and optimizer state by the number of GPUs.
+        The logits are not reduced: every GPU holds global batch x out_dim / num_GPUs of them, as many as the
+        local batch x out_dim of the unsharded head.""")
     parser.add_argument('--norm_last_layer', default=True, type=utils.bool_flag,
                         help="""Whether or not to weight normalize the last layer of the DINO head.
         Not normalizing leads to better performance but can make the training unstable.
@@ -70,6 +79,17 @@ def get_args_parser():
         We recommend setting a higher value with small batches: for example use 0.9995 with batch size of 256.""")
     parser.add_argument('--use_bn_in_head', default=False, type=utils.bool_flag,
                         help="Whether to use batch normalizations in projection head (Default: False)")
+    parser.add_argument('--student_token_keep', default=1.0, type=float, help="""Fraction of the spatial patch
+        positions of every student view kept (the same positions in all frames) before the TimeSformer blocks.
+        The teacher always sees all tokens. 1.0 disables token dropping (timesformer only).""")
+    parser.add_argument('--compile', type=utils.bool_flag, default=False, help="""Compile the student and
+        teacher backbones with torch.compile, one graph per crop shape (global / local crops). Graphs that
+        fail to compile run eagerly.""")
+    parser.add_argument('--compile_mode', default='default', type=str,
+        choices=['default', 'reduce-overhead', 'max-autotune'], help="torch.compile mode used with --compile.")
+    parser.add_argument('--teacher_dtype', default='fp32', type=str, choices=['fp32', 'bf16', 'fp16'],
+        help="""Precision of the teacher copy used for the forward passes. With bf16 / fp16 the EMA updates go
+        to an fp32 master copy of the teacher, synchronized into the low precision copy after every step.""")
 
     # Temperature teacher parameters
     parser.add_argument('--warmup_teacher_temp', default=0.04, type=float,
@@ -107,6 +127,12 @@ def get_args_parser():
                         help="Number of epochs for the linear learning-rate warm up.")
     parser.add_argument('--min_lr', type=float, default=1e-6, help="""Target LR at the
         end of optimization. We use a cosine LR schedule with linear warmup.""")
+    parser.add_argument('--zero_optimizer', default=False, type=utils.bool_flag,
+        help="""Whether to shard the optimizer state across the GPUs (ZeRO-1): each GPU keeps the state of a
+        partition of the parameters and broadcasts them after its update.""")
+    parser.add_argument('--zero_checkpoint', default='consolidated', type=str, choices=CHECKPOINT_MODES,
+        help="""How checkpoints store a sharded optimizer state: consolidated in checkpoint.pth (gathered on
+        the first GPU, resumable with any number of GPUs) or sharded in one optimizer_rank*.pth file per GPU.""")
     parser.add_argument('--optimizer', default='adamw', type=str,
                         choices=['adamw', 'sgd', 'lars'],
                         help="""Type of optimizer. We recommend using adamw with ViTs.""")
@@ -199,6 +225,7 @@ def train_svt(args):
     # ============ building student and teacher networks ... ============
     # we changed the name DeiT-S for ViT-S to avoid confusions
     args.arch = args.arch.replace("deit", "vit")
+    assert args.student_token_keep >= 1 or args.arch == "timesformer", "token dropping requires --arch timesformer"
     # if the network is a vision transformer (i.e. vit_tiny, vit_small, vit_base)
     if args.arch == "timesformer":
         if config.MODEL.TWO_TOKEN:
@@ -208,6 +235,9 @@ def train_svt(args):
             student = get_vit_base_patch16_224(cfg=config, no_head=True)
             teacher = get_vit_base_patch16_224(cfg=config, no_head=True)
         embed_dim = student.embed_dim
+        if args.student_token_keep < 1:
+            assert not (config.MODEL.TWO_TOKEN or config.MODEL.TWO_STREAM), \
+                "token dropping is only supported for the single-token timesformer"
 
         if args.pretrained_rgb is not None:
             state_dict = torch.load(args.pretrained_rgb)["teacher"]
@@ -233,7 +263,8 @@ def train_svt(args):
             motion_embed_dim = None
 
     if args.arch == "swin":
-        student = SwinTransformer3D(depths=[2, 2, 18, 2], embed_dim=128, num_heads=[4, 8, 16, 32])
+        student = SwinTransformer3D(depths=[2, 2, 18, 2], embed_dim=128, num_heads=[4, 8, 16, 32],
+                                    drop_path_skip_compute=config.TIMESFORMER.DROP_PATH_SKIP_COMPUTE)
         teacher = SwinTransformer3D(depths=[2, 2, 18, 2], embed_dim=128, num_heads=[4, 8, 16, 32])
 
         embed_dim = 1024
@@ -275,6 +306,8 @@ def train_svt(args):
         cnn_model = None
 
     # multi-crop wrapper handles forward with inputs of different resolutions
+    assert not (args.shard_head and (config.MODEL.TWO_STREAM or config.MODEL.TWO_TOKEN)), \
+        "--shard_head only supports the single stream, single token DINOHead"
     if config.MODEL.TWO_STREAM or config.MODEL.TWO_TOKEN:
         student = utils.MultiCropWrapper(student, MultiDINOHead(
             embed_dim,
@@ -287,7 +320,8 @@ def train_svt(args):
             MultiDINOHead(embed_dim, args.out_dim, args.use_bn_in_head),
         )
     else:
-        student = utils.MultiCropWrapper(student, DINOHead(
+        head = ShardedDINOHead if args.shard_head else DINOHead
+        student = utils.MultiCropWrapper(student, head(
             embed_dim,
             args.out_dim,
             use_bn=args.use_bn_in_head,
@@ -295,7 +329,7 @@ def train_svt(args):
         ), vary_fr=config.DATA.RAND_FR)
         teacher = utils.MultiCropWrapper(
             teacher,
-            DINOHead(embed_dim, args.out_dim, args.use_bn_in_head),
+            head(embed_dim, args.out_dim, args.use_bn_in_head),
             vary_fr=config.DATA.RAND_FR
         )
 
@@ -313,6 +347,16 @@ def train_svt(args):
 
     # move networks to gpu
     student, teacher = student.cuda(), teacher.cuda()
+    if args.compile:
+        # the backbones only: the multi-crop grouping and the heads stay eager
+        compile_model(student.backbone, mode=args.compile_mode)
+        compile_model(teacher.backbone, mode=args.compile_mode)
+        print(f"Compiled the student and teacher backbones (mode: {args.compile_mode}).")
+    if args.shard_head:
+        # every rank holds a different shard of the last layer: DDP must neither broadcast nor average it
+        for model in (student, teacher):
+            nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(
+                model, [n for n, _ in model.named_parameters() if n.startswith("head.last_layer.")])
     # synchronize batch norms (if any)
     if utils.has_batchnorms(student):
         student = nn.SyncBatchNorm.convert_sync_batchnorm(student)
@@ -329,6 +373,10 @@ def train_svt(args):
     print(f"initialized teacher with student msg: {msg}")
     for p in teacher.parameters():
         p.requires_grad = False
+    teacher_master = None
+    if args.teacher_dtype != "fp32":
+        teacher_master = utils.TeacherMasterWeights(teacher, TEACHER_DTYPES[args.teacher_dtype])
+        print(f"Teacher runs in {args.teacher_dtype} with fp32 master weights for the EMA update.")
     print(f"Student and Teacher are built: they are both {args.arch} network.")
 
     if config.MODEL.TWO_STREAM:
@@ -351,16 +399,27 @@ def train_svt(args):
         motion_teacher_without_ddp = None
 
     # ============ preparing loss ... ============
-    dino_loss = DINOLoss(
-        args.out_dim,
-        args.local_crops_number + 2,  # total number of crops = 2 global crops + local_crops_number
-        args.warmup_teacher_temp,
-        args.teacher_temp,
-        args.warmup_teacher_temp_epochs,
-        args.epochs,
-        global_crops=2,
-        two_token=config.MODEL.TWO_TOKEN
-    ).cuda()
+    if args.shard_head:
+        dino_loss = ShardedDINOLoss(
+            args.out_dim,
+            args.local_crops_number + 2,  # total number of crops = 2 global crops + local_crops_number
+            args.warmup_teacher_temp,
+            args.teacher_temp,
+            args.warmup_teacher_temp_epochs,
+            args.epochs,
+            global_crops=2,
+        ).cuda()
+    else:
+        dino_loss = DINOLoss(
+            args.out_dim,
+            args.local_crops_number + 2,  # total number of crops = 2 global crops + local_crops_number
+            args.warmup_teacher_temp,
+            args.teacher_temp,
+            args.warmup_teacher_temp_epochs,
+            args.epochs,
+            global_crops=2,
+            two_token=config.MODEL.TWO_TOKEN
+        ).cuda()
 
     if config.MODEL.TWO_STREAM:
         dino_flow_loss = DINOLoss(args.out_dim, 2, args.warmup_teacher_temp,
@@ -378,12 +437,20 @@ def train_svt(args):
         params_groups[0]['params'] += motion_params_groups[0]['params']
         params_groups[1]['params'] += motion_params_groups[1]['params']
 
+    # the shards of --shard_head differ across GPUs, ZeRO assumes replicated parameters
+    assert not (args.zero_optimizer and args.shard_head), "--zero_optimizer does not support --shard_head"
     if args.optimizer == "adamw":
-        optimizer = torch.optim.AdamW(params_groups)  # to use with ViTs
+        optimizer = build_optimizer(params_groups, torch.optim.AdamW, shard=args.zero_optimizer)  # to use with ViTs
     elif args.optimizer == "sgd":
-        optimizer = torch.optim.SGD(params_groups, lr=0, momentum=0.9)  # lr is set by scheduler
+        # lr is set by scheduler
+        optimizer = build_optimizer(params_groups, torch.optim.SGD, shard=args.zero_optimizer, lr=0, momentum=0.9)
     elif args.optimizer == "lars":
-        optimizer = utils.LARS(params_groups)  # to use with convnet and large batches
+        # to use with convnet and large batches
+        optimizer = build_optimizer(params_groups, utils.LARS, shard=args.zero_optimizer)
+    if is_sharded(optimizer):
+        print(f"Optimizer state sharded across {utils.get_world_size()} GPUs.")
+    # the optimizer state of the head shards is gathered in the checkpoints, and sliced again on resume
+    optimizer_state = utils.ShardedParamsOptimizerState(optimizer) if args.shard_head else optimizer
     # for mixed precision training
     fp16_scaler = None
     if args.use_fp16:
@@ -412,11 +479,13 @@ def train_svt(args):
         os.path.join(args.output_dir, "checkpoint.pth"),
         run_variables=to_restore,
         student=student,
-        teacher=teacher,
-        optimizer=optimizer,
+        teacher=teacher if teacher_master is None else teacher_master,
+        optimizer=optimizer_state,
         fp16_scaler=fp16_scaler,
         dino_loss=dino_loss,
     )
+    if is_sharded(optimizer) and args.zero_checkpoint == "sharded":
+        restart_shard(optimizer, args.output_dir)
     start_epoch = to_restore["epoch"]
 
     start_time = time.time()
@@ -430,7 +499,8 @@ def train_svt(args):
                                       epoch, fp16_scaler, args, cfg=config,
                                       motion_loss=dino_flow_loss, cross_loss=dino_cross_loss,
                                       motion_student=motion_student, motion_teacher=motion_teacher,
-                                      motion_teacher_without_ddp=motion_teacher_without_ddp, rand_conv=rand_conv)
+                                      motion_teacher_without_ddp=motion_teacher_without_ddp, rand_conv=rand_conv,
+                                      teacher_master=teacher_master)
 
         # TODO: fix online evaluation for multi-gpu training
         # val_stats = eval_knn(eval_loader_train, eval_loader_test, teacher, eval_train, eval_test, opt=args)
@@ -438,10 +508,10 @@ def train_svt(args):
         # ============ writing logs ... ============
         save_dict = {
             'student': student.state_dict(),
-            'teacher': teacher.state_dict(),
+            'teacher': teacher.state_dict() if teacher_master is None else teacher_master.state_dict(),
             'motion_student': motion_student.state_dict() if motion_student is not None else 0,
             'motion_teacher': motion_teacher.state_dict() if motion_teacher is not None else 0,
-            'optimizer': optimizer.state_dict(),
+            'optimizer': optimizer_state_dict(optimizer_state, args.zero_checkpoint),
             'epoch': epoch + 1,
             'args': args,
             'dino_loss': dino_loss.state_dict(),
@@ -449,6 +519,8 @@ def train_svt(args):
         if fp16_scaler is not None:
             save_dict['fp16_scaler'] = fp16_scaler.state_dict()
         utils.save_on_master(save_dict, os.path.join(args.output_dir, 'checkpoint.pth'))
+        if is_sharded(optimizer) and args.zero_checkpoint == "sharded":
+            save_shard(optimizer, args.output_dir)
         if args.saveckp_freq and epoch % args.saveckp_freq == 0:
             utils.save_on_master(save_dict, os.path.join(args.output_dir, f'checkpoint{epoch:04}.pth'))
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
@@ -464,9 +536,12 @@ def train_svt(args):
 def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loader,
                     optimizer, lr_schedule, wd_schedule, momentum_schedule, epoch,
                     fp16_scaler, args, cfg=None, motion_teacher=None, motion_student=None,
-                    motion_loss=None, cross_loss=None, motion_teacher_without_ddp=None, rand_conv=None):
+                    motion_loss=None, cross_loss=None, motion_teacher_without_ddp=None, rand_conv=None,
+                    teacher_master=None):
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Epoch: [{}/{}]'.format(epoch, args.epochs)
+    # random token dropping only applies to the student, the teacher always sees all tokens
+    student_kwargs = {"token_keep_ratio": args.student_token_keep} if args.student_token_keep < 1 else {}
     for it, (images, _, _, meta) in enumerate(metric_logger.log_every(data_loader, 10, header)):
         # update weight decay and learning rate according to their schedule
         it = len(data_loader) * epoch + it  # global training iteration
@@ -492,7 +567,8 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
 
             if cfg.MODEL.TWO_STREAM:
                 student_output_rgb, student_output_flow = student(images)
-                teacher_output_rgb, _ = teacher(images[:2])  # only the 2 global views pass through the teacher
+                # only the 2 global views pass through the teacher
+                teacher_output_rgb, _ = teacher_forward(teacher, images[:2], args.teacher_dtype)
                 teacher_flow = motion_teacher(flow_images[:2])
                 student_flow = motion_student(flow_images)
 
@@ -501,14 +577,15 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
                        cross_loss(student_output_flow, teacher_flow, epoch)
             elif cfg.MODEL.TWO_TOKEN:
                 student_output = student(images[2:])  # 2 spatially local and 2 temporally global local views
-                teacher_output = teacher(images[:2])  # only 2 global views through the teacher
+                teacher_output = teacher_forward(teacher, images[:2], args.teacher_dtype)  # only 2 global views
                 loss = dino_loss(student_output, teacher_output, epoch)
             else:
-                student_output = student(images)
+                student_output = student(images, **student_kwargs)
                 if rand_conv is not None:
-                    teacher_output = teacher([images[0], rand_conv(images[1])])
+                    teacher_output = teacher_forward(teacher, [images[0], rand_conv(images[1])], args.teacher_dtype)
                 else:
-                    teacher_output = teacher(images[:2])  # only the 2 global views pass through the teacher
+                    # only the 2 global views pass through the teacher
+                    teacher_output = teacher_forward(teacher, images[:2], args.teacher_dtype)
                 loss = dino_loss(student_output, teacher_output, epoch)
 
         if not math.isfinite(loss.item()):
@@ -538,8 +615,14 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
         # EMA update for the teacher
         with torch.no_grad():
             m = momentum_schedule[it]  # momentum parameter
-            for param_q, param_k in zip(student.module.parameters(), teacher_without_ddp.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
+            if teacher_master is not None:
+                teacher_master.update(student.module.parameters(), m)
+            else:
+                for param_q, param_k in zip(student.module.parameters(), teacher_without_ddp.parameters()):
+                    param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
+            if isinstance(teacher_without_ddp.backbone, SwinTransformer3D):
+                # the .data writes above are invisible to the cache of the relative position biases
+                teacher_without_ddp.backbone.clear_bias_cache()
 
             if cfg.MODEL.TWO_STREAM:
                 for param_q, param_k in zip(motion_student.module.parameters(),
@@ -557,6 +640,19 @@ def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loade
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+def teacher_forward(teacher, crops, teacher_dtype="fp32"):
+    """
+    Teacher outputs in fp32. A bf16 / fp16 teacher runs under autocast to its own dtype.
+    """
+    if teacher_dtype == "fp32":
+        return teacher(crops)
+    with torch.cuda.amp.autocast(dtype=TEACHER_DTYPES[teacher_dtype]):
+        output = teacher(crops)
+    if isinstance(output, tuple):
+        return tuple(o.float() for o in output)
+    return output.float()
+
+
 def eval_knn(train_loader, test_loader, model, train_dataset, test_dataset, opt):
     # model.eval()  # teacher model already on eval
     print("Extracting features for train set...")
@@ -675,6 +771,93 @@ class DINOLoss(nn.Module):
             self.center = self.center * self.center_momentum + batch_center * (1 - self.center_momentum)
 
 
+class ShardedDINOLoss(DINOLoss):
+    """
+    DINOLoss on the outputs of ShardedDINOHead: every rank holds the logits of its out_dim / world_size
+    outputs for the crops of all the ranks. The softmax normalizers and the cross-entropy are reduced
+    across the ranks, and the center is sharded like the logits.
+    """
+    def __init__(self, out_dim, ncrops, warmup_teacher_temp, teacher_temp,
+                 warmup_teacher_temp_epochs, nepochs, student_temp=0.1,
+                 center_momentum=0.9, global_crops=2):
+        assert out_dim % utils.get_world_size() == 0, "out_dim must be divisible by the world size"
+        super().__init__(out_dim // utils.get_world_size(), ncrops, warmup_teacher_temp, teacher_temp,
+                         warmup_teacher_temp_epochs, nepochs, student_temp=student_temp,
+                         center_momentum=center_momentum, global_crops=global_crops)
+        utils.register_sharded_state(self, ["center"], dim=1)
+
+    def _by_crop(self, output, n_crops):
+        # rank-major (world_size x n_crops x B) rows -> n_crops x (world_size x B) rows
+        output = output.float().view(utils.get_world_size(), n_crops, -1, output.size(-1))
+        return output.transpose(0, 1).reshape(n_crops, -1, output.size(-1))
+
+    def forward(self, student_output, teacher_output, epoch):
+        """
+        Cross-entropy between softmax outputs of the teacher and student networks.
+        """
+        student_out = self._by_crop(student_output, self.n_crops) / self.student_temp
+        teacher_out = self._by_crop(teacher_output, self.global_crops)
+
+        # teacher centering and sharpening
+        temp = self.teacher_temp_schedule[epoch]
+        teacher_logits = (teacher_out.detach() - self.center) / temp
+        teacher_out = torch.exp(teacher_logits - sharded_logsumexp(teacher_logits).unsqueeze(-1))
+
+        # -sum(q * log_softmax(v)) = logsumexp(v) - sum(q * v) as sum(q) = 1
+        cross, normalizers, n_loss_terms = 0, 0, 0
+        student_lse = sharded_logsumexp(student_out)
+        for iq in range(self.global_crops):
+            for v in range(self.n_crops):
+                if v == iq:
+                    # we skip cases where student and teacher operate on the same view
+                    continue
+                cross += torch.sum(teacher_out[iq] * student_out[v], dim=-1).mean()
+                normalizers += student_lse[v].mean()
+                n_loss_terms += 1
+        total_loss = (normalizers - all_reduce_with_local_grad(cross)) / n_loss_terms
+        self.update_center(teacher_output.float())
+        return total_loss
+
+    @torch.no_grad()
+    def update_center(self, teacher_output):
+        """
+        Update center used for teacher output.
+        """
+        # the logits of the shard cover the crops of every rank already
+        batch_center = torch.mean(teacher_output, dim=0, keepdim=True)
+
+        # ema update
+        self.center = self.center * self.center_momentum + batch_center * (1 - self.center_momentum)
+
+
+def all_reduce_with_local_grad(x):
+    """
+    Sum of `x` over the ranks, with the gradient of the local `x`: the terms of the other ranks depend on
+    their own shards only.
+    """
+    if utils.get_world_size() == 1:
+        return x
+    total = x.detach().clone()
+    dist.all_reduce(total)
+    return total + x - x.detach()
+
+
+def sharded_logsumexp(x):
+    """
+    logsumexp over the last dimension sharded across the ranks. Its gradient w.r.t. the local shard is
+    the softmax over the full dimension restricted to the shard.
+    """
+    max_logit = x.detach().max(dim=-1, keepdim=True).values
+    if utils.get_world_size() > 1:
+        dist.all_reduce(max_logit, op=dist.ReduceOp.MAX)
+    local_sum = torch.sum(torch.exp(x - max_logit), dim=-1)
+    total_sum = local_sum.detach().clone()
+    if utils.get_world_size() > 1:
+        dist.all_reduce(total_sum)
+    lse = max_logit.squeeze(-1) + torch.log(total_sum)
+    return lse + local_sum / total_sum - (local_sum / total_sum).detach()
+
+
 class DataAugmentationDINO(object):
     def __init__(self, global_crops_scale, local_crops_scale, local_crops_number):
         flip_and_color_jitter = transforms.Compose([
@@ -0,0 +1,245 @@
+"""Approximate nearest-neighbor search (IVF + product quantization) in torch."""
+
+import torch
+
+
+def kmeans(x, num_centroids, niter=20, seed=0, spherical=False, chunk_size=65536):
+    """
+    Lloyd's k-means on the rows of `x`.
+    Args:
+        x (tensor): N x D training vectors.
+        num_centroids (int): number of clusters.
+        niter (int): number of Lloyd iterations.
+        seed (int): seed of the random initialization.
+        spherical (bool): if True, assign by inner product and keep the
+            centroids on the unit sphere (for L2 normalized features).
+        chunk_size (int): number of rows assigned at once, bounds the size of
+            the N x K distance matrix.
+    Returns:
+        centroids (tensor): num_centroids x D cluster centers.
+    """
+    n = x.size(0)
+    assert n >= num_centroids, "need at least {} points to train {} centroids, got {}".format(
+        num_centroids, num_centroids, n
+    )
+    generator = torch.Generator().manual_seed(seed)
+    perm = torch.randperm(n, generator=generator)[:num_centroids].to(x.device)
+    centroids = x[perm].clone()
+    for _ in range(niter):
+        assign = assign_to_centroids(x, centroids, spherical, chunk_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=num_centroids).to(x.dtype)
+        # re-seed empty clusters with random points
+        empty = counts == 0
+        if empty.any():
+            reseed = torch.randint(n, (int(empty.sum()),), generator=generator).to(x.device)
+            sums[empty] = x[reseed]
+            counts[empty] = 1
+        centroids = sums / counts.unsqueeze(1)
+        if spherical:
+            centroids = torch.nn.functional.normalize(centroids, dim=1, p=2)
+    return centroids
+
+
+def assign_to_centroids(x, centroids, spherical=False, chunk_size=65536):
+    """
+    Return the index of the closest centroid (max inner product if spherical,
+    min L2 distance otherwise) for every row of `x`.
+    """
+    assign = []
+    c_norm = (centroids * centroids).sum(1)
+    for idx in range(0, x.size(0), chunk_size):
+        chunk = x[idx: idx + chunk_size]
+        scores = chunk @ centroids.t()
+        if not spherical:
+            # argmin ||x - c||^2 == argmax 2 x.c - ||c||^2
+            scores = 2 * scores - c_norm
+        assign.append(scores.argmax(1))
+    return torch.cat(assign)
+
+
+class IVFPQIndex(object):
+    """
+    Inverted file index with product quantized residuals for inner product
+    search on L2 normalized features. Database vectors are assigned to one of
+    `nlist` coarse centroids and their residual to that centroid is encoded
+    with `m` sub-quantizers of 2 ** nbits centroids each. A query only scans
+    the `nprobe` lists whose coarse centroids score highest, and the score of
+    every scanned code is q.c + sum_m LUT[m, code_m] with a per-query lookup
+    table, so the database features never have to be decompressed.
+    """
+
+    def __init__(self, dim, nlist=1024, m=64, nbits=8, niter=20, seed=0):
+        """
+        Args:
+            dim (int): feature dimension.
+            nlist (int): number of inverted lists (coarse centroids).
+            m (int): number of sub-quantizers, must divide `dim`.
+            nbits (int): bits per sub-quantizer code (at most 8).
+            niter (int): k-means iterations used in training.
+            seed (int): seed used by k-means.
+        """
+        assert dim % m == 0, "feature dim {} is not divisible by m={}".format(dim, m)
+        assert nbits <= 8, "codes are stored as uint8, nbits must be <= 8"
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.ksub = 2 ** nbits
+        self.dsub = dim // m
+        self.niter = niter
+        self.seed = seed
+
+        self.coarse_centroids = None  # nlist x dim
+        self.codebooks = None  # m x ksub x dsub
+        self.codes = None  # ntotal x m (uint8), sorted by list
+        self.ids = None  # ntotal, database row of every code
+        self.list_offsets = None  # nlist + 1, codes of list l are [offsets[l], offsets[l + 1])
+
+    @property
+    def is_trained(self):
+        return self.coarse_centroids is not None and self.codebooks is not None
+
+    @property
+    def ntotal(self):
+        return 0 if self.ids is None else self.ids.numel()
+
+    def config(self):
+        return {"dim": self.dim, "nlist": self.nlist, "m": self.m, "nbits": self.nbits}
+
+    def to(self, device):
+        for name in ["coarse_centroids", "codebooks", "codes", "ids", "list_offsets"]:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.to(device))
+        return self
+
+    def train(self, x, max_points_per_centroid=256):
+        """
+        Learn the coarse centroids and the residual codebooks.
+        Args:
+            x (tensor): N x dim training vectors (a random subset is used if
+                N is larger than max_points_per_centroid * number of centroids).
+        """
+        x = x.float()
+        generator = torch.Generator().manual_seed(self.seed)
+        max_coarse = max_points_per_centroid * self.nlist
+        if x.size(0) > max_coarse:
+            x = x[torch.randperm(x.size(0), generator=generator)[:max_coarse].to(x.device)]
+        self.coarse_centroids = kmeans(x, self.nlist, self.niter, self.seed, spherical=True)
+
+        residuals = x - self.coarse_centroids[assign_to_centroids(x, self.coarse_centroids, spherical=True)]
+        max_pq = max_points_per_centroid * self.ksub
+        if residuals.size(0) > max_pq:
+            residuals = residuals[torch.randperm(residuals.size(0), generator=generator)[:max_pq].to(x.device)]
+        residuals = residuals.view(-1, self.m, self.dsub)
+        self.codebooks = torch.stack([
+            kmeans(residuals[:, i].contiguous(), self.ksub, self.niter, self.seed + i) for i in range(self.m)
+        ])
+        return self
+
+    def encode(self, x, assign):
+        """
+        PQ-encode the residuals of `x` to their assigned coarse centroids.
+        Returns:
+            codes (tensor): N x m uint8 codes.
+        """
+        residuals = (x - self.coarse_centroids[assign]).view(-1, self.m, self.dsub)
+        codes = torch.stack([
+            assign_to_centroids(residuals[:, i].contiguous(), self.codebooks[i]) for i in range(self.m)
+        ], dim=1)
+        return codes.to(torch.uint8)
+
+    def add(self, x, chunk_size=65536):
+        """
+        Add database vectors; their ids are their row indices in `x`.
+        """
+        assert self.is_trained, "the index must be trained before adding vectors"
+        x = x.float()
+        assign, codes = [], []
+        for idx in range(0, x.size(0), chunk_size):
+            chunk = x[idx: idx + chunk_size]
+            chunk_assign = assign_to_centroids(chunk, self.coarse_centroids, spherical=True)
+            assign.append(chunk_assign)
+            codes.append(self.encode(chunk, chunk_assign))
+        assign = torch.cat(assign)
+        order = torch.argsort(assign)
+        self.codes = torch.cat(codes)[order]
+        self.ids = order
+        counts = torch.bincount(assign, minlength=self.nlist)
+        self.list_offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)])
+        return self
+
+    @torch.no_grad()
+    def search(self, queries, k, nprobe=8):
+        """
+        Approximate top-k inner product search.
+        Args:
+            queries (tensor): Q x dim query vectors.
+            k (int): number of neighbors.
+            nprobe (int): number of inverted lists scanned per query.
+        Returns:
+            distances (tensor): Q x k approximate inner products, sorted.
+            indices (tensor): Q x k database ids (-1 if fewer than k
+                candidates were scanned).
+        """
+        queries = queries.float()
+        nq = queries.size(0)
+        nprobe = min(nprobe, self.nlist)
+        coarse_scores = queries @ self.coarse_centroids.t()
+        _, probes = coarse_scores.topk(nprobe, dim=1)
+        # Q x m x ksub lookup table of query / codeword inner products
+        lut = torch.einsum("qmd,mkd->qmk", queries.view(nq, self.m, self.dsub), self.codebooks)
+
+        best_scores = queries.new_full((nq, k), float("-inf"))
+        best_ids = torch.full((nq, k), -1, dtype=torch.long, device=queries.device)
+        offsets = self.list_offsets.tolist()
+        # scan list by list: every query probing list l is scored against all its codes at once
+        probed_lists = torch.unique(probes).tolist()
+        for list_id in probed_lists:
+            start, end = offsets[list_id], offsets[list_id + 1]
+            if start == end:
+                continue
+            query_idx = (probes == list_id).any(dim=1).nonzero(as_tuple=False).squeeze(1)
+            codes = self.codes[start:end].long().t()  # m x n_list
+            list_lut = lut[query_idx]  # q_l x m x ksub
+            scores = torch.gather(list_lut, 2, codes.unsqueeze(0).expand(query_idx.numel(), -1, -1)).sum(1)
+            scores += coarse_scores[query_idx, list_id].unsqueeze(1)
+            ids = self.ids[start:end].unsqueeze(0).expand(query_idx.numel(), -1)
+
+            merged_scores = torch.cat([best_scores[query_idx], scores], dim=1)
+            merged_ids = torch.cat([best_ids[query_idx], ids], dim=1)
+            top_scores, top_pos = merged_scores.topk(k, dim=1)
+            best_scores[query_idx] = top_scores
+            best_ids[query_idx] = torch.gather(merged_ids, 1, top_pos)
+        return best_scores, best_ids
+
+    def save(self, path):
+        torch.save({
+            "config": self.config(),
+            "niter": self.niter,
+            "seed": self.seed,
+            "coarse_centroids": self.coarse_centroids.cpu(),
+            "codebooks": self.codebooks.cpu(),
+            "codes": self.codes.cpu(),
+            "ids": self.ids.cpu(),
+            "list_offsets": self.list_offsets.cpu(),
+        }, path)
+
+    @classmethod
+    def load(cls, path, map_location="cpu"):
+        state = torch.load(path, map_location=map_location)
+        index = cls(niter=state["niter"], seed=state["seed"], **state["config"])
+        for name in ["coarse_centroids", "codebooks", "codes", "ids", "list_offsets"]:
+            setattr(index, name, state[name])
+        return index
+
+
+def recall_at_k(approx_indices, exact_indices):
+    """
+    Fraction of the exact top-k neighbors that the approximate search found,
+    averaged over queries.
+    """
+    k = exact_indices.size(1)
+    hits = (approx_indices[:, :k].unsqueeze(2) == exact_indices.unsqueeze(1)).any(dim=1)
+    return hits.float().sum(1).div(k).mean().item()
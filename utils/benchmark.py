@@ -0,0 +1,57 @@
+"""Throughput and latency measurement helpers."""
+
+import time
+
+import torch
+
+
+@torch.no_grad()
+def measure_throughput(model, input_shape, batch_size=8, num_iters=20, warmup=5, device="cuda", dtype=None):
+    """
+    Measure the inference throughput of `model` on random clips.
+    Args:
+        model (nn.Module): model in eval mode.
+        input_shape (tuple): shape of one clip, e.g. (3, 8, 224, 224).
+        batch_size (int): number of clips per forward pass.
+        num_iters (int): number of timed forward passes.
+        warmup (int): number of untimed forward passes run first.
+        device (str): device of the inputs.
+        dtype (torch.dtype): dtype of the inputs, the default dtype if None.
+    Returns:
+        stats (dict): clips per second and mean latency per batch in ms.
+    """
+    inputs = torch.randn((batch_size,) + tuple(input_shape), device=device, dtype=dtype)
+    for _ in range(warmup):
+        model(inputs)
+    synchronize(device)
+    start_time = time.time()
+    for _ in range(num_iters):
+        model(inputs)
+    synchronize(device)
+    elapsed = time.time() - start_time
+    return {
+        "clips_per_sec": batch_size * num_iters / elapsed,
+        "latency_ms": 1000 * elapsed / num_iters,
+    }
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def measure_peak_memory(model, input_shape, batch_size=8, device="cuda", backward=True):
+    """
+    Peak CUDA memory (MB) allocated by one forward (and backward) pass of `model` on random clips,
+    on top of what is allocated before the pass.
+    """
+    inputs = torch.randn((batch_size,) + tuple(input_shape), device=device)
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start_mem = torch.cuda.memory_allocated()
+    with torch.set_grad_enabled(backward):
+        out = model(inputs)
+        if backward:
+            out.float().sum().backward()
+    torch.cuda.synchronize()
+    return (torch.cuda.max_memory_allocated() - start_mem) / 2 ** 20
@@ -0,0 +1,26 @@
+"""torch.compile helpers with an eager fallback."""
+
+import warnings
+
+import torch
+
+
+def compile_model(model, mode="default", dynamic=False, fallback=True):
+    """
+    Compile the forward of `model` in place, so its state dict keys and its parameters (e.g. for the EMA
+    teacher update) are unchanged. With dynamic=False one graph is compiled per input shape, i.e. one per
+    crop bucket of MultiCropWrapper (global crops, local crops). With fallback, graphs that fail to compile
+    run eagerly instead of raising, and torch versions without torch.compile keep the eager model.
+    """
+    if not hasattr(torch, "compile"):
+        warnings.warn("torch.compile is not available in torch {}, running eagerly".format(torch.__version__))
+        return model
+    import torch._dynamo
+    torch._dynamo.config.suppress_errors = fallback
+    # one graph per crop bucket and per train / eval mode, with headroom for smaller last batches
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 32)
+    if hasattr(model, "compile"):
+        model.compile(mode=mode, dynamic=dynamic)
+    else:
+        model.forward = torch.compile(model.forward, mode=mode, dynamic=dynamic)
+    return model
@@ -258,6 +258,45 @@ _C.TIMESFORMER = CfgNode()
 _C.TIMESFORMER.ATTENTION_TYPE = 'divided_space_time'
 _C.TIMESFORMER.PRETRAINED_MODEL = ''
 
+# If True, stochastic depth runs the residual branches only on the kept rows
+# of the batch instead of zeroing the dropped ones after computing them.
+_C.TIMESFORMER.DROP_PATH_SKIP_COMPUTE = False
+
+# Number of consecutive frames embedded by one token (3D patch embedding with
+# this temporal stride). 1 embeds every frame independently with a 2D conv.
+_C.TIMESFORMER.TUBELET_SIZE = 1
+
+# If True, divided space-time blocks keep the (h w t) token layout and write the
+# per-frame spatial sequences once, instead of rearranging and concatenating the
+# tokens several times per block. Outputs are unchanged.
+_C.TIMESFORMER.LAYOUT_STABLE_BLOCK = False
+
+# Number of consecutive frames temporal attention attends over (0: all frames).
+# Odd blocks attend over the frames strided by the window instead, so that two
+# blocks mix all frames at sub-quadratic cost in the number of frames.
+_C.TIMESFORMER.TEMPORAL_WINDOW = 0
+
+# Interpolation of the time embeddings for clips longer or shorter than the
+# pretrained ones ('nearest' or 'linear').
+_C.TIMESFORMER.TIME_EMBED_INTERP = 'nearest'
+
+####### Distillation of a pretrained SVT teacher into a smaller student (train_distill.py)
+_C.DISTILL = CfgNode()
+
+# Divided space-time student: width, depth and heads (vit_small by default).
+_C.DISTILL.EMBED_DIM = 384
+_C.DISTILL.DEPTH = 12
+_C.DISTILL.NUM_HEADS = 6
+
+# Number of frames of the student clips, uniformly strided from the
+# DATA.NUM_FRAMES frames of the teacher clips.
+_C.DISTILL.NUM_FRAMES = 4
+
+# Weights of the feature target (cosine distance between the projected student
+# and the teacher backbone features) and of the DINO-head target.
+_C.DISTILL.FEATURE_WEIGHT = 1.0
+_C.DISTILL.HEAD_WEIGHT = 1.0
+
 # Second model
 _C.MODEL.TWO_STREAM = False
 _C.MODEL.TWO_TOKEN = False
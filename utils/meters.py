@@ -6,6 +6,7 @@ import datetime
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from fvcore.common.timer import Timer
 from sklearn.metrics import average_precision_score
 
@@ -94,27 +95,63 @@ class TestMeter(object):
             clip_ids (tensor): clip indexes of the current batch, dimension is
                 N.
         """
-        for ind in range(preds.shape[0]):
-            vid_id = int(clip_ids[ind]) // self.num_clips
-            if self.video_labels[vid_id].sum() > 0:
-                assert torch.equal(
-                    self.video_labels[vid_id].type(torch.FloatTensor),
-                    labels[ind].type(torch.FloatTensor),
+        if self.ensemble_method not in ("sum", "max"):
+            raise NotImplementedError(
+                "Ensemble Method {} is not supported".format(
+                    self.ensemble_method
                 )
-            self.video_labels[vid_id] = labels[ind]
-            if self.ensemble_method == "sum":
-                self.video_preds[vid_id] += preds[ind]
-            elif self.ensemble_method == "max":
-                self.video_preds[vid_id] = torch.max(
-                    self.video_preds[vid_id], preds[ind]
-                )
-            else:
-                raise NotImplementedError(
-                    "Ensemble Method {} is not supported".format(
-                        self.ensemble_method
-                    )
-                )
-            self.clip_count[vid_id] += 1
+            )
+        preds = preds.to(self.video_preds)
+        labels = labels.to(self.video_labels)
+        vid_ids = clip_ids.long().cpu() // self.num_clips
+        seen = self.clip_count[vid_ids] > 0
+        if seen.any():
+            assert torch.equal(
+                self.video_labels[vid_ids[seen]].type(torch.FloatTensor),
+                labels[seen].type(torch.FloatTensor),
+            )
+        self.video_labels[vid_ids] = labels
+        if self.ensemble_method == "sum":
+            self.video_preds.index_add_(0, vid_ids, preds)
+        else:
+            self.video_preds.scatter_reduce_(
+                0,
+                vid_ids.view(-1, 1).expand_as(preds),
+                preds,
+                reduce="amax",
+                include_self=True,
+            )
+        self.clip_count.index_add_(
+            0, vid_ids, torch.ones_like(vid_ids)
+        )
+
+    def synchronize_between_processes(self):
+        """
+        Merge the partial ensembles of all processes, each of which only saw
+        the clips of its own shard of the dataset. Called once by
+        finalize_metrics; a no-op when not running distributed.
+        """
+        if not dist.is_available() or not dist.is_initialized():
+            return
+        device = (
+            torch.device("cuda", torch.cuda.current_device())
+            if dist.get_backend() == "nccl"
+            else torch.device("cpu")
+        )
+        preds_op = (
+            dist.ReduceOp.SUM
+            if self.ensemble_method == "sum"
+            else dist.ReduceOp.MAX
+        )
+        for name, op in [
+            ("video_preds", preds_op),
+            # labels are non-negative and identical wherever a video was seen
+            ("video_labels", dist.ReduceOp.MAX),
+            ("clip_count", dist.ReduceOp.SUM),
+        ]:
+            tensor = getattr(self, name).to(device)
+            dist.all_reduce(tensor, op=op)
+            setattr(self, name, tensor.cpu())
 
     def log_iter_stats(self, cur_iter):
         """
@@ -150,12 +187,16 @@ class TestMeter(object):
         self.data_timer.pause()
         self.net_timer.reset()
 
-    def finalize_metrics(self, ks=(1, 5)):
+    def finalize_metrics(self, ks=(1, 5), synchronize=True):
         """
         Calculate and log the final ensembled metrics.
         ks (tuple): list of top-k values for topk_accuracies. For example,
             ks = (1, 5) correspods to top-1 and top-5 accuracy.
+        synchronize (bool): merge the ensembles of all processes first; False
+            when this process evaluated the full dataset on its own.
         """
+        if synchronize:
+            self.synchronize_between_processes()
         if not all(self.clip_count == self.num_clips):
             logger.warning(
                 "clip count {} ~= num clips {}".format(
@@ -0,0 +1,121 @@
+"""Dynamic batching and latency counters of the embedding service (serve_embeddings.py)."""
+
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class LatencyStats(object):
+    """
+    Thread-safe latency counters: p50 / p99 over the last `window` requests, request and clip totals and
+    throughput since the start (or the last reset).
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+            self.counts = collections.Counter()
+            self.start_time = time.time()
+
+    def add(self, name, latency):
+        with self.lock:
+            self.latencies[name].append(latency)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            stats = {"uptime_s": elapsed}
+            for name, n in self.counts.items():
+                stats[name] = n
+                stats[name + "_per_sec"] = n / elapsed
+            for name, latencies in self.latencies.items():
+                if latencies:
+                    latencies = np.asarray(latencies) * 1000
+                    stats[name + "_p50_ms"] = float(np.percentile(latencies, 50))
+                    stats[name + "_p99_ms"] = float(np.percentile(latencies, 99))
+            return stats
+
+
+class DynamicBatcher(object):
+    """
+    Runs `model` on clips submitted from any thread, batched together: a batch is run as soon as
+    `max_batch_size` clips are queued, or `max_wait_ms` after its first clip arrived, whichever comes
+    first. Clips of a batch must have the same shape. submit() returns a Future of the l2-normalized
+    embedding of the clip.
+    """
+
+    def __init__(self, model, max_batch_size=16, max_wait_ms=10, device="cuda", fp16=True, stats=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.device = device
+        self.use_amp = fp16 and torch.device(device).type == "cuda"
+        self.stats = stats if stats is not None else LatencyStats()
+        self.queue = queue.Queue()
+        self.pending = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, clip):
+        future = Future()
+        self.queue.put((clip, future, time.time()))
+        return future
+
+    def _next_batch(self):
+        # a request that did not fit the shape of the previous batch starts the next one
+        first = self.pending if self.pending is not None else self.queue.get()
+        self.pending = None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item[0].shape != first[0].shape:
+                self.pending = item
+                break
+            batch.append(item)
+        return batch
+
+    @torch.no_grad()
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start_time = time.time()
+            try:
+                clips = torch.stack([clip for clip, _, _ in batch]).to(self.device, non_blocking=True)
+                with torch.cuda.amp.autocast(enabled=self.use_amp):
+                    features = self.model(clips)
+                if isinstance(features, tuple):
+                    features = torch.cat(features, dim=1)
+                features = nn.functional.normalize(features.float(), dim=-1).cpu().numpy()
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end_time = time.time()
+            self.stats.add("batch", end_time - start_time)
+            self.stats.count("batches")
+            self.stats.count("clips", len(batch))
+            for (_, future, submit_time), feature in zip(batch, features):
+                self.stats.add("queue", start_time - submit_time)
+                future.set_result(feature)
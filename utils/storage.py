@@ -0,0 +1,71 @@
+"""On-disk storage of features."""
+
+import struct
+
+import numpy as np
+
+
+class IncrementalNpyWriter(object):
+    """
+    Append rows to an .npy file as they are produced, without knowing their number in advance.
+    The header has a fixed size and is rewritten with the current row count on flush and close,
+    so the file can be read back with np.load(path, mmap_mode="r") at any of these points.
+    With append=True, rows are added to a file previously written by this class.
+    """
+    HEADER_SIZE = 128
+
+    def __init__(self, path, dim=None, dtype=np.float32, append=False):
+        self.dtype = np.dtype(dtype)
+        self.dim = dim
+        if append:
+            rows = np.load(path, mmap_mode="r")
+            assert rows.dtype == self.dtype and rows.shape[1:] == self.shape_suffix, \
+                "cannot append to {} with dtype {} and shape {}".format(path, rows.dtype, rows.shape)
+            self.rows = rows.shape[0]
+            del rows
+            self.file = open(path, "r+b")
+        else:
+            self.rows = 0
+            self.file = open(path, "w+b")
+        self._write_header()
+
+    @property
+    def shape_suffix(self):
+        return () if self.dim is None else (self.dim,)
+
+    def _write_header(self):
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.rows,) + self.shape_suffix,
+        }).encode("latin1")
+        magic = np.lib.format.magic(1, 0)
+        header_len = self.HEADER_SIZE - len(magic) - 2
+        assert len(header) < header_len
+        self.file.seek(0)
+        self.file.write(magic + struct.pack("<H", header_len) + header.ljust(header_len - 1) + b"\n")
+        # rows follow the header
+        self.file.seek(self.HEADER_SIZE + self.rows * self.row_bytes)
+
+    @property
+    def row_bytes(self):
+        return self.dtype.itemsize * (self.dim or 1)
+
+    def write(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.shape_suffix)
+        self.file.write(rows.tobytes())
+        self.rows += rows.shape[0]
+
+    def flush(self):
+        self._write_header()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -25,6 +25,7 @@ import random
 import datetime
 import subprocess
 from collections import defaultdict, deque
+from contextlib import contextmanager
 
 import numpy as np
 import torch
@@ -104,6 +105,11 @@ def clip_gradients(model, clip):
     for name, p in model.named_parameters():
         if p.grad is not None:
             param_norm = p.grad.data.norm(2)
+            if _is_shard(p):
+                # clip a parameter sharded across the ranks by the norm of its full gradient
+                param_norm = param_norm.pow(2)
+                dist.all_reduce(param_norm)
+                param_norm = param_norm.sqrt()
             norms.append(param_norm.item())
             clip_coef = clip / (param_norm + 1e-6)
             if clip_coef < 1:
@@ -133,8 +139,9 @@ def restart_from_checkpoint(ckp_path, run_variables=None, **kwargs):
     # key is what to look for in the checkpoint file
     # value is the object to load
     # example: {'state_dict': model}
+    # entries saved as None (e.g. an optimizer state saved per rank) are not loaded
     for key, value in kwargs.items():
-        if key in checkpoint and value is not None:
+        if key in checkpoint and checkpoint[key] is not None and value is not None:
             try:
                 msg = value.load_state_dict(checkpoint[key], strict=False)
                 print("=> loaded '{}' from checkpoint '{}' with msg {}".format(key, ckp_path, msg))
@@ -410,6 +417,111 @@ def get_rank():
     return dist.get_rank()
 
 
+class _GatherFromRanks(torch.autograd.Function):
+    """
+    all_gather of equally sized tensors along dim 0, in rank order. The backward sums the gradients of
+    every rank and keeps the slice of this rank, multiplied by the world size to cancel the gradient
+    averaging of DDP on the replicated parameters before the gather.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        gathered = [torch.empty_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, x.contiguous())
+        return torch.cat(gathered)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous()
+        dist.all_reduce(grad)
+        return grad.chunk(dist.get_world_size())[dist.get_rank()] * dist.get_world_size()
+
+
+def gather_from_ranks(x):
+    """
+    Concatenation of `x` of every rank along dim 0 (differentiable), `x` itself without distributed training.
+    """
+    if get_world_size() == 1:
+        return x
+    return _GatherFromRanks.apply(x)
+
+
+def register_sharded_state(module, names, dim=0):
+    """
+    Keep the tensors `names` of `module` (e.g. "last_layer.weight_v"), sharded along `dim` across the ranks,
+    whole in its state dicts: state_dict() gathers the shards, a collective to call on every rank, and
+    load_state_dict() takes full tensors (or shards of the right size) and keeps the shard of the rank.
+    """
+    def gather_hook(module, state_dict, prefix, local_metadata):
+        if get_world_size() == 1:
+            return
+        for name in names:
+            shard = state_dict[prefix + name].contiguous()
+            shards = [torch.empty_like(shard) for _ in range(get_world_size())]
+            dist.all_gather(shards, shard)
+            state_dict[prefix + name] = torch.cat(shards, dim=dim)
+
+    def shard_hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        for name in names:
+            key = prefix + name
+            if key in state_dict and state_dict[key].size(dim) == _get_tensor(module, name).size(dim) * get_world_size():
+                state_dict[key] = state_dict[key].chunk(get_world_size(), dim=dim)[get_rank()]
+
+    for name in names:
+        # read by clip_gradients and ShardedParamsOptimizerState
+        _get_tensor(module, name)._shard_dim = dim
+    module._register_state_dict_hook(gather_hook)
+    module._register_load_state_dict_pre_hook(shard_hook)
+
+
+def _get_tensor(module, name):
+    parent, _, attr = name.rpartition(".")
+    return getattr(module.get_submodule(parent), attr)
+
+
+def _is_shard(p):
+    return getattr(p, "_shard_dim", None) is not None and get_world_size() > 1
+
+
+class ShardedParamsOptimizerState(object):
+    """
+    State dict of an optimizer over parameters some of which are sharded across the ranks (see
+    register_sharded_state). state_dict() gathers the per-parameter state of the shards (e.g. the AdamW
+    moments) along the shard dim, a collective to call on every rank, and load_state_dict() takes the
+    full tensors and keeps the slice of the rank, so a checkpoint saved by rank 0 resumes every rank.
+    """
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+
+    def _shards(self):
+        params = [p for group in self.optimizer.param_groups for p in group["params"]]
+        return [(i, p) for i, p in enumerate(params) if _is_shard(p)]
+
+    def state_dict(self):
+        state_dict = self.optimizer.state_dict()
+        # the per-parameter dicts of optimizer.state_dict() are the live ones, replace them by copies
+        state = dict(state_dict["state"])
+        for i, p in self._shards():
+            param_state = dict(state.get(i, {}))
+            for k, v in param_state.items():
+                if torch.is_tensor(v) and v.shape == p.shape:
+                    shards = [torch.empty_like(v) for _ in range(get_world_size())]
+                    dist.all_gather(shards, v.contiguous())
+                    param_state[k] = torch.cat(shards, dim=p._shard_dim)
+            state[i] = param_state
+        return {**state_dict, "state": state}
+
+    def load_state_dict(self, state_dict):
+        state = dict(state_dict["state"])
+        for i, p in self._shards():
+            param_state = dict(state.get(i, {}))
+            for k, v in param_state.items():
+                if torch.is_tensor(v) and v.dim() == p.dim() and \
+                        v.size(p._shard_dim) == p.size(p._shard_dim) * get_world_size():
+                    param_state[k] = v.chunk(get_world_size(), dim=p._shard_dim)[get_rank()]
+            state[i] = param_state
+        self.optimizer.load_state_dict({**state_dict, "state": state})
+
+
 def is_main_process():
     return get_rank() == 0
 
@@ -561,6 +673,24 @@ class LARS(torch.optim.Optimizer):
                 p.add_(mu, alpha=-g['lr'])
 
 
+class DistributedEvalSampler(torch.utils.data.Sampler):
+    """
+    Shard a dataset across processes for evaluation: rank r gets the indices
+    r, r + world_size, ... in order. Unlike DistributedSampler, the shards are
+    not padded to the same length, so every sample is seen exactly once.
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.dataset = dataset
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+
 class MultiCropWrapper(nn.Module):
     """
     Perform forward pass separately on each resolution input.
@@ -579,7 +709,7 @@ class MultiCropWrapper(nn.Module):
         self.head = head
         self.vary_fr = vary_fr
 
-    def forward(self, x, **kwargs):
+    def forward(self, x, return_backbone_feat=False, **kwargs):
         # convert to list
         if not isinstance(x, list):
             x = [x]
@@ -606,9 +736,66 @@ class MultiCropWrapper(nn.Module):
                     output = torch.cat((output, _out))
             start_idx = end_idx
         # Run the head forward on the concatenated features.
+        if return_backbone_feat:
+            return output, self.head(output)
         return self.head(output)
 
 
+class TeacherMasterWeights(object):
+    """
+    EMA teacher kept in two copies: its parameters are cast to `dtype` (bf16 / fp16) for the forward
+    passes, and an fp32 master copy of them, one flat buffer, receives the EMA updates and is copied back
+    into the low precision parameters after every momentum step. Buffers are left untouched.
+    state_dict / load_state_dict use the fp32 master weights with the keys of teacher.state_dict(), so
+    checkpoints are the same as with an fp32 teacher.
+    """
+    def __init__(self, teacher, dtype):
+        self.teacher = teacher
+        self.params = list(teacher.parameters())
+        self.master = torch.cat([p.detach().float().reshape(-1) for p in self.params])
+        self.master_views = [v.view_as(p) for v, p in zip(self.master.split([p.numel() for p in self.params]),
+                                                         self.params)]
+        for p in self.params:
+            p.data = p.data.to(dtype)
+
+    @torch.no_grad()
+    def update(self, student_params, m):
+        """
+        EMA step master = m * master + (1 - m) * student, then synchronization of the teacher parameters.
+        """
+        torch._foreach_mul_(self.master_views, m)
+        torch._foreach_add_(self.master_views, [p.detach().float() for p in student_params], alpha=1 - m)
+        self.sync()
+
+    @torch.no_grad()
+    def sync(self):
+        for p, master in zip(self.params, self.master_views):
+            p.copy_(master)
+
+    @contextmanager
+    def _master_data(self):
+        # the teacher parameters temporarily point to the fp32 master views, e.g. for its state dict hooks
+        low_precision = [p.data for p in self.params]
+        for p, master in zip(self.params, self.master_views):
+            p.data = master
+        try:
+            yield
+        finally:
+            for p, data in zip(self.params, low_precision):
+                p.data = data
+
+    def state_dict(self):
+        with self._master_data():
+            return self.teacher.state_dict()
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict, strict=True):
+        with self._master_data():
+            msg = self.teacher.load_state_dict(state_dict, strict=strict)
+        self.sync()
+        return msg
+
+
 def get_params_groups(model):
     regularized = []
     not_regularized = []
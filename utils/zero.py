@@ -0,0 +1,149 @@
+"""
+ZeRO-1 style sharding of the optimizer state across the ranks for train_ssl.py.
+
+Each rank keeps the optimizer state (e.g. the AdamW moments) of a partition of the parameters only, steps
+that partition and broadcasts the updated parameters (torch ZeroRedundancyOptimizer); the gradients are
+still all-reduced by DDP. Checkpoints hold either the consolidated optimizer state dict, gathered on rank 0
+and loadable by the plain optimizer, or one file per rank with its partition.
+
+Smoke test on CPU (2 gloo processes): python -m utils.zero
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+from utils import utils
+
+CHECKPOINT_MODES = ("consolidated", "sharded")
+
+
+def build_optimizer(params_groups, optimizer_class, shard=False, **kwargs):
+    """
+    `optimizer_class`(params_groups, **kwargs), with its state sharded across the ranks if `shard`.
+    """
+    if shard and utils.get_world_size() > 1:
+        return ZeroRedundancyOptimizer(params_groups, optimizer_class=optimizer_class, **kwargs)
+    return optimizer_class(params_groups, **kwargs)
+
+
+def is_sharded(optimizer):
+    return isinstance(optimizer, ZeroRedundancyOptimizer)
+
+
+def optimizer_state_dict(optimizer, mode="consolidated"):
+    """
+    Optimizer entry of checkpoint.pth, to call on every rank. For a sharded optimizer it is the state dict
+    consolidated on rank 0 (None on the other ranks), or None with the sharded mode: the partitions are
+    saved by save_shard.
+    """
+    if not is_sharded(optimizer):
+        return optimizer.state_dict()
+    if mode == "sharded":
+        return None
+    optimizer.consolidate_state_dict(to=0)
+    return optimizer.state_dict() if utils.is_main_process() else None
+
+
+def shard_path(output_dir):
+    return os.path.join(output_dir, f"optimizer_rank{utils.get_rank():03}.pth")
+
+
+class OptimizerShard(object):
+    """
+    State dict of the partition of a ZeroRedundancyOptimizer held by this rank, for the per rank
+    checkpoints (to use with utils.restart_from_checkpoint).
+    """
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+
+    def state_dict(self):
+        return {
+            "optimizer": self.optimizer.optim.state_dict(),
+            "rank": utils.get_rank(),
+            "world_size": utils.get_world_size(),
+        }
+
+    def load_state_dict(self, state_dict):
+        assert state_dict["world_size"] == utils.get_world_size() and state_dict["rank"] == utils.get_rank(), \
+            "sharded optimizer checkpoints need the same ranks, resume from a consolidated one to change them"
+        self.optimizer.optim.load_state_dict(state_dict["optimizer"])
+
+
+def save_shard(optimizer, output_dir):
+    torch.save({"optimizer": OptimizerShard(optimizer).state_dict()}, shard_path(output_dir))
+
+
+def restart_shard(optimizer, output_dir):
+    utils.restart_from_checkpoint(shard_path(output_dir), optimizer=OptimizerShard(optimizer))
+
+
+def optimizer_state_numel(optimizer):
+    """
+    Number of elements of the optimizer state held by this rank.
+    """
+    local = optimizer.optim if is_sharded(optimizer) else optimizer
+    return sum(v.numel() for state in local.state.values() for v in state.values() if torch.is_tensor(v))
+
+
+def _smoke_test(rank, world_size, output_dir):
+    """
+    Steps of ZeroRedundancyOptimizer(AdamW) against AdamW under DDP, then after restarting from a
+    consolidated and from a sharded checkpoint.
+    """
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29511")
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    def build(shard):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.GELU(), torch.nn.Linear(32, 8))
+        model = torch.nn.parallel.DistributedDataParallel(model)
+        return model, build_optimizer(utils.get_params_groups(model), torch.optim.AdamW, shard=shard, lr=1e-2)
+
+    def train(model, optimizer, steps, seed):
+        torch.manual_seed(seed + rank)
+        for _ in range(steps):
+            optimizer.zero_grad()
+            model(torch.randn(4, 16)).pow(2).mean().backward()
+            optimizer.step()
+
+    def assert_same(model, other):
+        for p, q in zip(model.parameters(), other.parameters()):
+            assert torch.allclose(p, q, atol=1e-6), "sharded and replicated optimizers diverged"
+
+    reference, reference_optimizer = build(shard=False)
+    model, optimizer = build(shard=True)
+    train(reference, reference_optimizer, 5, seed=1)
+    train(model, optimizer, 5, seed=1)
+    assert_same(reference, model)
+    assert optimizer_state_numel(optimizer) < optimizer_state_numel(reference_optimizer)
+    train(reference, reference_optimizer, 3, seed=2)
+
+    checkpoint = os.path.join(output_dir, "checkpoint.pth")
+    for mode in CHECKPOINT_MODES:
+        state_dict = {"model": model.state_dict(), "optimizer": optimizer_state_dict(optimizer, mode)}
+        utils.save_on_master(state_dict, checkpoint)
+        if mode == "sharded":
+            save_shard(optimizer, output_dir)
+        dist.barrier()
+        restarted, restarted_optimizer = build(shard=True)
+        utils.restart_from_checkpoint(checkpoint, model=restarted, optimizer=restarted_optimizer)
+        if mode == "sharded":
+            restart_shard(restarted_optimizer, output_dir)
+        train(restarted, restarted_optimizer, 3, seed=2)
+        assert_same(reference, restarted)
+        dist.barrier()
+    if rank == 0:
+        print(f"ZeRO-1 smoke test passed on {world_size} gloo ranks ({', '.join(CHECKPOINT_MODES)} checkpoints)")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    import tempfile
+    import torch.multiprocessing as mp
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        mp.spawn(_smoke_test, args=(2, output_dir), nprocs=2)
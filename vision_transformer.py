@@ -21,6 +21,7 @@ from functools import partial
 import torch
 import torch.nn as nn
 
+from utils import utils
 from utils.utils import trunc_normal_
 
 
@@ -282,6 +283,34 @@ class DINOHead(nn.Module):
         return x
 
 
+class ShardedDINOHead(DINOHead):
+    """
+    DINOHead with the output dimension of last_layer sharded across the ranks. The bottleneck features of
+    every rank are gathered and each rank computes the logits of its out_dim / world_size outputs for the
+    samples of all the ranks, in rank order: use it with ShardedDINOLoss (train_ssl.py). The state dicts
+    hold the full last_layer.
+    """
+    def __init__(self, in_dim, out_dim, use_bn=False, norm_last_layer=True, nlayers=3, hidden_dim=2048, bottleneck_dim=256):
+        super().__init__(in_dim, out_dim, use_bn=use_bn, norm_last_layer=norm_last_layer, nlayers=nlayers,
+                         hidden_dim=hidden_dim, bottleneck_dim=bottleneck_dim)
+        world_size, rank = utils.get_world_size(), utils.get_rank()
+        assert out_dim % world_size == 0, "out_dim must be divisible by the world size to shard the head"
+        # rows of the full initialization, the same on every rank with the fixed seeds
+        last_layer = nn.utils.weight_norm(nn.Linear(bottleneck_dim, out_dim // world_size, bias=False))
+        last_layer.weight_v.data.copy_(self.last_layer.weight_v.data.chunk(world_size)[rank])
+        last_layer.weight_g.data.fill_(1)
+        if norm_last_layer:
+            last_layer.weight_g.requires_grad = False
+        self.last_layer = last_layer
+        utils.register_sharded_state(self, ["last_layer.weight_g", "last_layer.weight_v"], dim=0)
+
+    def forward(self, x):
+        x = self.mlp(x)
+        x = nn.functional.normalize(x, dim=-1, p=2)
+        x = self.last_layer(utils.gather_from_ranks(x))
+        return x
+
+
 class MultiDINOHead(nn.Module):
     def __init__(self, in_dim, out_dim, use_bn=False, norm_last_layer=True, nlayers=3, hidden_dim=2048,
                  bottleneck_dim=256):